@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import sys
+import os
+import argparse
+import logging
+
+from multiprocessing.pool import ThreadPool
+from CODE import ledger
+from CODE import resource_report
+
+
+"""
+Runs build_bart_network.r on shards of the target genes and merges them.
+
+Every shard is a contiguous block of targets fitted by its own Rscript job,
+and its regScore table is saved as soon as the job is finished, so a killed
+run resumes from the shards it has not finished yet, and the shards could be
+split across machines with --shard. When all shards are saved, their
+columns are bound in order into the table a single run would have written.
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Build the BART network on shards of the target genes.")
+    parser.add_argument('-e', '--fc', dest='fn_fc', type=str, help="fold change expression matrix, rows are samples, columns are genes")
+    parser.add_argument('-x', '--perturbed', dest='fn_pert', type=str)
+    parser.add_argument('-t', '--tf_names', dest='fn_tfs', type=str)
+    parser.add_argument('-o', '--output', dest='fn_output', type=str, help="regScore table written by write.table")
+    parser.add_argument('-n', '--num_shards', dest='num_shards', type=int, default=1)
+    parser.add_argument('-s', '--shard', dest='shards', type=int, nargs='+', help="run these 0-based shards only, eg: on one of several machines")
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help="shards run at the same time")
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1, help="cpu shared by the running shards")
+    parser.add_argument('-L', '--fn_ledger', dest='fn_ledger', type=str, help="ledger to skip the shards whose inputs are unchanged")
+    parser.add_argument('--program', dest='program', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "build_bart_network.r"))
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def count_targets(fn_fc):
+    """ The header of the fold change matrix names every target. """
+    with open(fn_fc) as reader:
+        return len(reader.readline().split())
+
+
+def shard_path(fn_output, index, count):
+    return "{}.shard{}of{}".format(fn_output, index + 1, count)
+
+
+def merge_shards(fns, fn_output):
+    """ Binds the columns of the regScore tables of the shards, the text of
+    every cell is kept as written by R. """
+    header, names, rows = [], None, None
+    for fn in fns:
+        with open(fn) as reader:
+            header.extend(reader.readline().rstrip("\n").split("\t"))
+            lines = [x.rstrip("\n").split("\t") for x in reader if x.strip()]
+        if names is None:
+            names = [x[0] for x in lines]
+            rows = [[] for _ in lines]
+        elif names != [x[0] for x in lines]:
+            raise ValueError("Regulators of %s differ from the other shards" % fn)
+        for row, line in zip(rows, lines):
+            row.extend(line[1:])
+
+    tmp = fn_output + ".tmp"
+    with open(tmp, "w") as writer:
+        writer.write("\t".join(header) + "\n")
+        for name, row in zip(names, rows):
+            writer.write("\t".join([name] + row) + "\n")
+    os.replace(tmp, fn_output)
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    count = max(1, min(parsed.num_shards, count_targets(parsed.fn_fc)))
+    shards = list(range(count)) if parsed.shards is None else [x for x in parsed.shards if 0 <= x < count]
+    jobs = max(1, min(parsed.jobs, len(shards)))
+    cores = max(1, parsed.processes // jobs)
+
+    journal = ledger.Ledger(parsed.fn_ledger) if parsed.fn_ledger is not None else None
+    inputs = None
+    if journal is not None:
+        inputs = [journal.hash_path(x) for x in (parsed.fn_fc, parsed.fn_pert, parsed.fn_tfs, parsed.program)]
+
+    def run_shard(index):
+        fn_shard = shard_path(parsed.fn_output, index, count)
+        key = "BART/{}/{}".format(index + 1, count)
+        value = ledger.fingerprint(inputs, index, count) if journal is not None else None
+        if os.path.exists(fn_shard) and (journal is None or journal.get(key) == value):
+            logging.info("Shard %d of %d is finished" % (index + 1, count))
+            return index
+
+        logging.info("Running shard %d of %d ... " % (index + 1, count))
+        resource_report.check_call("Rscript --vanilla {program} fcFile={fc} isPerturbedFile={pert} tfNameFile={tfs} saveTo={output} mpiBlockSize={processes} shardIndex={index} shardCount={count}".format(**{
+            "program": parsed.program,
+            "fc": parsed.fn_fc,
+            "pert": parsed.fn_pert,
+            "tfs": parsed.fn_tfs,
+            "output": fn_shard,
+            "processes": cores,
+            "index": index,
+            "count": count
+        }), name=key, shell=True)
+        if journal is not None:
+            journal.record(key, value)
+        return index
+
+    with ThreadPool(jobs) as p:
+        for _ in p.imap_unordered(run_shard, shards):
+            pass
+
+    fns = [shard_path(parsed.fn_output, x, count) for x in range(count)]
+    missing = [x for x in fns if not os.path.exists(x)]
+    if missing:
+        logging.info("%d of %d shards are not finished, skip merging" % (len(missing), count))
+        return False
+    merge_shards(fns, parsed.fn_output)
+    return True
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import sys
+import os
+import argparse
+import logging
+
+from multiprocessing import Pool
+from subprocess import CalledProcessError, TimeoutExpired
+
+import numpy as np
+from tqdm import tqdm
+
+from CODE import resource_report
+from CODE import scan_motifs
+
+
+"""
+Scores the motifs of all regulators with a few fimo runs instead of one per
+regulator.
+
+The MEME files of the regulators are concatenated into a batch file per
+process, every motif renamed to an ID unique in its batch, and every batch
+is scanned by one fimo --text run, so the promoters are loaded once per
+batch. The sites streamed by fimo are split on the fly into a fimo.txt of
+every regulator, named <regulator>.fimo.txt in the output directory, with
+the original motif name put back into the first column; estimate_affinity
+reads it as the fimo.txt fimo -o writes.
+
+fimo --text writes the sites in the order they are found and without
+q-values, which estimate_affinity does not read.
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Score the motifs of all regulators with one fimo run per batch of motifs.")
+    parser.add_argument('-m', '--dir_pfm', dest='dir_pfm', type=str, help="MEME motif of every regulator, named by the regulator")
+    parser.add_argument('-r', '--fn_rids', dest='fn_rids', type=str, help="score the motifs of these regulators only")
+    parser.add_argument('-P', '--fn_promoters', dest='fn_promoters', type=str)
+    parser.add_argument('-o', '--dir_fimo', dest='dir_fimo', type=str, help="the sites of a regulator are written to <dir_fimo>/<regulator>.fimo.txt")
+    parser.add_argument('-t', '--thresh', dest='thresh', type=float, default=5e-3)
+    parser.add_argument('-n', '--batches', dest='batches', type=int, help="number of fimo runs, default is the number of processes")
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1)
+    parser.add_argument('--fimo', dest='fimo', type=str, default="fimo", help="path to fimo")
+    parser.add_argument('--timeout', dest='timeout', type=float, help="seconds a fimo run is killed after")
+    parser.add_argument('--retries', dest='retries', type=int, default=1, help="times a failed or killed fimo run is tried again")
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def sites_path(dir_fimo, regulator):
+    return os.path.join(dir_fimo, regulator + ".fimo.txt")
+
+
+def write_batch(fn, fns):
+    """ Concatenates MEME files into one, with the header of the first file
+    and the motifs renamed M1, M2, ... in order.
+
+    Returns the regulator and the original name of every motif ID. """
+    owners = {}
+    with open(fn, "w") as writer:
+        for i, (regulator, fn_pfm) in enumerate(fns):
+            with open(fn_pfm) as reader:
+                lines = reader.readlines()
+            first = next((j for j, x in enumerate(lines) if x.startswith("MOTIF")), len(lines))
+            if i == 0:
+                writer.writelines(lines[:first])
+            for line in lines[first:]:
+                if line.startswith("MOTIF"):
+                    tokens = line.split()
+                    motif = "M%d" % (len(owners) + 1)
+                    owners[motif] = (regulator, tokens[1] if len(tokens) > 1 else "")
+                    line = "MOTIF %s\n" % motif
+                writer.write(line)
+            writer.write("\n")
+    return owners
+
+
+class Demultiplexer(object):
+    """ Writes every site line of a fimo --text stream to the fimo.txt of its
+    regulator. fimo reports one motif after another, so one file is open at
+    a time and a file is reopened to append only if its motifs interleave. """
+
+    def __init__(self, dir_fimo, owners):
+        self.dir_fimo = dir_fimo
+        self.owners = owners
+        self.current = None
+        self.writer = None
+        self.started = set()
+
+    def __call__(self, line):
+        if line.startswith("#") or not line.strip():
+            return
+        motif, rest = line.split("\t", 1)
+        regulator, name = self.owners[motif]
+        if regulator != self.current:
+            self.switch(regulator)
+        self.writer.write(name + "\t" + rest)
+
+    def switch(self, regulator):
+        if self.writer is not None:
+            self.writer.close()
+        fn = sites_path(self.dir_fimo, regulator) + ".tmp"
+        self.writer = open(fn, "a" if regulator in self.started else "w")
+        if regulator not in self.started:
+            self.writer.write(scan_motifs.HEADER)
+            self.started.add(regulator)
+        self.current = regulator
+
+    def discard(self):
+        """ Removes the files of a failed run. """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        for regulator in self.started:
+            os.remove(sites_path(self.dir_fimo, regulator) + ".tmp")
+        self.started = set()
+
+    def close(self):
+        """ Moves the files in place, regulators without any site get a header only. """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        for regulator in set(x[0] for x in self.owners.values()):
+            fn = sites_path(self.dir_fimo, regulator)
+            if regulator not in self.started:
+                with open(fn + ".tmp", "w") as writer:
+                    writer.write(scan_motifs.HEADER)
+            os.replace(fn + ".tmp", fn)
+
+
+__worker__ = {}
+
+
+def init_worker(parsed):
+    __worker__["parsed"] = parsed
+
+
+def run_batch(task):
+    """ One fimo run over the motifs of a batch.
+
+    Returns the regulators of the batch and the error of the last run, None
+    if it finished. """
+    index, fns = task
+    parsed = __worker__["parsed"]
+    fn_batch = os.path.join(parsed.dir_fimo, "batch%d.meme" % (index + 1))
+    owners = write_batch(fn_batch, fns)
+    # a failed run leaves no sites of an earlier one behind
+    for regulator, _ in fns:
+        if os.path.exists(sites_path(parsed.dir_fimo, regulator)):
+            os.remove(sites_path(parsed.dir_fimo, regulator))
+    cmd = "{fimo} --text --thresh {thresh} {motifs} {promoters}".format(**{
+        "fimo": parsed.fimo,
+        "thresh": parsed.thresh,
+        "motifs": fn_batch,
+        "promoters": parsed.fn_promoters
+    })
+
+    error = None
+    for attempt in range(parsed.retries + 1):
+        demux = Demultiplexer(parsed.dir_fimo, owners)
+        try:
+            with open(os.devnull, "w") as w:
+                resource_report.check_call(cmd, name="FIMO/batch%d" % (index + 1), timeout=parsed.timeout,
+                                           consume=demux, shell=True, stderr=w)
+            demux.close()
+            error = None
+            break
+        except (CalledProcessError, TimeoutExpired) as err:
+            demux.discard()
+            error = str(err)
+            if attempt < parsed.retries:
+                logging.warning("FIMO/batch%d: %s, trying again" % (index + 1, err))
+    os.remove(fn_batch)
+    return [x for x, _ in fns], error
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    if not os.path.exists(parsed.dir_fimo):
+        os.makedirs(parsed.dir_fimo)
+
+    if parsed.fn_rids is not None:
+        regulators = np.loadtxt(parsed.fn_rids, dtype=str, ndmin=1).tolist()
+    else:
+        regulators = sorted(os.listdir(parsed.dir_pfm))
+    fns, seen = [], set()
+    for regulator in regulators:
+        fn = os.path.join(parsed.dir_pfm, regulator)
+        if os.path.isfile(fn) and regulator not in seen:
+            fns.append((regulator, fn))
+            seen.add(regulator)
+    if not fns:
+        return {}
+
+    # a batch per process, so every process loads the promoters once
+    n_batches = max(1, min(len(fns), parsed.batches or parsed.processes))
+    batches = [(i, fns[i::n_batches]) for i in range(n_batches)]
+    logging.info("Scoring %d motifs in %d fimo runs ... " % (len(fns), n_batches))
+
+    failed = {}
+    with Pool(max(1, min(parsed.processes, n_batches)), initializer=init_worker, initargs=(parsed,)) as p:
+        for regulators, error in tqdm(p.imap_unordered(run_batch, batches), total=len(batches)):
+            if error is not None:
+                logging.warning("FIMO failed for %s: %s" % (", ".join(regulators), error))
+                failed.update((x, error) for x in regulators)
+    return failed
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
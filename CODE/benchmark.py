@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+import sys
+import os
+import gc
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+from collections import OrderedDict
+from subprocess import check_output, CalledProcessError
+
+import numpy as np
+
+from CODE import bin_network_scores
+from CODE import build_motif_network
+from CODE import model_averaging_utils
+from CODE import network_io
+from CODE import prepare_resources
+from CODE import weighted_avg_similar_dbds
+
+
+"""
+Benchmarks of the CODE modules on synthetic data.
+
+The data is generated at any number of genes, regulators, conditions and
+network density: a log fold change expression matrix, a lasso and a
+differential expression network, binding scores, groups of regulators with
+similar DBDs, FIMO summaries of the regulators and conditions with repeats.
+It can also be written as a RESOURCES directory for a run of the pipeline.
+
+Every benchmark is run a few times and the best wall time is kept, then run
+once more under tracemalloc for the peak of the memory it allocates, numpy
+arrays included. The results are saved as JSON along with the commit, so
+the runs of different commits are compared with --compare.
+"""
+
+# genes, regulators, conditions
+SIZES = OrderedDict([
+    ("small", (1000, 100, 100)),
+    ("medium", (6000, 300, 500)),
+    ("large", (20000, 1500, 1500)),
+])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the CODE modules on synthetic data.")
+    parser.add_argument('-s', '--sizes', dest='sizes', type=str, nargs='+', default=["small"],
+                        help="%s, or GENESxREGULATORSxCONDITIONS, eg: 2000x200x100" % ", ".join(SIZES.keys()))
+    parser.add_argument('-d', '--density', dest='density', type=float, default=0.1, help="fraction of non-zero edges of the networks")
+    parser.add_argument('-b', '--benchmarks', dest='benchmarks', type=str, nargs='+', help="run these benchmarks only, default is all")
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=3)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('-o', '--output', dest='fn_output', type=str, help="results, JSON")
+    parser.add_argument('-c', '--compare', dest='fn_baseline', type=str, help="results of an earlier run to compare with")
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float, default=1.2, help="slowdown or memory growth reported as a regression")
+    parser.add_argument('-w', '--write_resources', dest='dir_resources', type=str, help="write the data of the first size as a RESOURCES directory and exit")
+    parser.add_argument('--promoter_length', dest='promoter_length', type=int, default=600)
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def parse_size(size):
+    if size in SIZES:
+        return SIZES[size]
+    try:
+        genes, regulators, conditions = [int(x) for x in size.lower().split("x")]
+    except ValueError:
+        raise ValueError("Unknown size %s" % size)
+    if not 0 < regulators <= genes or conditions <= 0:
+        raise ValueError("Size %s needs 0 < regulators <= genes and conditions > 0" % size)
+    return genes, regulators, conditions
+
+
+def sparse_network(rng, shape, density, signed=True):
+    values = rng.standard_normal(shape) if signed else rng.random(shape)
+    values[rng.random(shape) >= density] = 0
+    return values
+
+
+def generate(genes, regulators, conditions, density=0.1, seed=0):
+    """ Synthetic inputs of the pipeline, regulators are the first genes. """
+    rng = np.random.default_rng(seed)
+    gids = np.array(["G%06d" % x for x in range(genes)])
+    rids = gids[:regulators]
+
+    # conditions repeated a few times, as replicates are
+    names = np.array(["C%05d" % x for x in range(max(1, conditions // 3))])
+    conds = names[rng.integers(0, len(names), conditions)]
+
+    # DBDs of regulators in groups of up to 5 similar ones
+    groups = rng.integers(0, max(1, regulators // 3), regulators)
+    pids = {}
+    for i, rid in enumerate(rids.tolist()):
+        similar = np.flatnonzero(groups == groups[i])
+        pids[rid] = {rids[x]: 100.0 if x == i else rng.uniform(30, 100) for x in similar[:5].tolist()}
+    tf_weights = {x: {y: weighted_avg_similar_dbds.sigmoid(z) for y, z in paired.items()} for x, paired in pids.items()}
+
+    return {
+        "genes": gids,
+        "regulators": rids,
+        "conditions": conds,
+        "expr": rng.standard_normal((genes, conditions)) * 0.3,
+        "lasso": sparse_network(rng, (regulators, genes), density),
+        "de": sparse_network(rng, (regulators, genes), density) * 20,
+        "binding": sparse_network(rng, (regulators, genes), density, signed=False),
+        "dbd_pids": pids,
+        "tf_weights": tf_weights,
+    }
+
+
+def write_fimo_summaries(dir_fimo, data, density, seed=0):
+    """ FIMO summaries of the regulators in the columns build_motif_network
+    reads, and the motifs.txt of FIRE naming them. """
+    rng = np.random.default_rng(seed)
+    gids = data["genes"]
+    lines = []
+    for i, rid in enumerate(data["regulators"].tolist()):
+        targets = gids[rng.random(len(gids)) < density]
+        ranks = rng.random((len(targets), 2))
+        with open(os.path.join(dir_fimo, rid + ".summary"), "w") as writer:
+            for target, (rank_sum, rank_max) in zip(targets.tolist(), ranks.tolist()):
+                writer.write("%s\t%s\t0\t%.6f\t0\t%.6f\t0\t0\t0\n" % (rid, target, rank_sum, rank_max))
+        # every fourth motif is matched to two regulators
+        motifs = rid if i % 4 or i == 0 else ",".join([rid, data["regulators"][i - 1]])
+        lines.append("%s\tmotif\tseed\t%.3f\t%d/10\n" % (motifs, rng.uniform(0, 10), rng.integers(0, 11)))
+    fn_motifs = os.path.join(dir_fimo, "motifs.txt")
+    with open(fn_motifs, "w") as writer:
+        writer.writelines(lines)
+    return fn_motifs
+
+
+def write_resources(dir_resources, data, promoter_length=600, seed=0):
+    """ The data as the input files of the pipeline, see config.json. """
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(os.path.join(dir_resources, "DBD_PIDS")):
+        os.makedirs(os.path.join(dir_resources, "DBD_PIDS"))
+    for name in ("genes", "regulators", "conditions"):
+        np.savetxt(os.path.join(dir_resources, name), data[name], fmt="%s")
+    np.savetxt(os.path.join(dir_resources, "data.expr"), data["expr"], fmt="%.8g", delimiter="\t")
+    network_io.write_adjmtr(os.path.join(dir_resources, "signed.de.adj"), data["de"], fmt="%.10g")
+    for rid, paired in data["dbd_pids"].items():
+        with open(os.path.join(dir_resources, "DBD_PIDS", rid), "w") as writer:
+            for paired_tf, pctid in paired.items():
+                writer.write("%s\t%.5f\n" % (paired_tf, pctid))
+    bases = np.array(list("ACGT"))
+    with open(os.path.join(dir_resources, "promoter.fasta"), "w") as writer:
+        for gid in data["genes"].tolist():
+            writer.write(">%s\n%s\n" % (gid, "".join(bases[rng.integers(0, 4, promoter_length)].tolist())))
+
+
+def bench_model_average_np(data, tmp):
+    model_averaging_utils.model_average_np(data["lasso"], data["de"])
+    return data["lasso"].size
+
+
+def bench_resort_by_weights(data, tmp):
+    model_averaging_utils.resort_by_weights(data["lasso"], data["binding"])
+    return data["lasso"].size
+
+
+def bench_average_scores(data, tmp):
+    weighted_avg_similar_dbds.average_scores(data["lasso"], data["tf_weights"], data["regulators"])
+    return data["lasso"].size
+
+
+def bench_build_network(data, tmp):
+    build_motif_network.build_network(
+        tmp["fn_rids"], tmp["fn_gids"], tmp["fn_motifs"], tmp["dir_fimo"], ".summary", "robust", 0
+    )
+    return len(data["regulators"]) * len(data["genes"])
+
+
+def bench_bin_scores(data, tmp):
+    targets, columns = bin_network_scores.dedupe_targets(data["genes"])
+    for row in data["lasso"]:
+        order, bins = bin_network_scores.bin_scores(row[columns], 20)
+    return data["lasso"].size
+
+
+def bench_make_nonrepeat_conditions(data, tmp):
+    prepare_resources.make_nonrepeat_conditions(data["conditions"])
+    return len(data["conditions"])
+
+
+def bench_write_text(data, tmp):
+    network_io.write_adjmtr(tmp["fn_text"], data["lasso"])
+    return data["lasso"].size
+
+
+def bench_read_text(data, tmp):
+    network_io.load_adjmtr(tmp["fn_text"])
+    return data["lasso"].size
+
+
+def bench_write_binary(data, tmp):
+    network_io.save_network(tmp["fn_binary"], data["lasso"], data["regulators"], data["genes"])
+    return data["lasso"].size
+
+
+def bench_read_binary(data, tmp):
+    # a memory map is read when it is summed
+    mtr, _, _ = network_io.load_network(tmp["fn_binary"])
+    np.sum(mtr)
+    return data["lasso"].size
+
+
+# name -> function returning the number of items it processed, run in this order
+BENCHMARKS = OrderedDict([
+    ("model_average_np", bench_model_average_np),
+    ("resort_by_weights", bench_resort_by_weights),
+    ("average_scores", bench_average_scores),
+    ("build_network", bench_build_network),
+    ("bin_scores", bench_bin_scores),
+    ("make_nonrepeat_conditions", bench_make_nonrepeat_conditions),
+    ("write_text", bench_write_text),
+    ("read_text", bench_read_text),
+    ("write_binary", bench_write_binary),
+    ("read_binary", bench_read_binary),
+])
+
+
+def measure(func, data, tmp, repeats):
+    """ Best wall time of the repeats, then the peak of the memory allocated
+    by one more run. """
+    seconds = []
+    for _ in range(max(1, repeats)):
+        gc.collect()
+        start = time.perf_counter()
+        items = func(data, tmp)
+        seconds.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(data, tmp)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return items, min(seconds), peak
+
+
+def commit_of(path):
+    try:
+        with open(os.devnull, "w") as w:
+            return check_output(["git", "rev-parse", "HEAD"], cwd=path, stderr=w).decode().strip()
+    except (OSError, CalledProcessError):
+        return None
+
+
+def run(sizes, density, names, repeats, seed=0):
+    results = []
+    for size in sizes:
+        genes, regulators, conditions = parse_size(size)
+        logging.info("Generating %d genes, %d regulators, %d conditions ... " % (genes, regulators, conditions))
+        data = generate(genes, regulators, conditions, density, seed)
+
+        dir_tmp = tempfile.mkdtemp(prefix="np2bench.")
+        try:
+            tmp = {
+                "dir_fimo": dir_tmp + "/",
+                "fn_rids": os.path.join(dir_tmp, "regulators"),
+                "fn_gids": os.path.join(dir_tmp, "genes"),
+                "fn_text": os.path.join(dir_tmp, "network.adjmtr"),
+                "fn_binary": os.path.join(dir_tmp, "network" + network_io.BINARY_SUFFIX),
+            }
+            np.savetxt(tmp["fn_rids"], data["regulators"], fmt="%s")
+            np.savetxt(tmp["fn_gids"], data["genes"], fmt="%s")
+            tmp["fn_motifs"] = write_fimo_summaries(dir_tmp, data, density, seed)
+
+            for name in names:
+                items, seconds, peak = measure(BENCHMARKS[name], data, tmp, repeats)
+                logging.info("%s at %s: %.3fs, %.1fM peak" % (name, size, seconds, peak / 2.0 ** 20))
+                results.append(OrderedDict([
+                    ("benchmark", name),
+                    ("size", size),
+                    ("genes", genes),
+                    ("regulators", regulators),
+                    ("conditions", conditions),
+                    ("density", density),
+                    ("seconds", seconds),
+                    ("items", items),
+                    ("items_per_second", items / seconds if seconds > 0 else None),
+                    ("peak_bytes", peak),
+                ]))
+        finally:
+            shutil.rmtree(dir_tmp)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Lines comparing the results with those of the baseline at the same
+    benchmark, size and density, and the number of regressions. """
+    key = lambda x: (x["benchmark"], x["genes"], x["regulators"], x["conditions"], x["density"])
+    earlier = {key(x): x for x in baseline["results"]}
+    lines, regressions = [], 0
+    for result in results:
+        before = earlier.get(key(result))
+        if before is None:
+            continue
+        time_ratio = result["seconds"] / before["seconds"] if before["seconds"] > 0 else float("inf")
+        memory_ratio = result["peak_bytes"] / before["peak_bytes"] if before["peak_bytes"] > 0 else 1.0
+        regressed = time_ratio > tolerance or memory_ratio > tolerance
+        regressions += regressed
+        lines.append("%-28s %-8s time x%.2f  memory x%.2f%s" % (
+            result["benchmark"], result["size"], time_ratio, memory_ratio, "  REGRESSION" if regressed else ""
+        ))
+    return lines, regressions
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
+
+    if parsed.dir_resources is not None:
+        data = generate(*parse_size(parsed.sizes[0]), density=parsed.density, seed=parsed.seed)
+        write_resources(parsed.dir_resources, data, parsed.promoter_length, parsed.seed)
+        return
+
+    names = parsed.benchmarks or list(BENCHMARKS.keys())
+    unknown = [x for x in names if x not in BENCHMARKS]
+    if unknown:
+        sys.exit("Unknown benchmarks: %s\n" % ", ".join(unknown))
+
+    report = OrderedDict([
+        ("commit", commit_of(os.path.dirname(os.path.abspath(__file__)))),
+        ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("python", platform.python_version()),
+        ("numpy", np.__version__),
+        ("machine", platform.machine()),
+        ("cpu_count", os.cpu_count()),
+        ("results", run(parsed.sizes, parsed.density, names, parsed.repeats, parsed.seed)),
+    ])
+    if parsed.fn_output is not None:
+        with open(parsed.fn_output, "w") as writer:
+            json.dump(report, writer, indent=4)
+
+    if parsed.fn_baseline is not None:
+        with open(parsed.fn_baseline) as reader:
+            baseline = json.load(reader)
+        lines, regressions = compare(report["results"], baseline, parsed.tolerance)
+        print("Compared with %s" % (baseline.get("commit") or parsed.fn_baseline))
+        print("\n".join(lines))
+        if regressions:
+            sys.exit("%d regressions over x%.2f\n" % (regressions, parsed.tolerance))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import sys
+import os
+import argparse
+import logging
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from CODE import network_io
+from CODE import resource_bundle
+
+
+"""
+Bins every row of a network into the FIRE --expfiles inputs in one pass,
+without the per-regulator score files of parse_network_scores.
+
+A row is binned exactly as parse_quantized_bins.process_score bins the file
+parse_network_scores writes: scores are quantized to %0.17f, ties keep the
+reversed file order, bins compare scores rounded to 15 digits, and zero
+scores go to the last bin.
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Discretize the scores of every regulator in a network into equal-value-range bins, along with a bin of all zeros.")
+    parser.add_argument('-a', '--adjmtr', dest='adjmtr', type=str)
+    parser.add_argument('-r', '--regulator', dest='regulator', type=str)
+    parser.add_argument('-t', '--target', dest='target', type=str)
+    parser.add_argument('-n', '--num_bin', dest='num_bin', type=int, default=20)
+    parser.add_argument('-o', '--dir_output', dest='dir_output', type=str)
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1)
+    parser.add_argument('-B', '--dir_bundle', dest='dir_bundle', type=str, help="binary bundle of the resources written by prepare_resources")
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def reformat(values, fmt):
+    """ Equals float(fmt % x) for every value, formatted and parsed in bulk. """
+    if len(values) == 0:
+        return np.zeros(0)
+    text = ((fmt + "\n") * len(values)) % tuple(values.tolist())
+    return np.array(list(map(float, text.split())))
+
+
+def dedupe_targets(targets):
+    """ The scores files are read into a dictionary: a repeated target keeps
+    the position of its first line and the score of its last line.
+
+    Returns the kept targets and the column each one takes its score from. """
+    targets = np.asarray(targets)
+    _, first = np.unique(targets, return_index=True)
+    if len(first) == len(targets):
+        columns = np.arange(len(targets))
+        return targets, columns
+
+    first = np.sort(first)
+    _, last = np.unique(targets[::-1], return_index=True)
+    last = dict(zip(targets[::-1][last].tolist(), (len(targets) - 1 - last).tolist()))
+    columns = np.array([last[x] for x in targets[first].tolist()], dtype=int)
+    return targets[first], columns
+
+
+def bin_scores(scores, num_bin):
+    """ Returns the order of the targets in the output and their bins. """
+    if not np.all(np.isfinite(scores)):
+        raise ValueError("Cannot bin non-finite scores")
+
+    scores = reformat(scores, "%0.17f")
+    # sorted by score, then reversed
+    order = np.argsort(scores, kind="stable")[::-1]
+    scores = scores[order]
+
+    max_score = float(scores[0])
+    min_score = float(scores[-1])
+    interval_score = (max_score - min_score) / (num_bin - 1)
+
+    # thresholds never increase, so the bin of a score is the number of thresholds above it
+    thresholds = np.array([round(max_score - interval_score * (j + 1), 15) for j in range(num_bin + 2)])
+    rounded = reformat(scores, "%.15f")
+    bins = np.searchsorted(-thresholds, -rounded, side="left")
+    if bins[-1] >= len(thresholds):
+        bins = bin_sorted_scores(scores, max_score, interval_score)
+
+    nonzero = scores != 0
+    bins = np.concatenate([bins[nonzero], np.full(np.count_nonzero(~nonzero), num_bin - 1, dtype=bins.dtype)])
+    order = np.concatenate([order[nonzero], order[~nonzero]])
+    return order, bins
+
+
+def bin_sorted_scores(scores, max_score, interval_score):
+    """ The binning loop of process_score over scores sorted in descending order. """
+    bins = np.zeros(len(scores), dtype=int)
+    # python floats, numpy scalars round differently
+    scores = scores.tolist()
+    i = 0
+    j = 0
+    while i < len(scores):
+        if round(scores[i], 15) >= round((max_score - interval_score * (j + 1)), 15):
+            bins[i] = j
+            i += 1
+        else:   j += 1
+    return bins
+
+
+def write_bins(fo, targets, order, bins):
+    writer = open(fo, "w")
+    writer.write("target\tscore\n")
+    if len(order) > 0:
+        cells = np.empty(2 * len(order), dtype=object)
+        cells[0::2] = targets[order].tolist()
+        cells[1::2] = bins.tolist()
+        writer.write(("%s\t%d\n" * len(order)) % tuple(cells.tolist()))
+    writer.close()
+
+
+__worker__ = {}
+
+
+def init_worker(adjmtr, targets, columns, num_bin, dir_output):
+    __worker__.update(adjmtr=adjmtr, targets=targets, columns=columns, num_bin=num_bin, dir_output=dir_output)
+
+
+def bin_row(task):
+    indx, tf = task
+    row = np.asarray(__worker__["adjmtr"][indx], dtype=float)[__worker__["columns"]]
+    order, bins = bin_scores(row, __worker__["num_bin"])
+    write_bins(os.path.join(__worker__["dir_output"], tf), __worker__["targets"], order, bins)
+    return tf
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    if not os.path.exists(parsed.dir_output):
+        os.makedirs(parsed.dir_output)
+
+    # load adjmtr, regulator and target lists
+    adjmtr = network_io.load_adjmtr(parsed.adjmtr)
+    tfs = resource_bundle.read_ids(parsed.regulator, parsed.dir_bundle, delimiter="\t", ndmin=1)
+    targets = resource_bundle.read_ids(parsed.target, parsed.dir_bundle, delimiter="\t", ndmin=1)
+    targets, columns = dedupe_targets(targets)
+
+    # a regulator listed several times is written by its last row
+    tasks = list({tf: (i, tf) for i, tf in enumerate(tfs[:adjmtr.shape[0]].tolist())}.values())
+
+    logging.info("Binning %d regulators into %d bins ... " % (len(tasks), parsed.num_bin))
+    if parsed.processes > 1 and len(tasks) > 1:
+        initargs = (adjmtr, targets, columns, parsed.num_bin, parsed.dir_output)
+        with Pool(parsed.processes, initializer=init_worker, initargs=initargs) as p:
+            for _ in p.imap_unordered(bin_row, tasks, chunksize=max(1, len(tasks) // (parsed.processes * 16))):
+                pass
+    else:
+        init_worker(adjmtr, targets, columns, parsed.num_bin, parsed.dir_output)
+        for task in tasks:
+            bin_row(task)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
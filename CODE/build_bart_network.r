@@ -52,7 +52,7 @@ getBartNetwork <- function(tgtLevel, tfLevel, regMat, unperturbedTfLevel, nBin =
 	try(dim(result$yMeanVar) <- dim(result$yMean)); # reshaping yMeanVar
 	try(dimnames(result$yMeanVar) <- dimnames(result$yMean));
 	#
-	result$regScore <- result$yMean[nBin, , ] - result$yMean[1, , ] # calculating regulation score
+	result$regScore <- array(result$yMean[nBin, , ] - result$yMean[1, , ], dim(result$yMean)[-1], dimnames(result$yMean)[-1]) # calculating regulation score, kept as a matrix for a single regulator or target
 	result;
 }
 
@@ -277,6 +277,14 @@ regMat <- matrix(FALSE, nTf, nTgt, dimnames = list(tfName, tgtName));
 regMat[availableTfName, ] <- TRUE; # only allow a target to be regulated by TFs whose expression levels are avaiable in the data
 regMat[cbind(availableTfName, availableTfName)] <- FALSE; # disallow autoregulation
 
+# keeping the targets of one shard only: shards are contiguous blocks of targets, so that their regScore columns are merged by binding them in order
+if (!is.null(argList$shardCount)) {
+	shardOf <- floor((sequence(nTgt) - 1) * argList$shardCount / nTgt);
+	tgtIx <- which(shardOf == argList$shardIndex);
+	tgtLevel <- tgtLevel[, tgtIx, drop = FALSE];
+	regMat <- regMat[, tgtIx, drop = FALSE];
+}
+
 if (!is.null(argList$saveTo)) saveProcessTo <- paste(argList$saveTo, ".bartProcess.RData", sep = "") else saveProcessTo <- NULL;
 if (!is.null(argList$mpiBlockSize))
 	if (argList$mpiBlockSize)
@@ -293,5 +301,7 @@ result <- getBartNetwork(
 
 if (!is.null(argList$saveTo)) {
 	save(result, file = paste(argList$saveTo, ".bartResult.RData", sep = ""));
-	write.table(result$regScore, file = argList$saveTo, sep = "\t");
+	# written next to saveTo and renamed, so that a killed run never leaves a partial result behind
+	write.table(result$regScore, file = paste(argList$saveTo, ".tmp", sep = ""), sep = "\t");
+	file.rename(paste(argList$saveTo, ".tmp", sep = ""), argList$saveTo);
 }
@@ -4,9 +4,14 @@ import argparse
 import os.path
 import logging
 
+from multiprocessing import Pool
+
 import numpy as np
 from scipy.stats.mstats import gmean
 
+from CODE import network_io
+from CODE import resource_bundle
+
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description="Build motif network using the (inferred) PWM scores on promoters.")
@@ -18,19 +23,27 @@ def parse_args(argv):
     parser.add_argument('-s', '--summary_suffix', dest='summary_suffix', type=str, default=".summary")
     parser.add_argument('-t', '--thld_type', dest='thld_type', type=str)
     parser.add_argument('-v', '--thld_val', dest='thld_val', type=float, default=0)
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1)
+    parser.add_argument('-B', '--dir_bundle', dest='dir_bundle', type=str, help="binary bundle of the resources written by prepare_resources")
     parsed = parser.parse_args(argv)
     return parsed
 
 
-def build_network(fn_rids, fn_gids, fn_inferred, dir_fimo, summary_suffix, thld_type, thld_val):
+def build_network(fn_rids, fn_gids, fn_inferred, dir_fimo, summary_suffix, thld_type, thld_val, processes=1, dir_bundle=None):
     # initialize network
-    rids = np.loadtxt(fn_rids, dtype=str)
-    gids = np.loadtxt(fn_gids, dtype=str)
+    rids = resource_bundle.read_ids(fn_rids, dir_bundle)
+    gids = resource_bundle.read_ids(fn_gids, dir_bundle)
     adjmtr = np.zeros([len(rids), len(gids)])
+    # index of the first row of every regulator
+    rindex = {}
+    for i, rid in enumerate(rids.tolist()):
+        rindex.setdefault(rid, i)
+
     # iterate thru motifs
     f = open(fn_inferred, "r")
     lines = f.readlines()
     f.close()
+    rows, tasks = [], []
     for line in lines:
         # get inferred tf and database motif
         inferred, _, _, zscore, robust = line.strip().split('\t')
@@ -41,9 +54,8 @@ def build_network(fn_rids, fn_gids, fn_inferred, dir_fimo, summary_suffix, thld_
             indx = np.where(rids == inferred)[0]
             if len(indx) > 0:
                 continue
-            ## get fimo score and build subnetwork
-            subadjmtr = build_subnetwork(motifs, gids, dir_fimo, summary_suffix)
-            adjmtr[indx[0], :] = gmean(subadjmtr).data
+            rows.append(indx[0])
+            tasks.append((motifs, True))
 
         else:
             # get confidence score and threshold type
@@ -56,56 +68,92 @@ def build_network(fn_rids, fn_gids, fn_inferred, dir_fimo, summary_suffix, thld_
             ## check if inferred motif passes motif quality threshold
             if score < thld_val:
                 continue
-            indx = np.where(rids == inferred)[0]
-            if len(indx) <= 0:
+            if inferred not in rindex:
                 continue
-            ## get fimo score and build subnetwork
-            subadjmtr = build_subnetwork(motifs, gids, dir_fimo,summary_suffix)
-            if len(motifs) > 1:
-                adjmtr[indx[0], :] = gmean(subadjmtr).data
-            else:
-                adjmtr[indx[0], :] = subadjmtr
+            rows.append(rindex[inferred])
+            tasks.append((motifs, len(motifs) > 1))
+
+    ## get fimo score and build subnetwork, rows are assigned in the order of lines
+    gene_index = index_genes(gids)
+    if processes > 1 and len(tasks) > 1:
+        with Pool(processes, initializer=init_worker, initargs=(gene_index, dir_fimo, summary_suffix)) as p:
+            for indx, row in zip(rows, p.imap(build_row, tasks, chunksize=max(1, len(tasks) // (processes * 16)))):
+                adjmtr[indx, :] = row
+    else:
+        init_worker(gene_index, dir_fimo, summary_suffix)
+        for indx, task in zip(rows, tasks):
+            adjmtr[indx, :] = build_row(task)
     return adjmtr
 
 
-def build_subnetwork(motifs, gids, dir_fimo, summary_suffix):
-    adjmtr = np.zeros([len(motifs), len(gids)])
+def index_genes(gids):
+    """ Sorted unique gene IDs, and the position in it of every column. """
+    return np.unique(np.asarray(gids), return_inverse=True)
+
+
+__worker__ = {}
+
+
+def init_worker(gene_index, dir_fimo, summary_suffix):
+    __worker__["gene_index"] = gene_index
+    __worker__["dir_fimo"] = dir_fimo
+    __worker__["summary_suffix"] = summary_suffix
+
+
+def build_row(task):
+    """ Builds the row of an inferred motif, the geometric mean over the
+    motifs if there are several of them. """
+    motifs, use_gmean = task
+    subadjmtr = build_subnetwork(motifs, __worker__["gene_index"], __worker__["dir_fimo"], __worker__["summary_suffix"])
+    if use_gmean:
+        return gmean(subadjmtr).data
+    return subadjmtr
+
+
+def build_subnetwork(motifs, gene_index, dir_fimo, summary_suffix):
+    """ gene_index is either the gene IDs or index_genes of them. """
+    if not isinstance(gene_index, tuple):
+        gene_index = index_genes(gene_index)
+    uniq, columns = gene_index
+
+    adjmtr = np.zeros([len(motifs), len(columns)])
     for j in range(len(motifs)):
         fn_motif = dir_fimo + motifs[j] + summary_suffix
         if not os.path.isfile(fn_motif):
             continue
-        score_dict = get_fimo_scores(fn_motif)
-        for k in range(len(gids)):
-            gid = gids[k]
-            adjmtr[j, k] = score_dict[gid] if gid in score_dict else 0
+        names, scores = get_fimo_scores(fn_motif)
+        if len(names) == 0 or len(uniq) == 0:
+            continue
+        # the last score of a target wins, like a dictionary
+        names, last = np.unique(names[::-1], return_index=True)
+        scores = scores[::-1][last]
+
+        pos = np.minimum(np.searchsorted(uniq, names), len(uniq) - 1)
+        found = uniq[pos] == names
+        row = np.zeros(len(uniq))
+        row[pos[found]] = scores[found]
+        adjmtr[j, :] = row[columns]
     return adjmtr
 
 
 def get_fimo_scores(fn):
+    """ Returns the target names and the larger of the two scores of every
+    line, in the order of the file. """
     ## load file
     f = open(fn, "r")
     lines = f.readlines()
     f.close()
-    ## store target scores into dictionary
-    d = {}
+    names, scores = [], []
     for line in lines:
         line = line.strip().split()
-        name = line[1]
+        names.append(line[1])
         score = max([float(line[3]), float(line[5])])
-        d[name] = score
-    return d
+        scores.append(score)
+    return np.array(names, dtype=str), np.array(scores, dtype=float)
 
 
 def write_adjmtr(adjmtr, fn):
-    writer = open(fn, "w")
-    for i in range(len(adjmtr)):
-        for j in range(len(adjmtr[i])):
-            if adjmtr[i,j] == 0:
-                writer.write("0.\t")
-            else:
-                writer.write("%0.10f\t" % adjmtr[i,j])
-        writer.write("\n")
-    writer.close()
+    network_io.write_adjmtr(fn, adjmtr, fmt="%0.10f", zero="0.")
 
 
 def main(argv):
@@ -119,10 +167,15 @@ def main(argv):
 
     ## build network
     logging.info("Building motif network ... ")
-    network = build_network(parsed.fn_rids, parsed.fn_gids, parsed.fn_inferred, parsed.dir_fimo, parsed.summary_suffix, parsed.thld_type, parsed.thld_val)
+    network = build_network(parsed.fn_rids, parsed.fn_gids, parsed.fn_inferred, parsed.dir_fimo, parsed.summary_suffix, parsed.thld_type, parsed.thld_val, parsed.processes, parsed.dir_bundle)
     # write adjmtr file
     logging.info("DONE\nWriting network ... ")
-    write_adjmtr(network, parsed.fn_adjmtr)
+    if parsed.fn_adjmtr.endswith(network_io.BINARY_SUFFIX):
+        rids = resource_bundle.read_ids(parsed.fn_rids, parsed.dir_bundle)
+        gids = resource_bundle.read_ids(parsed.fn_gids, parsed.dir_bundle)
+        network_io.save_network(parsed.fn_adjmtr, network, rids, gids)
+    else:
+        write_adjmtr(network, parsed.fn_adjmtr)
     logging.info("DONE\n")
 
 
@@ -4,9 +4,8 @@ import os
 import argparse
 import logging
 
-import numpy as nmp
-
 from CODE.model_averaging_utils import *
+from CODE import network_io
 
 
 """
@@ -69,16 +68,16 @@ def main(argv):
         logging.info("Reading input arguments ... ")
 
         # read in LASSO values
-        lasso_component = nmp.loadtxt(parsed.lasso_component)
+        lasso_component, rids, gids = network_io.read_network(parsed.lasso_component)
         # read in DE values
-        de_component = nmp.loadtxt(parsed.de_component)
+        de_component = network_io.load_adjmtr(parsed.de_component)
         # read in desired name for final combined adjmtr
         output_adjmtr_name = os.path.join(parsed.output_dir, 
                                           parsed.output_adjmtr_name)
         # read in PWM binding information, if available
         binding_strengths = None
         if parsed.binding_strengths != None:
-            binding_strengths = nmp.loadtxt(parsed.binding_strengths)
+            binding_strengths = network_io.load_adjmtr(parsed.binding_strengths)
             
         # Optional:
         making_adjlst = False
@@ -111,14 +110,14 @@ def main(argv):
         logging.info("Reading input arguments ... ")
 
         # read in np values
-        np_component = nmp.loadtxt(parsed.np_component)
+        np_component, rids, gids = network_io.read_network(parsed.np_component)
         # read in desired name for final combined adjmtr
         output_adjmtr_name = os.path.join(parsed.output_dir, 
                                           parsed.output_adjmtr_name)
         # read in PWM binding information, if available
         binding_strengths = None
         if parsed.binding_strengths != None:
-            binding_strengths = nmp.loadtxt(parsed.binding_strengths)
+            binding_strengths = network_io.load_adjmtr(parsed.binding_strengths)
             
         # Optional:
         making_adjlst = False
@@ -144,20 +143,12 @@ def main(argv):
     # if args provided, write out combined lists as an adjacency list
     logging.info("Writing adjmtr file ... ")
     # nmp.savetxt(output_adjmtr_name, combined)
-    write_adjmtr(output_adjmtr_name, combined)
+    network_io.write_network(output_adjmtr_name, combined, rids, gids, fmt="%0.15f", zero="0")
     logging.info("Done\n")
 
 
 def write_adjmtr(fn, adjmtr):
-    writer = open(fn, "w")
-    for i in range(len(adjmtr)):
-        for j in range(len(adjmtr[i])):
-            if adjmtr[i,j] == 0:
-                writer.write("0\t")
-            else:
-                writer.write("%0.15f\t" % adjmtr[i,j])
-        writer.write("\n")
-    writer.close()
+    network_io.write_adjmtr(fn, adjmtr, fmt="%0.15f", zero="0")
 
 
 if __name__ == "__main__":
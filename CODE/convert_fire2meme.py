@@ -18,6 +18,57 @@ def errprint(st):
     logging.ERROR(st + "\n")
 
 
+def write_meme(fn, motif):
+    """ Writes a FIRE motif, eg: A[CG]T.N, as a MEME position frequency matrix. """
+    # write header to output file
+    writer = open(fn, "w")
+    writer.write("MEME version 4.9.1\n\nALPHABET= ACGT\n\nstrands: + -\n\n")
+
+    # parse string by character
+    charList = []
+    charMotif = motif
+    i = 0
+    while i < len(charMotif):
+        if charMotif[i] == "[":
+            childList = []
+            i += 1
+            while charMotif[i] != "]":
+                childList.append(charMotif[i])
+                i += 1
+            charList.append(childList)
+        else: 
+            charList.append(charMotif[i])
+        i += 1
+
+    # make pfm, row order of ACGT
+    pfm = [[float(0) for item in range(4)] for item in range(len(charList))]
+    for i in range(len(charList)):
+        if len(charList[i]) > 1:
+            for item in charList[i]:
+                pfm[i][0] = float(1)/len(charList[i]) if item == "A" else pfm[i][0]
+                pfm[i][1] = float(1)/len(charList[i]) if item == "C" else pfm[i][1]
+                pfm[i][2] = float(1)/len(charList[i]) if item == "G" else pfm[i][2]
+                pfm[i][3] = float(1)/len(charList[i]) if item == "T" else pfm[i][3]
+        else:
+            if charList[i] == "N" or charList[i] == ".":
+                for j in range(4):
+                    pfm[i][j] = 0.25
+            else:
+                pfm[i][0] = 1 if charList[i] == "A" else pfm[i][0]
+                pfm[i][1] = 1 if charList[i] == "C" else pfm[i][1]
+                pfm[i][2] = 1 if charList[i] == "G" else pfm[i][2]
+                pfm[i][3] = 1 if charList[i] == "T" else pfm[i][3]
+
+    # write motif to output file
+    writer.write("MOTIF %s\n\n" % motif)
+    writer.write("letter-probability matrix: alength= 4 w= %d nsites= 20 E= 0\n" % len(charList))
+    for i in range(len(charList)):
+        for j in range(4):
+            writer.write("%.3f\t" % pfm[i][j])
+        writer.write("\n")
+    writer.close()
+
+
 def main(argv):
     parsed = parse_args(argv)
     if not parsed.dir_output.endswith("/"):
@@ -32,53 +83,7 @@ def main(argv):
         tf = line.split()[0]
         motif = line.split()[1]
 
-        # write header to output file
-        writer = open(parsed.dir_output + tf, "w")
-        writer.write("MEME version 4.9.1\n\nALPHABET= ACGT\n\nstrands: + -\n\n")
-
-        # parse string by character
-        charList = []
-        charMotif = motif
-        i = 0
-        while i < len(charMotif):
-            if charMotif[i] == "[":
-                childList = []
-                i += 1
-                while charMotif[i] != "]":
-                    childList.append(charMotif[i])
-                    i += 1
-                charList.append(childList)
-            else: 
-                charList.append(charMotif[i])
-            i += 1
-
-        # make pfm, row order of ACGT
-        pfm = [[float(0) for item in range(4)] for item in range(len(charList))]
-        for i in range(len(charList)):
-            if len(charList[i]) > 1:
-                for item in charList[i]:
-                    pfm[i][0] = float(1)/len(charList[i]) if item == "A" else pfm[i][0]
-                    pfm[i][1] = float(1)/len(charList[i]) if item == "C" else pfm[i][1]
-                    pfm[i][2] = float(1)/len(charList[i]) if item == "G" else pfm[i][2]
-                    pfm[i][3] = float(1)/len(charList[i]) if item == "T" else pfm[i][3]
-            else:
-                if charList[i] == "N" or charList[i] == ".":
-                    for j in range(4):
-                        pfm[i][j] = 0.25
-                else:
-                    pfm[i][0] = 1 if charList[i] == "A" else pfm[i][0]
-                    pfm[i][1] = 1 if charList[i] == "C" else pfm[i][1]
-                    pfm[i][2] = 1 if charList[i] == "G" else pfm[i][2]
-                    pfm[i][3] = 1 if charList[i] == "T" else pfm[i][3]
-
-        # write motif to output file
-        writer.write("MOTIF %s\n\n" % motif)
-        writer.write("letter-probability matrix: alength= 4 w= %d nsites= 20 E= 0\n" % len(charList))
-        for i in range(len(charList)):
-            for j in range(4):
-                writer.write("%.3f\t" % pfm[i][j])
-            writer.write("\n")
-        writer.close()
+        write_meme(parsed.dir_output + tf, motif)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+u"""
+Created at 2020.01.10
+
+A dependency-graph scheduler for the pipeline steps.
+
+Every task declares the files or directories it reads and writes; the edges
+of the graph are derived from those declarations, and the tasks whose
+inputs are ready are started concurrently within a CPU and a memory budget.
+A task also declares how many threads it could use and its memory footprint
+at a number of threads; it is granted as many threads as the budgets allow.
+
+The granted threads are the processes of the pools and R workers of a task;
+the BLAS and OpenMP pools in every one of them are capped by cap_threads,
+otherwise each would start a thread per core on its own.
+"""
+import os
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# thread pools of OpenMP, OpenBLAS, MKL, Accelerate and numexpr
+THREAD_ENV = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+def cap_threads(threads: int=1, env=None):
+    u"""
+    cap the BLAS and OpenMP thread pools, unless they are set by the user already;
+    it has to be called before numpy is imported, and is inherited by child processes
+    :param threads: threads of every pool
+    :param env: environment to update, default is os.environ
+    :return: the environment
+    """
+    env = os.environ if env is None else env
+    for key in THREAD_ENV:
+        env.setdefault(key, str(threads))
+    return env
+
+
+def physical_memory():
+    u"""
+    bytes of physical memory, None if unknown
+    """
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class Task(object):
+    u"""
+    A single schedulable unit of work
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), threads: int=1, min_threads: int=None, params=None, memory=0):
+        u"""
+        :param name: name of task, used in logs and error messages
+        :param func: callable, called with the number of granted threads
+        :param inputs: files or directories read by this task
+        :param outputs: files or directories written by this task
+        :param threads: how many cpu this task could make use of
+        :param min_threads: the minimum number of cpu this task could start with, default is threads
+        :param params: json serializable parameters that change the outputs of this task
+        :param memory: bytes this task uses, or a callable of the number of threads returning them;
+                       evaluated when the task is ready, so it could be estimated from the inputs
+        """
+        self.name = name
+        self.func = func
+        self.inputs = [os.path.normpath(x) for x in inputs]
+        self.outputs = [os.path.normpath(x) for x in outputs]
+        self.threads = max(1, threads)
+        self.min_threads = max(1, min(min_threads or self.threads, self.threads))
+        self.params = params or {}
+        self.memory = memory
+
+    def footprint(self, threads: int):
+        u"""
+        bytes this task uses with the number of threads
+        """
+        return int(self.memory(threads)) if callable(self.memory) else int(self.memory)
+
+    def __repr__(self):
+        return "Task({})".format(self.name)
+
+
+def produces(output, input_):
+    u"""
+    whether the input is the output itself or lies inside the output directory
+    """
+    return input_ == output or input_.startswith(output.rstrip(os.sep) + os.sep)
+
+
+def resolve_dependencies(tasks):
+    u"""
+    derive the upstream tasks of every task from the declared inputs and outputs
+
+    :param tasks: list of Task
+    :return: dict of task name -> list of upstream task names, in declaration order
+    """
+    requires = {}
+    for task in tasks:
+        requires[task.name] = []
+        for other in tasks:
+            if other is task:
+                continue
+
+            if any(produces(o, i) for o in other.outputs for i in task.inputs):
+                requires[task.name].append(other.name)
+
+    # check cycles by depth first search
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == 1:
+            raise ValueError("Cyclic dependencies between tasks: %s" % " -> ".join(path + [name]))
+        if state.get(name) == 2:
+            return
+        state[name] = 1
+        for upstream in requires[name]:
+            visit(upstream, path + [name])
+        state[name] = 2
+
+    for task in tasks:
+        visit(task.name, [])
+
+    return requires
+
+
+class DAGScheduler(object):
+    u"""
+    Run tasks as soon as their upstream tasks are finished, within a cpu budget
+    """
+
+    def __init__(self, tasks, processes: int=1, memory: int=None):
+        u"""
+        :param tasks: list of Task
+        :param processes: total cpu budget shared by all running tasks
+        :param memory: total bytes shared by all running tasks, None for no limit
+        """
+        names = [x.name for x in tasks]
+        if len(set(names)) != len(names):
+            raise ValueError("Task names must be unique: %s" % names)
+
+        self.tasks = tasks
+        self.processes = max(1, processes)
+        self.memory = memory
+        self.requires = resolve_dependencies(tasks)
+
+    def __grant__(self, task, used, used_memory=0):
+        u"""
+        how many threads could be granted to task, 0 if it has to wait
+        """
+        available = self.processes - used
+        if used == 0:
+            # a task requiring more than the whole budget runs alone with the whole budget
+            threads = min(task.threads, self.processes)
+        elif available >= task.min_threads:
+            threads = min(task.threads, available)
+        else:
+            return 0
+
+        if self.memory is None:
+            return threads
+        # fewer threads, as long as the task fits in the memory left
+        while threads > task.min_threads and used_memory + task.footprint(threads) > self.memory:
+            threads -= 1
+        if used_memory + task.footprint(threads) <= self.memory:
+            return threads
+        if used == 0:
+            logging.warning("%s may use %.1fG, more than the memory budget of %.1fG" % (
+                task.name, task.footprint(threads) / 2.0 ** 30, self.memory / 2.0 ** 30))
+            return threads
+        return 0
+
+    @staticmethod
+    def __execute__(task, threads):
+        missing = [x for x in task.inputs if not os.path.exists(x)]
+        if missing:
+            raise FileNotFoundError("Cannot find inputs of %s: %s" % (task.name, ", ".join(missing)))
+
+        logging.info("Start %s with %d cpu" % (task.name, threads))
+        task.func(threads)
+
+        missing = [x for x in task.outputs if not os.path.exists(x)]
+        if missing:
+            raise FileNotFoundError("%s did not produce: %s" % (task.name, ", ".join(missing)))
+
+    def run(self):
+        u"""
+        run all tasks, raise the first error after the running tasks are finished
+        """
+        pending = list(self.tasks)
+        finished = set()
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=len(self.tasks) or 1) as executor:
+            while pending or running:
+                if error is None:
+                    used = sum(x[1] for x in running.values())
+                    used_memory = sum(x[2] for x in running.values())
+                    for task in list(pending):
+                        if not all(x in finished for x in self.requires[task.name]):
+                            continue
+
+                        threads = self.__grant__(task, used, used_memory)
+                        if threads <= 0:
+                            continue
+
+                        pending.remove(task)
+                        memory = task.footprint(threads) if self.memory is not None else 0
+                        running[executor.submit(self.__execute__, task, threads)] = (task, threads, memory)
+                        used += threads
+                        used_memory += memory
+                elif not running:
+                    break
+
+                if not running:
+                    raise RuntimeError("Tasks cannot be scheduled: %s" % pending)
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, _, _ = running.pop(future)
+                    try:
+                        future.result()
+                        finished.add(task.name)
+                        logging.info("Finished %s" % task.name)
+                    except Exception as err:
+                        logging.error("%s failed: %s" % (task.name, err))
+                        if error is None:
+                            error = err
+
+        if error is not None:
+            raise error
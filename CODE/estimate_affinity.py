@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import sys
+import re
+import math
+import argparse
+
+
+"""
+A python port of estimate_affinity.rb, reading the fimo.txt of a regulator
+directly instead of its `sed '1d' | cut -f 1,2,7` output.
+
+For every TF - target pair with sites below the p-value cutoff, the sum, max
+and count of -log10(p-value) are written along with their ranks, numbers
+printed the way ruby prints them.
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Estimate the affinity of a TF to its targets from FIMO sites")
+    parser.add_argument('-i', '--input', dest='fn_fimo', type=str, help="fimo.txt, the first line is a header")
+    parser.add_argument('-p', '--pval', dest='pval', type=float, default=1)
+    parser.add_argument('-o', '--output', dest='fn_output', type=str, help="output file, default is stdout")
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+__float_prefix__ = re.compile(r"\s*([+-]?(?:\d+(?:\.\d+)?|\.\d+)(?:[eE][+-]?\d+)?)")
+
+
+def to_f(st):
+    """ String#to_f of ruby: the leading number of a string, 0.0 if there is none. """
+    if st is None:
+        return 0.0
+    match = __float_prefix__.match(st)
+    return float(match.group(1)) if match else 0.0
+
+
+def to_s(x):
+    """ Float#to_s of ruby for floats, str for integers. """
+    if isinstance(x, int):
+        return str(x)
+    if math.isnan(x):
+        return "NaN"
+    if math.isinf(x):
+        return "Infinity" if x > 0 else "-Infinity"
+    st = repr(x)
+    if "e" in st:
+        mantissa, exponent = st.split("e")
+        if "." not in mantissa:
+            mantissa += ".0"
+        return mantissa + "e" + exponent
+    return st
+
+
+def cut_fields(line, fields=(0, 1, 6)):
+    """ A line of `cut -f 1,2,7`, lines without tab are kept as is. """
+    line = line.rstrip("\n")
+    if "\t" not in line:
+        return line + "\n"
+    split = line.split("\t")
+    return "\t".join(split[x] for x in fields if x < len(split)) + "\n"
+
+
+def read_sites(fn_fimo, pval=1):
+    """ -log10(p-value) of the sites of every TF - target pair, in the order the pairs appear. """
+    targets = {}
+    with open(fn_fimo) as reader:
+        for i, line in enumerate(reader):
+            if i == 0:
+                continue
+            dline = cut_fields(line).split("\t")
+            key = dline[0] + "\t" + dline[1]
+            p = to_f(dline[2] if len(dline) > 2 else None)
+            if pval > p:
+                if key not in targets:
+                    targets[key] = []
+                targets[key].append(math.inf if p == 0 else -math.log10(p))
+    return targets
+
+
+def rank_array(arr):
+    a_len = len(arr)
+    rankpos_arr = sorted(range(a_len), key=arr.__getitem__)
+    rank_arr = [None] * a_len
+    for i, x in enumerate(rankpos_arr):
+        rank_arr[x] = float(i) / float(a_len - 1) if a_len > 1 else math.nan
+    return rank_arr
+
+
+def site_sum(value):
+    total = value[0]
+    for x in value[1:]:
+        total += x
+    return total
+
+
+def estimate_affinity(fn_fimo, writer, pval=1):
+    """ Writes the summary of a fimo.txt, a missing file is taken as empty
+    like the output of sed. """
+    try:
+        targets = read_sites(fn_fimo, pval)
+    except FileNotFoundError:
+        targets = {}
+
+    sums = [site_sum(x) for x in targets.values()]
+    maxs = [max(x) for x in targets.values()]
+    counts = [len(x) for x in targets.values()]
+
+    rank_site_sum = rank_array(sums)
+    rank_site_max = rank_array(maxs)
+    rank_site_count = rank_array(counts)
+
+    for index, key in enumerate(targets.keys()):
+        lineout = key + "\t" + to_s(sums[index]) + "\t" + to_s(rank_site_sum[index])
+        lineout = lineout + "\t" + to_s(maxs[index]) + "\t" + to_s(rank_site_max[index])
+        lineout = lineout + "\t" + to_s(counts[index]) + "\t" + to_s(rank_site_count[index])
+        lineout = lineout + "\t" + to_s(rank_site_sum[index] if rank_site_sum[index] > rank_site_max[index] else rank_site_max[index])
+        writer.write(lineout + "\n")
+
+
+def write_summary(task):
+    """ Pool worker, task is the path to fimo.txt and to the summary. """
+    fn_fimo, fn_summary = task
+    with open(fn_summary, "w") as writer:
+        estimate_affinity(fn_fimo, writer)
+    return fn_summary
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    if parsed.fn_output is None:
+        estimate_affinity(parsed.fn_fimo, sys.stdout, parsed.pval)
+    else:
+        with open(parsed.fn_output, "w") as writer:
+            estimate_affinity(parsed.fn_fimo, writer, parsed.pval)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
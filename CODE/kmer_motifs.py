@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import sys
+import os
+import argparse
+import logging
+
+import numpy as np
+from tqdm import tqdm
+
+from CODE import promoter_store
+
+
+"""
+Infers a k-mer motif of every regulator in process, in place of a FIRE run
+per regulator.
+
+The promoters are read from a promoter_store and counted once into a matrix
+of genes by canonical k-mers, a k-mer and its reverse complement being one
+column, of whether the k-mer is found in the promoter of the gene. The
+mutual information of every k-mer with the bins of every regulator (the
+FIRE --expfiles of bin_network_scores) comes from the counts of genes with
+the k-mer in every bin, which are a matrix product of the k-mer matrix with
+the one-hot bins of a chunk of regulators at a time.
+
+Like the discrete mode of FIRE, the k-mers of a regulator are taken by
+decreasing mutual information, and the first one that is significant and
+robust is its motif: its mutual information is above that of every one of
+--shuffles shuffles of the bins, its z-score is against those shuffles, and
+it stays above every one of --jn_shuffles shuffles in at least --jn_t of
+--jn jackknife samples, each leaving out a third of the genes. The motifs
+are written as the motifs.txt of parse_motif_summary: the regulator, the
+k-mer, the mutual information, the z-score and the robustness as passed/jn.
+Unlike FIRE, the k-mers are not extended into degenerate motifs.
+"""
+
+LETTERS = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Infer a k-mer motif of every regulator from the mutual information of k-mers and its bins, in place of FIRE.")
+    parser.add_argument('-r', '--fn_rids', dest='fn_rids', type=str, help="infer the motifs of these regulators only, in this order")
+    parser.add_argument('-b', '--dir_bins', dest='dir_bins', type=str, help="bins of the target genes of every regulator, named by the regulator")
+    parser.add_argument('-P', '--fn_promoters', dest='fn_promoters', type=str)
+    parser.add_argument('-S', '--fn_store', dest='fn_store', type=str, help="promoter store, encoded from -P if missing or encoded from another version of it")
+    parser.add_argument('-o', '--fn_motifs', dest='fn_motifs', type=str, help="summary of inferred motifs, eg: motifs.txt")
+    parser.add_argument('-k', '--kmer', dest='k', type=int, default=7, help="length of the k-mers, as FIRE --k")
+    parser.add_argument('--shuffles', dest='shuffles', type=int, default=1000, help="shuffles of the bins a motif is tested against")
+    parser.add_argument('--jn', dest='jn', type=int, default=20, help="jackknife samples, as FIRE --jn")
+    parser.add_argument('--jn_t', dest='jn_t', type=int, default=16, help="jackknife samples a motif passes at least, as FIRE --jn_t")
+    parser.add_argument('--jn_shuffles', dest='jn_shuffles', type=int, default=100, help="shuffles of the bins of every jackknife sample")
+    parser.add_argument('-c', '--candidates', dest='candidates', type=int, default=10, help="k-mers of highest mutual information tested per regulator")
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def kmer_columns(k):
+    u"""
+    column of every k-mer, shared with its reverse complement, and the k-mer of every column
+    """
+    ids = np.arange(4 ** k, dtype=np.int64)
+    reverse = np.zeros_like(ids)
+    for j in range(k):
+        reverse = (reverse << 2) | (3 - ((ids >> (2 * j)) & 3))
+    kmers, columns = np.unique(np.minimum(ids, reverse), return_inverse=True)
+    return columns, kmers
+
+
+def kmer_string(kmer, k):
+    return LETTERS[[(kmer >> (2 * (k - 1 - j))) & 3 for j in range(k)]].tobytes().decode("ascii")
+
+
+def count_kmers(store, k, columns, n_columns, block=1 << 22):
+    u"""
+    genes by k-mer columns, whether the promoter of a gene has the k-mer on either strand
+    """
+    presence = np.zeros((len(store.names), n_columns), dtype=bool)
+    for start in range(0, len(store), block):
+        stop = min(start + block, len(store))
+        codes = store.decode(start, stop + k - 1)
+        ids = np.zeros(stop - start, dtype=np.int64)
+        clean = np.ones(stop - start, dtype=bool)
+        for j in range(k):
+            window = codes[j:j + stop - start]
+            ids = (ids << 2) | (window & 3)
+            clean &= window != promoter_store.OTHER
+        starts = np.flatnonzero(clean) + start
+        seqs = np.searchsorted(store.offsets, starts, side="right") - 1
+        presence[seqs, columns[ids[clean]]] = True
+    return presence
+
+
+def read_bins(fn):
+    u"""
+    target genes and their bins, from a FIRE --expfiles
+    """
+    with open(fn) as reader:
+        # header
+        reader.readline()
+        rows = [x for x in (line.split() for line in reader) if len(x) == 2]
+    return [x[0] for x in rows], np.array([int(x[1]) for x in rows], dtype=np.int64)
+
+
+def mutual_information(n1b, nb):
+    u"""
+    mutual information in bits of the presence of a k-mer and the bins,
+    from the genes with the k-mer in every bin and the genes in every bin, along the last axis
+    """
+    n1b = np.asarray(n1b, dtype=np.float64)
+    nb = np.asarray(nb, dtype=np.float64)
+    n = nb.sum(-1, keepdims=True)
+    n0b = nb - n1b
+    n1 = n1b.sum(-1, keepdims=True)
+    n0 = n - n1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t1 = np.where(n1b > 0, n1b * np.log2(n1b * n / (n1 * nb)), 0)
+        t0 = np.where(n0b > 0, n0b * np.log2(n0b * n / (n0 * nb)), 0)
+    return (t1 + t0).sum(-1) / np.maximum(n[..., 0], 1)
+
+
+def enrichment(presence, targets, n_bins, limit=1 << 25):
+    u"""
+    mutual information of every k-mer with the bins of every regulator, regulators by k-mers
+
+    :param targets: list of (rows of presence, bins) of every regulator
+    """
+    n_genes, n_columns = presence.shape
+    mi = np.zeros((len(targets), n_columns))
+    # one-hot bins of a chunk of regulators and a chunk of k-mers stay within limit bytes
+    n_regulators = max(1, limit // (4 * n_bins * max(1, n_genes)))
+    n_kmers = max(1, limit // (4 * max(1, n_genes)))
+    for first in range(0, len(targets), n_regulators):
+        chunk = targets[first:first + n_regulators]
+        onehot = np.zeros((n_genes, len(chunk) * n_bins), dtype=np.float32)
+        nb = np.zeros((len(chunk), n_bins))
+        for i, (rows, bins) in enumerate(chunk):
+            onehot[rows, i * n_bins + bins] = 1
+            nb[i] = np.bincount(bins, minlength=n_bins)
+        for start in range(0, n_columns, n_kmers):
+            stop = min(start + n_kmers, n_columns)
+            counts = presence[:, start:stop].T.astype(np.float32) @ onehot
+            counts = np.rint(counts).reshape(stop - start, len(chunk), n_bins).transpose(1, 0, 2)
+            mi[first:first + len(chunk), start:stop] = mutual_information(counts, nb[:, None, :])
+    return mi
+
+
+def shuffled_mi(x, bins, n_bins, shuffles, rng, batch=100):
+    u"""
+    mutual information of the presence x with shuffles of the bins
+    """
+    nb = np.bincount(bins, minlength=n_bins)
+    values = []
+    for start in range(0, shuffles, batch):
+        size = min(batch, shuffles - start)
+        permuted = np.argsort(rng.random((size, len(bins))), axis=1)
+        index = bins[permuted] + n_bins * np.arange(size)[:, None]
+        n1b = np.bincount(index.ravel(), weights=np.tile(x, size), minlength=size * n_bins).reshape(size, n_bins)
+        values.append(mutual_information(n1b, nb))
+    return np.concatenate(values) if values else np.zeros(0)
+
+
+def robustness(x, bins, n_bins, parsed, rng):
+    u"""
+    jackknife samples, each leaving out a third of the genes, whose mutual information is above every shuffle
+    """
+    size = len(bins) - len(bins) // 3
+    passed = 0
+    for _ in range(parsed.jn):
+        keep = rng.choice(len(bins), size=size, replace=False)
+        value = mutual_information(np.bincount(bins[keep], weights=x[keep], minlength=n_bins), np.bincount(bins[keep], minlength=n_bins))
+        if value > shuffled_mi(x[keep], bins[keep], n_bins, parsed.jn_shuffles, rng).max(initial=-np.inf):
+            passed += 1
+    return passed
+
+
+def select_motif(regulator, mi, presence, rows, bins, n_bins, kmers, parsed, rng):
+    u"""
+    the motif of a regulator as (regulator, k-mer, mi, z-score, robustness), None if no k-mer passes
+    """
+    order = np.argsort(-mi, kind="stable")[:parsed.candidates]
+    for column in order.tolist():
+        if not mi[column] > 0:
+            break
+        x = presence[rows, column].astype(np.float64)
+        shuffled = shuffled_mi(x, bins, n_bins, parsed.shuffles, rng)
+        if not mi[column] > shuffled.max(initial=-np.inf):
+            continue
+        passed = robustness(x, bins, n_bins, parsed, rng)
+        if passed < parsed.jn_t:
+            continue
+        std = shuffled.std()
+        zscore = (mi[column] - shuffled.mean()) / std if std > 0 else 0.0
+        return regulator, kmer_string(int(kmers[column]), parsed.k), "%.6f" % mi[column], "%.3f" % zscore, "%d/%d" % (passed, parsed.jn)
+    return None
+
+
+def infer_motifs(store, fns, parsed):
+    u"""
+    the motif of every regulator, None for regulators without any
+
+    :param fns: dict of regulator -> its bins
+    """
+    columns, kmers = kmer_columns(parsed.k)
+    logging.info("Counting %d-mers of %d promoters ... " % (parsed.k, len(store.names)))
+    presence = count_kmers(store, parsed.k, columns, len(kmers))
+
+    # targets without a promoter are left out
+    targets = []
+    for regulator, fn in fns.items():
+        genes, bins = read_bins(fn)
+        rows = np.array([store.index.get(x, -1) for x in genes], dtype=np.int64)
+        targets.append((rows[rows >= 0], bins[rows >= 0]))
+    n_bins = max([int(x[1].max()) + 1 for x in targets if len(x[1]) > 0], default=1)
+
+    logging.info("Mutual information of %d k-mers with the bins of %d regulators ... " % (len(kmers), len(fns)))
+    mi = enrichment(presence, targets, n_bins)
+
+    motifs = {}
+    for i, regulator in enumerate(tqdm(list(fns.keys()))):
+        rows, bins = targets[i]
+        rng = np.random.default_rng([parsed.seed, i])
+        motifs[regulator] = select_motif(regulator, mi[i], presence, rows, bins, n_bins, kmers, parsed, rng)
+    return motifs
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    if parsed.fn_rids is not None:
+        regulators = np.loadtxt(parsed.fn_rids, dtype=str, ndmin=1).tolist()
+    else:
+        regulators = sorted(x for x in os.listdir(parsed.dir_bins) if os.path.isfile(os.path.join(parsed.dir_bins, x)))
+    fns = {}
+    for regulator in regulators:
+        fn = os.path.join(parsed.dir_bins, regulator)
+        if os.path.isfile(fn):
+            fns.setdefault(regulator, fn)
+
+    if parsed.fn_store is not None:
+        store = promoter_store.build_store(parsed.fn_promoters, parsed.fn_store)
+    else:
+        store = promoter_store.from_fasta(parsed.fn_promoters)
+    motifs = infer_motifs(store, fns, parsed)
+
+    with open(parsed.fn_motifs, "w") as writer:
+        for regulator in fns.keys():
+            if motifs[regulator] is not None:
+                writer.write("%s\t%s\t%s\t%s\t%s\n" % motifs[regulator])
+    return motifs
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+u"""
+Created at 2020.01.16
+
+A ledger of the work done by the pipeline.
+
+Every step and every per-regulator task records a fingerprint of its inputs
+and parameters when it is finished; a rerun skips the work whose fingerprint
+is unchanged. The ledger is a journal of JSON lines appended with O_APPEND,
+so it could be written by the threads of the pipeline and by the processes of
+a pool at the same time, and the work recorded before a crash is kept.
+
+Only the parent process compacts the journal, by an explicit compact before
+any step starts. Appends hold a shared flock and compaction an exclusive
+one on a lock file next to the journal, so a compaction never drops the
+lines another process appends meanwhile.
+"""
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+
+from threading import Lock
+
+
+def fingerprint(*parts):
+    u"""
+    hash of json serializable parts, eg: content hashes of inputs and parameters
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class Ledger(object):
+    u"""
+    fingerprints of finished work, and a memo of file content hashes
+    """
+
+    def __init__(self, path: str):
+        u"""
+        :param path: path to journal file
+        """
+        self.path = path
+        self.__lock__ = Lock()
+        self.entries = {}
+        self.files = {}
+        self.__load__()
+
+    def __load__(self):
+        u"""
+        read the journal, returns its number of lines
+        """
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path) as r:
+                for line in r:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut by a crash
+                        continue
+                    lines += 1
+                    if "file" in entry:
+                        self.files[entry["file"]] = (entry["size"], entry["mtime"], entry["sha1"])
+                    else:
+                        self.entries[entry["key"]] = entry["fingerprint"]
+        return lines
+
+    def __flock__(self, operation):
+        u"""
+        descriptor of the lock file of the journal, locked with operation
+        """
+        fd = os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def __append__(self, entry):
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        lock = self.__flock__(fcntl.LOCK_SH)
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        finally:
+            os.close(lock)
+
+    def compact(self):
+        u"""
+        rewrite the journal with the latest entries only, if it has grown past twice their number;
+        called by the parent process before any step starts, never by the workers
+
+        :return: whether the journal is rewritten
+        """
+        if not os.path.exists(self.path):
+            return False
+        with self.__lock__:
+            lock = self.__flock__(fcntl.LOCK_EX)
+            try:
+                # along with the lines appended by other processes since it was loaded
+                lines = self.__load__()
+                if lines <= 2 * (len(self.entries) + len(self.files)) + 64:
+                    return False
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w") as w:
+                        for path, (size, mtime, sha1) in self.files.items():
+                            w.write(json.dumps({"file": path, "size": size, "mtime": mtime, "sha1": sha1}) + "\n")
+                        for key, value in self.entries.items():
+                            w.write(json.dumps({"key": key, "fingerprint": value}) + "\n")
+                    os.chmod(tmp, 0o644)
+                    os.replace(tmp, self.path)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+                return True
+            finally:
+                os.close(lock)
+
+    def get(self, key: str):
+        u"""
+        recorded fingerprint of key, None if it was never recorded
+        """
+        return self.entries.get(key)
+
+    def record(self, key: str, value: str):
+        u"""
+        record the fingerprint of finished work
+        """
+        with self.__lock__:
+            self.entries[key] = value
+            self.__append__({"key": key, "fingerprint": value})
+
+    def hash_file(self, path: str):
+        u"""
+        sha1 of the content of a file, memorized by its size and modification time
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        memo = self.files.get(path)
+        if memo is not None and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            return memo[2]
+
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as r:
+            for block in iter(lambda: r.read(1 << 20), b""):
+                sha1.update(block)
+        sha1 = sha1.hexdigest()
+
+        with self.__lock__:
+            self.files[path] = (stat.st_size, stat.st_mtime_ns, sha1)
+            self.__append__({"file": path, "size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": sha1})
+        return sha1
+
+    def hash_path(self, path: str):
+        u"""
+        content hash of a file, or of all files under a directory along with their relative paths;
+        None if the path does not exist
+        """
+        if os.path.isfile(path):
+            return self.hash_file(path)
+        if not os.path.isdir(path):
+            return None
+
+        hashes = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                fn = os.path.join(root, name)
+                hashes.append([os.path.relpath(fn, path), self.hash_file(fn)])
+        return fingerprint(hashes)
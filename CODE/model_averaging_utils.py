@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import sys
+import logging
 import numpy as nmp
 import operator
 from functools import reduce
@@ -10,6 +10,24 @@ An importable file to provide utilities for model averaging in netprophet.
 """
 
 
+def _resort_by_scores(working_net, avail, scores):
+    """ Replaces the rows of working_net selected by avail with their own
+    values, sorted so that the largest value goes to the cell with the
+    largest score. Ties keep the row-major order of the cells (the sort
+    is stable), as the former list-of-tuples implementation did. The
+    temporaries are a few flat arrays of the selected cells. """
+    # scores are negated in-place so an ascending stable sort gives the
+    # descending order with ties in row-major order
+    nmp.negative(scores, out=scores)
+    order = nmp.argsort(scores, axis=None, kind='stable')
+    del scores
+    values = working_net[avail]
+    orig_values = nmp.sort(values, axis=None)[::-1]
+    values.reshape(-1)[order] = orig_values
+    working_net[avail] = values
+    return working_net
+
+
 def resort_by_weights(M, W):
     """ For all edges in M that have a corresponding edge in W,
     resort those edges in-place by their new score, M_ij*W_ij. 
@@ -17,50 +35,20 @@ def resort_by_weights(M, W):
     # select only rows for which we weights to use
     W_avail = nmp.sum(W, 1) > 0
     working_net = nmp.abs(nmp.copy(M))
-    # get the original values of the matrix where we have 
-    orig_values = nmp.sort(nmp.ravel(nmp.copy(working_net)[W_avail]))[::-1]
-    #working_net[W_avail] = (working_net[W_avail]+.001)*(W[W_avail]+.001)
-    working_net[W_avail] = (working_net[W_avail])*(W[W_avail])
-    index_to_value = []
-    for j in range(nmp.shape(working_net)[0]):
-        if not W_avail[j]:
-            continue
-        for i in range(nmp.shape(working_net)[1]):
-            index_to_value.append([(j,i), working_net[j,i]])
-    index_to_value.sort(key=lambda x: -x[1])
-    for n,item in enumerate(index_to_value):
-        j = item[0][0]; i = item[0][1]
-        working_net[j, i] = orig_values[n]
-        # working_net[j, i] = orig_values[n]*orig_signs[n]
-    # working_net[W_avail] = working_net[W_avail]*orig_signs
-    return working_net
+    # scores are cast to the type of working_net, as if stored in it
+    scores = working_net[W_avail]
+    nmp.multiply(scores, W[W_avail], out=scores, casting='unsafe')
+    return _resort_by_scores(working_net, W_avail, scores)
 
 
 def resort_by_pwm(network, pwm_net):
-    """ """
+    """ Same as resort_by_weights, the new score of an edge is
+    (|network_ij|+.001)*(pwm_net_ij+.001)."""
     pwm_avail = nmp.sum(pwm_net, 1) > 0
     working_net = nmp.abs(nmp.copy(network))
-    # get list of values from before pwms are used, map indices to values
-    # orig_values = nmp.ravel(nmp.copy(working_net)[pwm_avail])
-    # orig_signed = nmp.ravel(nmp.copy(network)[pwm_avail])
-    # orig_signs[orig_signs!=0] = orig_signs[orig_signs!=0]/(nmp.abs(orig_signs[orig_signs!=0]))
-    # orig_values = sorted(zip(list(orig_values), list(orig_signed)), key=lambda x:-x[0])
-    # orig_signs = nmp.ravel(orig_signs)
-    orig_values = nmp.sort(nmp.ravel(nmp.copy(working_net)[pwm_avail]))[::-1]
-    working_net[pwm_avail] = (working_net[pwm_avail]+.001)*(pwm_net[pwm_avail]+.001)
-    index_to_value = []
-    for j in range(nmp.shape(working_net)[0]):
-        if not pwm_avail[j]:
-            continue
-        for i in range(nmp.shape(working_net)[1]):
-            index_to_value.append([(j,i), working_net[j,i]])
-    index_to_value.sort(key=lambda x: -x[1])
-    for n,item in enumerate(index_to_value):
-        j = item[0][0]; i = item[0][1]
-        working_net[j, i] = orig_values[n]
-        # working_net[j, i] = orig_values[n]*orig_signs[n]
-    # working_net[pwm_avail] = working_net[pwm_avail]*orig_signs
-    return working_net
+    scores = (working_net[pwm_avail]+.001)*(pwm_net[pwm_avail]+.001)
+    scores = nmp.array(scores, dtype=working_net.dtype)
+    return _resort_by_scores(working_net, pwm_avail, scores)
 
 
 def list_geometric(ls):
@@ -87,6 +75,57 @@ def rescale_shift_matrix(mtr):
     return rescale_matrix(mtr_cp)
 
 
+def row_blocks(n_rows, n_cols, block_rows=None):
+    ''' Yields slices over the rows of a matrix, each block holding about
+    2**20 cells unless block_rows is given. '''
+    if block_rows is None:
+        block_rows = max(1, (1 << 20) // max(1, n_cols))
+    for start in range(0, n_rows, block_rows):
+        yield slice(start, min(start + block_rows, n_rows))
+
+
+def _shift_block(block, least_neg, least_pos):
+    ''' Applies the shift of rescale_shift_matrix to a block of rows. '''
+    block = nmp.copy(block)
+    block[block<0]-=least_neg
+    block[block>0]-=least_pos
+    return block
+
+
+def _shift_stats(mtr, blocks):
+    ''' Computes the shifts and scale of rescale_shift_matrix block by
+    block, so the shifted copy of the whole matrix is never held. '''
+    negs = [nmp.max(mtr[b][mtr[b]<0]) for b in blocks if nmp.any(mtr[b]<0)]
+    least_neg = nmp.max(negs) if negs else 0
+    poss = []
+    for b in blocks:
+        shifted = _shift_block(mtr[b], least_neg, 0)
+        if nmp.any(shifted>0):
+            poss.append(nmp.min(shifted[shifted>0]))
+    least_pos = nmp.min(poss) if poss else 0
+    scale = nmp.max([nmp.max(nmp.abs(_shift_block(mtr[b], least_neg, least_pos)))
+                     for b in blocks])
+    return least_neg, least_pos, scale
+
+
+def quadrant_combine_array(lasso_scores, de_scores, constants):
+    ''' Whole-array version of quadrant_combine, giving the same value
+    for every cell. Each quadrant constant is applied as a scalar, so
+    the arithmetic promotes exactly as in quadrant_combine. '''
+    base = (nmp.abs(lasso_scores) + constants["Cb"]) * \
+        (nmp.abs(de_scores) + constants["Cd"])
+    combined = nmp.zeros(nmp.shape(base), dtype=nmp.result_type(base, nmp.float64))
+    for key, mask in (
+            ("quadrant I", (lasso_scores > 0) & (de_scores > 0)),
+            ("quadrant II", (lasso_scores < 0) & (de_scores > 0)),
+            ("quadrant III", (lasso_scores < 0) & (de_scores < 0)),
+            ("quadrant IV", (lasso_scores > 0) & (de_scores < 0)),
+            ("B", (lasso_scores != 0) & (de_scores == 0)),
+            ("D", (lasso_scores == 0) & (de_scores != 0))):
+        combined[mask] = base[mask] * constants[key]
+    return combined
+
+
 def quadrant_combine(lasso_score, de_score, constants):
     ''' Returns a score for an edge based on its lasso score, de score, 
     and constants. '''
@@ -146,8 +185,13 @@ def model_average_pwm_arithmetic_intersect(np_component, binding_strengths):
 
 
 def model_average_np(lasso_component, de_component, 
-                     constants = None):
-    ''' Performs model averaging as in netprophet. '''
+                     constants = None, block_rows = None):
+    ''' Performs model averaging as in netprophet.
+
+    The components are rescaled and combined a block of rows at a time
+    (see row_blocks), so float32 inputs stay float32 and the temporaries
+    never exceed a block. The result is the same as calling
+    quadrant_combine on every cell. '''
     # modified at 2020.01.06
     if constants is None:
         constants = {
@@ -157,16 +201,20 @@ def model_average_np(lasso_component, de_component,
             "Cb": 0.1, "Cd": 0.01
         }
 
-    betas = rescale_matrix(lasso_component)
-    de = rescale_shift_matrix(de_component)
+    lasso_component = nmp.asarray(lasso_component)
+    de_component = nmp.asarray(de_component)
+    blocks = list(row_blocks(*nmp.shape(lasso_component), block_rows=block_rows))
+
+    # scales of rescale_matrix and rescale_shift_matrix
+    lasso_max = nmp.max([nmp.max(nmp.abs(lasso_component[b])) for b in blocks])
+    least_neg, least_pos, de_max = _shift_stats(de_component, blocks)
+
     retval = nmp.zeros(nmp.shape(lasso_component))
-    for j, row in enumerate(lasso_component):
-        if j%20 == 0:
-            sys.stderr.write('working on row %i\n'%(j))
-        for i, ix in enumerate(row):
-            retval[j, i] = quadrant_combine(betas[j,i], 
-                                            de[j,i],
-                                            constants) 
+    for b in blocks:
+        logging.debug('working on row %i' % b.start)
+        betas = lasso_component[b]/lasso_max
+        de = _shift_block(de_component[b], least_neg, least_pos)/de_max
+        retval[b] = quadrant_combine_array(betas, de, constants)
     return retval
 
 
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import argparse
+import logging
+
+from multiprocessing import Pool
+from shutil import rmtree
+from subprocess import CalledProcessError, TimeoutExpired
+
+import numpy as np
+from tqdm import tqdm
+
+from CODE import build_motif_network
+from CODE import convert_fire2meme
+from CODE import estimate_affinity
+from CODE import ledger
+from CODE import network_io
+from CODE import parse_motif_summary
+from CODE import resource_report
+from CODE import scan_motifs
+from CODE import kmer_motifs
+from CODE import resource_bundle
+
+
+"""
+Infers, scores and maps the motif of every regulator as one pipeline.
+
+A regulator goes on to FIMO and its affinity summary as soon as its own FIRE
+run is finished, instead of waiting for the FIRE runs of all regulators, and
+its row of the motif network is filled in when it comes back. Regulators
+without any FIRE motif stop after FIRE. With a ledger, the FIRE, FIMO and
+affinity tasks of a regulator are skipped when their outputs exist and the
+content of their inputs is unchanged, so an interrupted run resumes.
+
+Regulators are started longest first, so a slow FIRE run does not stretch
+the tail of the run. The cost of a regulator is the time of its last FIRE
+run kept in the ledger, or else its number of binned targets out of the
+zero bin, scaled by the time per target of the regulators timed before.
+FIRE and FIMO runs are killed after --timeout seconds and tried again up
+to --retries times; a regulator whose runs still fail is reported and left
+out of the motif network, the other regulators go on.
+
+The outputs are those of parse_motif_summary, convert_fire2meme, the FIMO
+scoring of step 9 and build_motif_network. With --scanner builtin, the
+motifs are scored by scan_motifs on the promoters encoded once by the main
+process, instead of by a fimo run per regulator; with -S they are encoded
+into a promoter_store file the workers map instead of receiving a copy.
+With --inference kmer, the motifs of all regulators are inferred up front
+by kmer_motifs from the same encoded promoters, instead of by a FIRE run
+per regulator, and written to the same motifs.txt. With --scanner none,
+the pipeline stops at the motifs of the regulators, their scoring and the
+motif network are left to steps 9 and 10, eg: to score all motifs with a
+few batched fimo runs of batch_fimo.
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Infer, score and map the motif of every regulator as soon as its FIRE run is finished.")
+    parser.add_argument('-r', '--fn_rids', dest='fn_rids', type=str)
+    parser.add_argument('-g', '--fn_gids', dest='fn_gids', type=str)
+    parser.add_argument('-P', '--fn_promoters', dest='fn_promoters', type=str)
+    parser.add_argument('-b', '--dir_bins', dest='dir_bins', type=str, help="FIRE --expfiles of the regulators")
+    parser.add_argument('-m', '--dir_pfm', dest='dir_pfm', type=str)
+    parser.add_argument('-f', '--dir_fimo', dest='dir_fimo', type=str)
+    parser.add_argument('-l', '--fn_motifs', dest='fn_motifs', type=str, help="summary of inferred motifs, eg: motifs.txt")
+    parser.add_argument('-o', '--fn_adjmtr', dest='fn_adjmtr', type=str)
+    parser.add_argument('-t', '--thld_type', dest='thld_type', type=str)
+    parser.add_argument('-v', '--thld_val', dest='thld_val', type=float, default=0)
+    parser.add_argument('--fire', dest='fire', type=str, help="path to fire.pl")
+    parser.add_argument('--fimo', dest='fimo', type=str, help="path to fimo")
+    parser.add_argument('--inference', dest='inference', type=str, default="fire", choices=["fire", "kmer"],
+                        help="infer the motifs with a FIRE run per regulator, or with kmer_motifs for all regulators at once")
+    parser.add_argument('--scanner', dest='scanner', type=str, default="fimo", choices=["fimo", "builtin", "none"],
+                        help="score the motifs with fimo, with the built-in scanner of scan_motifs on promoters encoded once, "
+                             "or not at all, leaving the scoring and the network to steps 9 and 10")
+    parser.add_argument('-S', '--fn_store', dest='fn_store', type=str,
+                        help="promoter store of promoter_store the builtin scanner workers share, encoded from -P if missing or encoded from another version of it")
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1)
+    parser.add_argument('-B', '--dir_bundle', dest='dir_bundle', type=str, help="binary bundle of the resources written by prepare_resources")
+    parser.add_argument('-L', '--fn_ledger', dest='fn_ledger', type=str, help="ledger to skip the FIRE, FIMO and affinity tasks whose inputs are unchanged, and of the FIRE run times")
+    parser.add_argument('--timeout', dest='timeout', type=float, help="seconds a FIRE or FIMO run is killed after, default is no limit")
+    parser.add_argument('--retries', dest='retries', type=int, default=1, help="times a failed or killed FIRE or FIMO run is tried again")
+    parser.add_argument('-F', '--fn_failed', dest='fn_failed', type=str, help="regulators whose FIRE or FIMO runs failed, along with the errors")
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def call(cmd, name=None, timeout=None):
+    with open(os.devnull, "w+") as w:
+        resource_report.check_call(cmd, name=name, timeout=timeout, shell=True, stdout=w, stderr=w)
+
+
+def call_retry(cmd, name, timeout=None, retries=0):
+    """ Runs cmd until it succeeds, at most retries + 1 times; raises the
+    error of the last run. """
+    for attempt in range(retries + 1):
+        try:
+            call(cmd, name, timeout)
+            return
+        except (CalledProcessError, TimeoutExpired) as err:
+            if attempt == retries:
+                raise
+            logging.warning("%s: %s, trying again" % (name, err))
+
+
+def count_targets(fn_bins):
+    """ Targets of a FIRE --expfiles out of its last bin, the bin of zero scores. """
+    with open(fn_bins) as reader:
+        # header
+        reader.readline()
+        bins = [int(x[1]) for x in (line.split() for line in reader) if len(x) == 2]
+    return sum(x < max(bins) for x in bins) if bins else 0
+
+
+def fire_seconds_key(regulator):
+    return "SECONDS/FIRE/" + regulator
+
+
+def estimate_costs(regulators, dir_bins, journal=None):
+    """ Expected FIRE run time of every regulator, in seconds when there are
+    earlier run times, otherwise in targets. """
+    targets = {}
+    for regulator in regulators:
+        fn_bins = os.path.join(dir_bins, regulator)
+        targets[regulator] = count_targets(fn_bins) if os.path.exists(fn_bins) else 0
+
+    history = {}
+    if journal is not None:
+        for regulator in regulators:
+            seconds = journal.get(fire_seconds_key(regulator))
+            if seconds is not None:
+                history[regulator] = seconds
+
+    rates = [history[x] / targets[x] for x in history if targets[x] > 0]
+    rate = float(np.median(rates)) if rates else 1.0
+    return {x: history[x] if x in history else targets[x] * rate for x in regulators}
+
+
+__worker__ = {}
+
+
+def init_worker(parsed, gene_index, promoters, encoded=None, inferred=None):
+    __worker__["parsed"] = parsed
+    __worker__["ledger"] = ledger.Ledger(parsed.fn_ledger) if parsed.fn_ledger is not None else None
+    __worker__["promoters"] = promoters
+    __worker__["encoded"] = encoded
+    __worker__["inferred"] = inferred
+    build_motif_network.init_worker(gene_index, parsed.dir_fimo, ".summary")
+
+
+def task_fingerprint(params, *paths):
+    """ Fingerprint of the parameters and the content of the input files of
+    a task, None without a ledger. """
+    journal = __worker__["ledger"]
+    if journal is None:
+        return None
+    return ledger.fingerprint(params, [journal.hash_path(x) for x in paths])
+
+
+def is_done(key, value, output):
+    journal = __worker__["ledger"]
+    return journal is not None and journal.get(key) == value and os.path.exists(output)
+
+
+def record(key, value):
+    if __worker__["ledger"] is not None:
+        __worker__["ledger"].record(key, value)
+
+
+def passes_threshold(summary, thld_type, thld_val):
+    """ The motif filter of build_motif_network.build_network. """
+    if thld_type is None:
+        return True
+    _, _, _, zscore, robust = "\t".join(summary).strip().split('\t')
+    zscore = float(zscore)
+    robust = float(robust.split("/")[0])
+    score = zscore if thld_type == 'zscore' else robust
+    return score >= thld_val
+
+
+def run_fire(regulator):
+    """ FIRE run of a regulator, skipped when the ledger has it.
+
+    Returns its summary, None when FIRE did not find any motif or failed,
+    and the error of its failed run. """
+    parsed = __worker__["parsed"]
+
+    expfile = os.path.join(parsed.dir_bins, regulator)
+    cmd = "perl {fire} --expfiles={expfile} --exptype=discrete --fastafile_dna={promoters} --k=7 --jn=20 --jn_t=16 --nodups=1 --dorna=0 --dodnarna=0".format(**{
+        "fire": parsed.fire,
+        "expfile": expfile,
+        "promoters": parsed.fn_promoters
+    })
+    value = task_fingerprint([cmd, __worker__["promoters"]], expfile)
+    if not is_done("FIRE/" + regulator, value, expfile + "_FIRE"):
+        start = time.time()
+        try:
+            call_retry(cmd, "FIRE/" + regulator, parsed.timeout, parsed.retries)
+        except (CalledProcessError, TimeoutExpired) as err:
+            return None, "FIRE: %s" % err
+        record(fire_seconds_key(regulator), round(time.time() - start, 3))
+        record("FIRE/" + regulator, value)
+
+    return parse_motif_summary.parse_fire_summary(expfile + "_FIRE", regulator), None
+
+
+def run_regulator(regulator):
+    """ FIRE, FIMO, affinity summary and the motif network row of a regulator.
+
+    Returns the regulator, its motif summary, its row and the error of its
+    failed run; the summary and the row are None when no motif is found or
+    FIRE failed, the row is also None when the motif did not pass. """
+    parsed = __worker__["parsed"]
+    if parsed.inference == "kmer":
+        summary = __worker__["inferred"].get(regulator)
+    else:
+        summary, error = run_fire(regulator)
+        if error is not None:
+            return regulator, None, None, error
+    if summary is None:
+        return regulator, None, None, None
+
+    fn_pfm = os.path.join(parsed.dir_pfm, regulator)
+    convert_fire2meme.write_meme(fn_pfm, summary[1])
+    if parsed.scanner == "none":
+        return regulator, summary, None, None
+
+    out_fimo = os.path.join(parsed.dir_fimo, regulator)
+    cmd = "{fimo} -o {output} --thresh 5e-3 {motif} {promoters}".format(**{
+        "fimo": parsed.fimo if parsed.scanner == "fimo" else "scan_motifs",
+        "output": out_fimo,
+        "motif": fn_pfm,
+        "promoters": parsed.fn_promoters
+    })
+    value = task_fingerprint([cmd, __worker__["promoters"]], fn_pfm)
+    error = None
+    if not is_done("FIMO/" + regulator, value, os.path.join(out_fimo, "fimo.txt")):
+        if os.path.exists(out_fimo):
+            rmtree(out_fimo)
+        os.makedirs(out_fimo)
+        try:
+            if parsed.scanner == "builtin":
+                scan_motifs.scan_regulators(__worker__["encoded"], {regulator: fn_pfm}, parsed.dir_fimo, 5e-3)
+            else:
+                call_retry(cmd, "FIMO/" + regulator, parsed.timeout, parsed.retries)
+            record("FIMO/" + regulator, value)
+        except (CalledProcessError, TimeoutExpired) as err:
+            # scored as a motif without any site, as before
+            error = "FIMO: %s" % err
+
+    fn_fimo = os.path.join(out_fimo, "fimo.txt")
+    value = task_fingerprint([], fn_fimo)
+    if not is_done("AFFINITY/" + regulator, value, out_fimo + ".summary"):
+        estimate_affinity.write_summary((fn_fimo, out_fimo + ".summary"))
+        record("AFFINITY/" + regulator, value)
+
+    if not passes_threshold(summary, parsed.thld_type, parsed.thld_val):
+        return regulator, summary, None, error
+    return regulator, summary, build_motif_network.build_row(([regulator], parsed.thld_type is None)), error
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    if parsed.thld_type is not None and parsed.thld_type not in ["zscore", "robust"]:
+        sys.exit("No confidence threshold to filter motifs.\n")
+    if not parsed.dir_fimo.endswith("/"):
+        parsed.dir_fimo += "/"
+    for fd in (parsed.dir_pfm, parsed.dir_fimo):
+        if not os.path.exists(fd):
+            os.makedirs(fd)
+
+    rids = resource_bundle.read_ids(parsed.fn_rids, parsed.dir_bundle, ndmin=1)
+    gids = resource_bundle.read_ids(parsed.fn_gids, parsed.dir_bundle, ndmin=1)
+    rindex = {}
+    for i, rid in enumerate(rids.tolist()):
+        rindex.setdefault(rid, i)
+
+    adjmtr = np.zeros([len(rids), len(gids)])
+    summaries = {}
+    # hash the promoters once instead of in every task
+    promoters = None
+    if parsed.fn_ledger is not None:
+        promoters = ledger.Ledger(parsed.fn_ledger).hash_file(parsed.fn_promoters)
+
+    # longest first
+    costs = estimate_costs(list(rindex.keys()), parsed.dir_bins, ledger.Ledger(parsed.fn_ledger) if parsed.fn_ledger is not None else None)
+    regulators = sorted(rindex.keys(), key=lambda x: -costs[x])
+
+    failed = {}
+    # encoded once, the workers share it; a store file is mapped by every worker instead of copied to it
+    encoded = None
+    if parsed.scanner == "builtin" or parsed.inference == "kmer":
+        encoded = scan_motifs.read_promoters(parsed.fn_promoters, parsed.fn_store)
+
+    # the k-mer motifs of all regulators at once, in place of their FIRE runs
+    inferred = None
+    if parsed.inference == "kmer":
+        fns = {x: os.path.join(parsed.dir_bins, x) for x in regulators if os.path.isfile(os.path.join(parsed.dir_bins, x))}
+        inferred = kmer_motifs.infer_motifs(encoded, fns, kmer_motifs.parse_args([]))
+    initargs = (parsed, build_motif_network.index_genes(gids), promoters, encoded, inferred)
+    with Pool(parsed.processes, initializer=init_worker, initargs=initargs) as p:
+        for regulator, summary, row, error in tqdm(p.imap_unordered(run_regulator, regulators), total=len(regulators)):
+            if error is not None:
+                logging.warning("%s %s" % (regulator, error))
+                failed[regulator] = error
+            if summary is None:
+                if error is None:
+                    logging.info("No motif of %s is found by FIRE" % regulator)
+                continue
+            summaries[regulator] = summary
+            if row is not None:
+                adjmtr[rindex[regulator], :] = row
+
+    # motifs in the order of regulators
+    with open(parsed.fn_motifs, "w") as writer:
+        for regulator in rindex.keys():
+            if regulator in summaries:
+                writer.write("%s\t%s\t%s\t%s\t%s\n" % summaries[regulator])
+
+    if failed:
+        logging.warning("FIRE or FIMO failed for %d of %d regulators: %s" % (len(failed), len(rindex), ", ".join(x for x in rindex if x in failed)))
+    if parsed.fn_failed is not None:
+        with open(parsed.fn_failed, "w") as writer:
+            for regulator in rindex.keys():
+                if regulator in failed:
+                    writer.write("%s\t%s\n" % (regulator, failed[regulator]))
+
+    if parsed.scanner == "none":
+        return
+
+    logging.info("Writing network ... ")
+    if parsed.fn_adjmtr.endswith(network_io.BINARY_SUFFIX):
+        network_io.save_network(parsed.fn_adjmtr, adjmtr, rids, gids)
+    else:
+        build_motif_network.write_adjmtr(adjmtr, parsed.fn_adjmtr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
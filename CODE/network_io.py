@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import os
+import json
+import struct
+import itertools
+
+import numpy as np
+
+from collections import deque
+from multiprocessing import Pool
+
+
+"""
+An importable file to read and write the networks of the pipeline.
+
+Text: cells are formatted a block of rows at a time with a single
+%-formatting call per row, instead of one writer.write call per cell. The
+zero token and the float format are parameters, so every module keeps its
+own output byte-for-byte.
+
+Binary: a file ending with BINARY_SUFFIX holds a magic string, the length
+of a JSON header (dtype, shape, regulator and gene IDs), the header padded
+to 64 bytes, then the matrix in C order. It is loaded as a memory map.
+"""
+
+BINARY_SUFFIX = ".npnet"
+BINARY_MAGIC = b"NPNET001"
+
+
+def _escape(token):
+    return token.replace("%", "%%")
+
+
+def _row_template(is_zero, cell, zero):
+    """ Format string of a row, zero cells are written as the zero token
+    and do not consume any value. """
+    if not is_zero.any():
+        return cell * len(is_zero)
+    tokens = np.array([cell, zero], dtype=object)
+    return "".join(tokens[is_zero.view(np.int8)].tolist())
+
+
+def format_rows(block, fmt="%0.10f", zero="0"):
+    """ Formats a block of rows of an adjacency matrix, every cell is
+    followed by a tab and every row by a newline. """
+    cell = fmt + "\t"
+    zero = _escape(zero) + "\t"
+    lines = []
+    for row in np.asarray(block):
+        is_zero = row == 0
+        values = row[~is_zero].tolist() if is_zero.any() else row.tolist()
+        lines.append(_row_template(is_zero, cell, zero) % tuple(values))
+        lines.append("\n")
+    return "".join(lines)
+
+
+def format_named_column(names, values, fmt="%0.17f", zero="0"):
+    """ Formats a row of scores as "name\\tvalue\\n" lines, zero values are
+    written as the zero token. """
+    values = np.asarray(values)
+    is_zero = values == 0
+    names = [_escape(str(x)) + "\t" for x in names]
+    tokens = np.array([fmt + "\n", _escape(zero) + "\n"], dtype=object)
+    cells = tokens[is_zero.view(np.int8)].tolist()
+    template = "".join(itertools.chain.from_iterable(zip(names, cells)))
+    return template % tuple(values[~is_zero].tolist())
+
+
+def block_slices(n_rows, n_cols, block_rows=None):
+    """ Yields slices over the rows, each block holding about 2**18 cells
+    unless block_rows is given. """
+    if block_rows is None:
+        block_rows = max(1, (1 << 18) // max(1, n_cols))
+    for start in range(0, n_rows, block_rows):
+        yield slice(start, min(start + block_rows, n_rows))
+
+
+def write_adjmtr(fn, adjmtr, fmt="%0.10f", zero="0", block_rows=None, processes=1):
+    """ Writes an adjacency matrix as tab-separated text, in the layout
+    every module of the pipeline uses: each cell followed by a tab, zero
+    cells written as zero.
+
+    Formatting holds the GIL, so with processes > 1 the blocks are
+    formatted by a process pool while the finished blocks are written in
+    order; at most 2 blocks per process are in flight. """
+    adjmtr = np.asarray(adjmtr)
+    blocks = (adjmtr[x] for x in block_slices(*adjmtr.shape, block_rows=block_rows))
+    with open(fn, "w") as writer:
+        if processes > 1:
+            with Pool(processes) as p:
+                pending = deque()
+                for block in blocks:
+                    pending.append(p.apply_async(format_rows, (block, fmt, zero)))
+                    if len(pending) >= 2 * processes:
+                        writer.write(pending.popleft().get())
+                while pending:
+                    writer.write(pending.popleft().get())
+        else:
+            for block in blocks:
+                writer.write(format_rows(block, fmt, zero))
+
+
+def is_binary(fn):
+    """ Whether a file is a network in the binary format. """
+    with open(fn, "rb") as reader:
+        return reader.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def save_network(fn, adjmtr, rids=None, gids=None):
+    """ Writes a network in the binary format, along with its regulator
+    and gene IDs if given. The file is written next to fn and renamed, so
+    a partially written network is never left at fn. """
+    adjmtr = np.asarray(adjmtr)
+    if adjmtr.ndim != 2:
+        raise ValueError("adjacency matrix must be 2-dimensional, got shape %s" % (adjmtr.shape,))
+    if rids is not None and len(rids) != adjmtr.shape[0]:
+        raise ValueError("%d regulators for %d rows" % (len(rids), adjmtr.shape[0]))
+    if gids is not None and len(gids) != adjmtr.shape[1]:
+        raise ValueError("%d genes for %d columns" % (len(gids), adjmtr.shape[1]))
+
+    header = json.dumps({
+        "dtype": adjmtr.dtype.str,
+        "shape": list(adjmtr.shape),
+        "rids": None if rids is None else [str(x) for x in rids],
+        "gids": None if gids is None else [str(x) for x in gids],
+    }).encode("utf-8")
+    offset = len(BINARY_MAGIC) + 8 + len(header)
+    padding = b" " * (-offset % 64)
+
+    tmp = fn + ".tmp"
+    with open(tmp, "wb") as writer:
+        writer.write(BINARY_MAGIC)
+        writer.write(struct.pack("<Q", len(header) + len(padding)))
+        writer.write(header + padding)
+        for x in block_slices(*adjmtr.shape):
+            writer.write(np.ascontiguousarray(adjmtr[x]).tobytes())
+    os.replace(tmp, fn)
+
+
+def load_network(fn, mmap=True):
+    """ Reads a network in the binary format.
+
+    Returns the matrix (a copy-on-write memory map unless mmap is False),
+    the regulator IDs and the gene IDs; IDs that were not stored are None. """
+    with open(fn, "rb") as reader:
+        if reader.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("%s is not a binary network" % fn)
+        size = struct.unpack("<Q", reader.read(8))[0]
+        header = json.loads(reader.read(size).decode("utf-8"))
+    offset = len(BINARY_MAGIC) + 8 + size
+    dtype = np.dtype(header["dtype"])
+    shape = tuple(header["shape"])
+
+    if mmap and shape[0] * shape[1] > 0:
+        adjmtr = np.memmap(fn, dtype=dtype, mode="c", offset=offset, shape=shape)
+    else:
+        adjmtr = np.fromfile(fn, dtype=dtype, offset=offset).reshape(shape)
+
+    rids = None if header["rids"] is None else np.array(header["rids"], dtype=str)
+    gids = None if header["gids"] is None else np.array(header["gids"], dtype=str)
+    return adjmtr, rids, gids
+
+
+def read_network(fn):
+    """ Reads a network in either format, returns the matrix, regulator
+    IDs and gene IDs; text networks do not carry IDs. """
+    if is_binary(fn):
+        return load_network(fn)
+    return np.loadtxt(fn), None, None
+
+
+def load_adjmtr(fn):
+    """ Reads the matrix of a network in either format. """
+    return read_network(fn)[0]
+
+
+def write_network(fn, adjmtr, rids=None, gids=None, fmt="%0.10f", zero="0", processes=1):
+    """ Writes a network in the binary format if fn ends with BINARY_SUFFIX,
+    otherwise as text with the given format. """
+    if fn.endswith(BINARY_SUFFIX):
+        save_network(fn, adjmtr, rids, gids)
+    else:
+        write_adjmtr(fn, adjmtr, fmt=fmt, zero=zero, processes=processes)
+
+
+def export_text(fn_binary, fn_text, fmt="%0.10f", zero="0", processes=1):
+    """ Writes a binary network out as text. """
+    write_adjmtr(fn_text, load_network(fn_binary)[0], fmt=fmt, zero=zero, processes=processes)
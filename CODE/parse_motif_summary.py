@@ -21,6 +21,18 @@ def errprint(st):
     logging.ERROR(st + "\n")
 
 
+def parse_fire_summary(fn, tf):
+    """ The top motif of a FIRE output directory as (tf, motif, mi, z_score,
+    robustness), None if FIRE did not find any motif. """
+    fsum = fn + "/DNA/" + tf + ".summary"
+    if os.path.isfile(fsum) and os.path.getsize(fsum) > 0:
+        with open(fsum, "r") as r:
+            line = r.readline()
+        line = line.split('\t')
+        return tf, line[0], line[3], line[5], line[6]
+    return None
+
+
 def main(argv):
     parsed = parse_args(argv)
 
@@ -33,20 +45,15 @@ def main(argv):
     # parse the lists of tfs and inferred motifs
     fns = glob.glob(parsed.dir_input + "*_FIRE")
     for fn in fns:
-        tf = os.path.basename(fn).strip('_FIRE')
-        # parse FIRE summary file  
-        fsum = fn + "/DNA/" + tf + ".summary"
+        tf = os.path.basename(fn)[:-len('_FIRE')]
+        # parse FIRE summary file
+        summary = parse_fire_summary(fn, tf)
 
-        if os.path.isfile(fsum) and os.path.getsize(fsum) > 0:
-            lines = open(fsum, "r").readlines()
-            motif = lines[0].split('\t')[0]
+        if summary is not None:
             if parsed.append_mi_zscore_robustness:
-                mi = lines[0].split('\t')[3]
-                z_score = lines[0].split('\t')[5]
-                robustness = lines[0].split('\t')[6]
-                writer.write("%s\t%s\t%s\t%s\t%s\n" % (tf, motif, mi, z_score, robustness))
+                writer.write("%s\t%s\t%s\t%s\t%s\n" % summary)
             else:
-                writer.write("%s\t%s\n" % (tf, motif))
+                writer.write("%s\t%s\n" % summary[:2])
     writer.close()
 
 
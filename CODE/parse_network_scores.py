@@ -6,6 +6,8 @@ import argparse
 import numpy
 import logging
 
+from CODE import network_io
+
 
 def parse_args(argv):
     ''' A method for taking in command line arguments and specifying
@@ -28,7 +30,7 @@ def main(argv):
     parsed.dir_output = check_dir(parsed.dir_output)
 
     # load adjmtr, regulator and target lists
-    adjmtr = numpy.loadtxt(parsed.adjmtr)
+    adjmtr = network_io.load_adjmtr(parsed.adjmtr)
     tfs = numpy.loadtxt(parsed.regulator, dtype=str, delimiter="\t")
     targets = numpy.loadtxt(parsed.target, dtype=str, delimiter="\t")
 
@@ -36,11 +38,7 @@ def main(argv):
     for i in range(adjmtr.shape[0]):
         writer = open(parsed.dir_output + tfs[i], "w")
         writer.write("#target\tscore\n")
-        for j in range(adjmtr.shape[1]):
-            if adjmtr[i, j] == 0:
-                writer.write("%s\t0\n" % targets[j])
-            else:
-                writer.write("%s\t%0.17f\n" % (targets[j], adjmtr[i, j]))
+        writer.write(network_io.format_named_column(targets, adjmtr[i], fmt="%0.17f", zero="0"))
         writer.close()
 
 
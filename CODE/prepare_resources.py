@@ -3,6 +3,12 @@ import os
 import argparse
 import numpy as np
 
+from collections import deque
+from multiprocessing import Pool
+
+from CODE import network_io
+from CODE import resource_bundle
+
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description="")
@@ -16,46 +22,85 @@ def parse_args(argv):
     parser.add_argument('-oa', '--output_allowed', dest='output_allowed')
     parser.add_argument('-op1', '--output_pert_binary', dest='output_pert_binary')
     parser.add_argument('-op2', '--output_pert_boolean', dest='output_pert_boolean')
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1)
+    parser.add_argument('-ob', '--output_bundle', dest='output_bundle', help="directory of the binary bundle of the parsed resources")
     # parser.add_argument('-ol', '--output_regulator_lists', dest='output_regulator_lists')
     parsed = parser.parse_args(argv)
     return parsed
 
 
 def write_adjmtr(fn, adjmtr):
-    writer = open(fn, "w")
-    for i in range(len(adjmtr)):
-        for j in range(len(adjmtr[i])):
-            if adjmtr[i,j] == 0:
-                writer.write("0\t")
-            else:
-                writer.write("%0.10f\t" % adjmtr[i,j])
-        writer.write("\n")
-    writer.close()
-
-
-def write_tsv(fn, adjmtr, conds, genes):
-    writer = open(fn, "w")
-    for i in range(len(genes)):
-        writer.write("%s\t" % genes[i])
-    writer.write("\n")
-    for i in range(len(adjmtr)):
-        writer.write("%s\t" % conds[i])
-        for j in range(len(adjmtr[i])):
-            writer.write("%s\t" % adjmtr[i,j])
-        writer.write("\n")
-    writer.close()
+    network_io.write_adjmtr(fn, adjmtr, fmt="%0.10f", zero="0")
+
+
+def write_tsv(fn, adjmtr, conds, genes, block_rows=None, processes=1):
+    """ Genes in the header, then every row after its condition; cells are
+    formatted by %s, ie: str of the values.
+
+    adjmtr is formatted a block of rows at a time, by a process pool if
+    processes > 1, and the finished blocks are written in order. """
+    blocks = ((adjmtr[x], conds[x]) for x in network_io.block_slices(len(conds), len(genes), block_rows))
+    with open(fn, "w") as writer:
+        writer.write("".join("%s\t" % x for x in genes) + "\n")
+        if processes > 1:
+            with Pool(processes) as p:
+                pending = deque()
+                for block in blocks:
+                    pending.append(p.apply_async(format_tsv_rows, block))
+                    if len(pending) >= 2 * processes:
+                        writer.write(pending.popleft().get())
+                while pending:
+                    writer.write(pending.popleft().get())
+        else:
+            for block in blocks:
+                writer.write(format_tsv_rows(*block))
+
+
+def format_tsv_rows(rows, conds):
+    """ str of every cell, the same as %s of numpy scalars. """
+    end = "\t\n" if np.shape(rows)[1] > 0 else "\n"
+    lines = []
+    for cond, row in zip(conds, rows):
+        lines.append("%s\t" % cond + "\t".join(map(str, row.tolist())) + end)
+    return "".join(lines)
+
+
+class LazyRows(object):
+    """ Rows of a function of the columns of a matrix, computed a block at a time. """
+
+    def __init__(self, data, func):
+        self.data = data
+        self.func = func
+
+    def __getitem__(self, x):
+        return self.func(self.data[:, x]).T
 
 
 def make_nonrepeat_conditions(conditions):
+    """ Repeated conditions are numbered by their order, eg: c_1, c_2; the
+    repeated names are numbered in sorted order, and a name made by an
+    earlier numbering that repeats a later name is numbered along with it. """
     conditions = np.array(conditions, dtype='|S500')
-    non_unique_conds = [x for n, x in enumerate(conditions) if x in conditions[:n]]
-    for x in np.unique(np.array(non_unique_conds)):
-        indx = np.where(conditions == x)[0]
+    positions = {}
+    for i, x in enumerate(conditions.tolist()):
+        positions.setdefault(x, []).append(i)
+
+    for x in sorted(x for x, indx in positions.items() if len(indx) > 1):
+        indx = sorted(positions.pop(x))
         for i in range(len(indx)):
-            conditions[indx[i]] = "{}_{}".format(conditions[indx[i]].decode("utf-8"), str(i+1))
+            conditions[indx[i]] = "{}_{}".format(x.decode("utf-8"), str(i+1))
+            positions.setdefault(conditions[indx[i]], []).append(indx[i])
     return conditions
 
 
+def index_first(names):
+    """ Index of the first occurrence of every name. """
+    index = {}
+    for i, x in enumerate(names.tolist()):
+        index.setdefault(x, i)
+    return index
+
+
 def main(argv):
     parsed = parse_args(argv)
     # make directories
@@ -71,36 +116,50 @@ def main(argv):
     conditions = np.loadtxt(parsed.conditions, dtype=str)
 
     # prepare expression matrix of regulators (regulators x conditions)
-    reg_indx = []
-    for i in range(len(regulators)):
-        reg_indx.append(np.where(genes == regulators[i])[0][0])
+    gene_index = index_first(genes)
+    missing = [x for x in regulators.tolist() if x not in gene_index]
+    if missing:
+        raise ValueError("Regulators are not in the genes: %s" % ", ".join(missing))
+    reg_indx = np.array([gene_index[x] for x in regulators.tolist()], dtype=int)
     data = np.loadtxt(parsed.expr_data)
     np.savetxt(parsed.output_reg_expr, data[reg_indx,:], fmt="%.10f", delimiter="\t")
 
-    # prepare fold change of expression data (conditions x genes)
+    # prepare fold change of expression data (conditions x genes), a block of conditions at a time
     # data_fc = np.loadtxt(parsed.fc_data, dtype=str)
-    data_fc = 2**data
     nonrepeat_conditions = make_nonrepeat_conditions(conditions)
-    write_tsv(parsed.output_data_fc, data_fc.T, nonrepeat_conditions, genes)
+    write_tsv(parsed.output_data_fc, LazyRows(data, lambda x: 2**x), nonrepeat_conditions, genes, processes=parsed.processes)
 
     # prepare allowed matrix (regulators x genes)
     allowed = np.ones((len(regulators),len(genes)), dtype=int)
-    for i in range(len(reg_indx)):
-        allowed[i,reg_indx[i]] = 0
+    allowed[np.arange(len(reg_indx)), reg_indx] = 0
     np.savetxt(parsed.output_allowed, allowed, fmt="%d", delimiter="\t")
 
     # prepare binary pert matrix (genes x conditions)
     # and boolean pert matrix (conditions x genes)
+    regulator_set = set(regulators.tolist())
+    perturbed = [(gene_index[x], j) for j, x in enumerate(conditions.tolist()) if x in regulator_set and x in gene_index]
     pert = np.zeros((len(genes),len(conditions)), dtype=int)
-    pert_bool = np.array([['FALSE']*len(conditions)]*len(genes), dtype=str)
-    for j in range(len(conditions)):
-        if conditions[j] in regulators:
-            i = np.where(genes == conditions[j])[0]
-            if len(i) > 0:
-                pert[i[0],j] = 1
-                pert_bool[i[0],j] = 'TRUE'
+    if perturbed:
+        rows, cols = zip(*perturbed)
+        pert[list(rows), list(cols)] = 1
     np.savetxt(parsed.output_pert_binary, pert, fmt="%d", delimiter="\t")
-    write_tsv(parsed.output_pert_boolean, pert_bool.T, nonrepeat_conditions, genes)
+    pert_bool = np.array(["FALSE", "TRUE"], dtype=object)
+    write_tsv(parsed.output_pert_boolean, LazyRows(pert, lambda x: pert_bool[x]), nonrepeat_conditions, genes, processes=parsed.processes)
+
+    # binary bundle of the parsed resources for the following steps
+    if parsed.output_bundle is not None:
+        resource_bundle.write_bundle(parsed.output_bundle, {
+            "genes": genes,
+            "regulators": regulators,
+            "conditions": conditions,
+            "expr": data,
+            "regulator_rows": reg_indx
+        }, sources={
+            "genes": parsed.genes,
+            "regulators": parsed.regulators,
+            "conditions": parsed.conditions,
+            "expr": parsed.expr_data
+        })
 
     # split regulators into sublists with 10 in each
     # step = 5
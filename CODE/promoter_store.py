@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import struct
+import argparse
+import logging
+
+import numpy as np
+
+
+"""
+The promoter sequences encoded once, in 2 bits per base, for the in-process
+code that reads them: the motif scanner of scan_motifs and the pool workers
+of motif_pipeline.
+
+The sequences are laid out one after another, every one followed by a
+separator, so a position is the same in every reader. A base takes 2 bits
+(A, C, G, T), and a bit of the N-mask is set at every other letter and at
+every separator; those decode to OTHER. The names and the lengths of the
+sequences are the gene index, the start of every sequence is derived from
+them.
+
+A file ending with STORE_SUFFIX holds a magic string, the length of a JSON
+header (names, lengths, number of positions, and the path, size and
+modification time of the FASTA file it is encoded from), the header padded
+to 64 bytes, the packed bases padded to 64 bytes, then the N-mask. It is loaded
+as a read-only memory map, so the processes on a node share the pages of
+one copy, and a loaded store is pickled as its path: pool workers given a
+store open the same file instead of receiving a copy.
+"""
+
+STORE_SUFFIX = ".npseq"
+STORE_MAGIC = b"NPSEQ001"
+
+BASES = "ACGT"
+# code of any other letter, and of the separators of sequences
+OTHER = 4
+
+# positions decoded at a time when counting windows
+BLOCK = 1 << 24
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Encode the promoter sequences into a 2-bit store shared by the motif scoring workers.")
+    parser.add_argument('-P', '--fn_promoters', dest='fn_promoters', type=str, help="promoter sequences, FASTA")
+    parser.add_argument('-o', '--fn_store', dest='fn_store', type=str, help="the store, default is the FASTA file name with %s appended" % STORE_SUFFIX)
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def read_fasta(fn):
+    names, sequences, chunks = [], [], None
+    with open(fn) as reader:
+        for line in reader:
+            line = line.strip()
+            if line.startswith(">"):
+                if chunks is not None:
+                    sequences.append("".join(chunks))
+                names.append(line[1:].split()[0] if len(line) > 1 else "")
+                chunks = []
+            elif chunks is not None:
+                chunks.append(line)
+    if chunks is not None:
+        sequences.append("".join(chunks))
+    return names, sequences
+
+
+def encode(sequences):
+    """ Packed bases and N-mask of the sequences, every one followed by a
+    separator. """
+    lookup = np.full(256, OTHER, dtype=np.uint8)
+    for i, base in enumerate(BASES):
+        lookup[ord(base)] = i
+        lookup[ord(base.lower())] = i
+
+    text = "\0".join(sequences) + "\0" if sequences else ""
+    codes = lookup[np.frombuffer(text.encode("ascii", "replace"), dtype=np.uint8)]
+    bases = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    bases[:len(codes)] = codes & 3
+    bases = bases.reshape(-1, 4)
+    packed = (bases[:, 0] << 6) | (bases[:, 1] << 4) | (bases[:, 2] << 2) | bases[:, 3]
+    mask = np.packbits(codes == OTHER)
+    return packed, mask
+
+
+class PromoterStore(object):
+    u"""
+    Sequences as 2-bit bases and an N-mask, and the start of every sequence
+    """
+
+    def __init__(self, names, lengths, packed, mask, fn=None):
+        self.names = np.asarray(names, dtype=str)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths + 1)[:-1]]).astype(np.int64)
+        self.index = {}
+        for i, name in enumerate(self.names.tolist()):
+            self.index.setdefault(name, i)
+        self.size = int(np.sum(self.lengths + 1))
+        self.packed = packed
+        self.mask = mask
+        self.fn = fn
+        self.__windows__ = {}
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        # a store loaded from a file travels as its path
+        if self.fn is not None:
+            return {"fn": self.fn}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if "fn" in state and len(state) == 1:
+            state = load_store(state["fn"]).__dict__
+        self.__dict__.update(state)
+
+    def masked(self, positions):
+        u"""
+        whether the bases at positions are other than ACGT
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        return ((self.mask[positions >> 3] >> (7 - (positions & 7))) & 1).astype(bool)
+
+    def masked_range(self, start, stop):
+        first = start >> 3
+        return np.unpackbits(self.mask[first:(stop + 7) >> 3])[start - 8 * first:stop - 8 * first].astype(bool)
+
+    def take(self, positions):
+        u"""
+        base codes at positions, of any shape
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        codes = ((self.packed[positions >> 2] >> (6 - 2 * (positions & 3))) & 3).astype(np.uint8)
+        codes[self.masked(positions)] = OTHER
+        return codes
+
+    def decode(self, start, stop):
+        u"""
+        base codes from start to stop, OTHER past the end
+        """
+        codes = np.full(stop - start, OTHER, dtype=np.uint8)
+        end = min(stop, self.size)
+        if end > start:
+            first = start >> 2
+            block = self.packed[first:(end + 3) >> 2]
+            bases = np.empty((len(block), 4), dtype=np.uint8)
+            for i in range(4):
+                bases[:, i] = (block >> (6 - 2 * i)) & 3
+            bases = bases.ravel()[start - 4 * first:end - 4 * first]
+            bases[self.masked_range(start, end)] = OTHER
+            codes[:end - start] = bases
+        return codes
+
+    def sequence(self, name):
+        u"""
+        the sequence of a gene, with N at every letter other than ACGT
+        """
+        i = self.index[name]
+        codes = self.decode(self.offsets[i], self.offsets[i] + self.lengths[i])
+        return np.frombuffer(b"ACGTN", dtype=np.uint8)[codes].tobytes().decode("ascii")
+
+    def clean(self, starts, width):
+        u"""
+        whether the windows of width at starts are made of ACGT only, width is one or one per start
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        widths = np.broadcast_to(np.asarray(width, dtype=np.int64), starts.shape)
+        ok = starts + widths <= self.size
+        for k in range(int(widths.max()) if len(starts) > 0 else 0):
+            check = ok & (k < widths)
+            ok[check] = ~self.masked(starts[check] + k)
+        return ok
+
+    def windows(self, width):
+        u"""
+        number of windows of width within the sequences, made of ACGT only
+        """
+        if width not in self.__windows__:
+            count = 0
+            n_starts = max(0, self.size - width + 1)
+            for start in range(0, n_starts, BLOCK):
+                stop = min(start + BLOCK, n_starts)
+                others = np.concatenate([[0], np.cumsum(self.masked_range(start, stop + width - 1))])
+                count += int(np.count_nonzero(others[width:width + stop - start] == others[:stop - start]))
+            self.__windows__[width] = count
+        return self.__windows__[width]
+
+
+def from_fasta(fn):
+    u"""
+    a store in memory, pickled along with its arrays
+    """
+    names, sequences = read_fasta(fn)
+    return PromoterStore(names, [len(x) for x in sequences], *encode(sequences))
+
+
+def source_stat(fn):
+    stat = os.stat(fn)
+    return [os.path.abspath(fn), stat.st_size, stat.st_mtime_ns]
+
+
+def save_store(fn, store, source=None):
+    """ Writes a store, next to fn and renamed, so a partially written store
+    is never left at fn. source is the FASTA file it is encoded from. """
+    header = json.dumps({
+        "size": store.size,
+        "names": store.names.tolist(),
+        "lengths": store.lengths.tolist(),
+        "source": None if source is None else source_stat(source),
+    }).encode("utf-8")
+    offset = len(STORE_MAGIC) + 8 + len(header)
+    padding = b" " * (-offset % 64)
+    packed = np.ascontiguousarray(store.packed).tobytes()
+
+    # by process, several steps may build the same store at once
+    tmp = "%s.%d.tmp" % (fn, os.getpid())
+    with open(tmp, "wb") as writer:
+        writer.write(STORE_MAGIC)
+        writer.write(struct.pack("<Q", len(header) + len(padding)))
+        writer.write(header + padding)
+        writer.write(packed)
+        writer.write(b"\0" * (-len(packed) % 64))
+        writer.write(np.ascontiguousarray(store.mask).tobytes())
+    os.replace(tmp, fn)
+
+
+def read_header(fn):
+    """ The JSON header of a store and its size in bytes. """
+    with open(fn, "rb") as reader:
+        if reader.read(len(STORE_MAGIC)) != STORE_MAGIC:
+            raise ValueError("%s is not a promoter store" % fn)
+        size = struct.unpack("<Q", reader.read(8))[0]
+        return json.loads(reader.read(size).decode("utf-8")), size
+
+
+def load_store(fn, mmap=True):
+    """ Reads a store, as read-only memory maps unless mmap is False. """
+    header, size = read_header(fn)
+    offset = len(STORE_MAGIC) + 8 + size
+    n_packed = -(-header["size"] // 4)
+    n_mask = -(-header["size"] // 8)
+    mask_offset = offset + n_packed + (-n_packed % 64)
+
+    if mmap and header["size"] > 0:
+        packed = np.memmap(fn, dtype=np.uint8, mode="r", offset=offset, shape=(n_packed,))
+        mask = np.memmap(fn, dtype=np.uint8, mode="r", offset=mask_offset, shape=(n_mask,))
+    else:
+        packed = np.fromfile(fn, dtype=np.uint8, count=n_packed, offset=offset)
+        mask = np.fromfile(fn, dtype=np.uint8, count=n_mask, offset=mask_offset)
+    return PromoterStore(header["names"], header["lengths"], packed, mask, fn if mmap else None)
+
+
+def is_current(fn_store, fn_fasta):
+    """ Whether a store exists and is encoded from the FASTA file as it is
+    now: the same path, size and modification time. """
+    if not os.path.exists(fn_store):
+        return False
+    try:
+        header, _ = read_header(fn_store)
+    except (OSError, ValueError):
+        return False
+    return header.get("source") == source_stat(fn_fasta)
+
+
+def build_store(fn_fasta, fn_store=None):
+    """ The store of a FASTA file, encoded only if it is missing or was
+    encoded from another FASTA file or an earlier version of it. """
+    if fn_store is None:
+        fn_store = fn_fasta + STORE_SUFFIX
+    if not is_current(fn_store, fn_fasta):
+        logging.info("Encoding %s ... " % fn_fasta)
+        save_store(fn_store, from_fasta(fn_fasta), fn_fasta)
+    return load_store(fn_store)
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    store = build_store(parsed.fn_promoters, parsed.fn_store)
+    logging.info("%d sequences, %d positions in %s" % (len(store.names), store.size, store.fn))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
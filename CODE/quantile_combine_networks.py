@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import sys
+import math
+import argparse
+import logging
+
+import numpy as np
+
+from CODE import network_io
+
+
+"""
+A numpy port of quantile_combine_networks.r, combining any number of
+networks with the quantile combine method (ref: Hien's Thesis).
+
+The absolute scores of every network are ranked, ties averaged, and mapped to
+the scores of the same rank in a representative network, the first one by
+default; the mapped scores are signed as the raw scores and averaged over
+the networks, NA cells left out. When the networks have the same number of
+non-NA cells, a rank falls on a sorted score or halfway between two, as in
+the R script. Otherwise ranks are scaled to [0, 1] and mapped to the
+quantiles of the representative scores, the branch the R script meant to run
+but cannot (portionMatrix is never defined).
+
+A text output is written the way write.table of R writes numbers: at most 15
+significant digits, the fixed notation unless the scientific one is shorter,
+and NA for NaN.
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Combine networks with the quantile combine method.")
+    parser.add_argument('-i', '--input', dest='fn_inputs', type=str, nargs='+', help="networks to combine, text or binary")
+    parser.add_argument('-o', '--output', dest='fn_output', type=str, help="combined network, binary if it ends with %s" % network_io.BINARY_SUFFIX)
+    parser.add_argument('-r', '--representative', dest='representative', type=int, default=0, help="index of the network whose scores the ranks are mapped to")
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def read_table(fn):
+    """ A network as read.table reads it, NA cells are NaN. """
+    try:
+        return network_io.load_adjmtr(fn)
+    except ValueError:
+        return np.loadtxt(fn, ndmin=2, converters=lambda x: math.nan if x == "NA" else float(x))
+
+
+def tied_positions(values):
+    """ For every value, the sum of the first and the last 0-based position
+    of its ties in the sorted values; the average rank of R is half of it
+    plus one. """
+    order = np.argsort(values, kind="stable")
+    ordered = values[order]
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = ordered[1:] != ordered[:-1]
+    starts = np.flatnonzero(first)
+    ends = np.append(starts[1:], len(values)) - 1
+    group = np.cumsum(first) - 1
+    positions = np.empty(len(values), dtype=np.int64)
+    positions[order] = starts[group] + ends[group]
+    return positions
+
+
+def quantile_type7(ordered, probs):
+    """ quantile(x, probs) of R, the default type 7, over sorted values. """
+    index = 1 + max(len(ordered) - 1, 0) * probs
+    lo = np.floor(index).astype(np.int64)
+    hi = np.ceil(index).astype(np.int64)
+    qs = ordered[lo - 1]
+    upper = ordered[hi - 1]
+    interpolate = (index > lo) & (upper != qs)
+    h = (index - lo)[interpolate]
+    qs[interpolate] = (1 - h) * qs[interpolate] + h * upper[interpolate]
+    return qs
+
+
+def convert_scores(scores, ordered, equal_counts):
+    """ Maps the absolute values of the non-NA scores of a network to the
+    sorted absolute scores of the representative network. """
+    positions = tied_positions(np.abs(scores))
+    if equal_counts:
+        # the rank * 2 - 1 row of the sorted scores interleaved with halfway values
+        return (ordered[positions // 2] + ordered[(positions + 1) // 2]) / 2
+    ranks = positions / 2 + 1
+    top = ranks.max() if len(ranks) > 0 else 1
+    portions = (ranks - 1) / (top - 1) if top > 1 else np.zeros(len(ranks))
+    return quantile_type7(ordered, portions)
+
+
+def quantile_combine(networks, representative=0):
+    """ Returns the networks combined by the scores of the representative
+    network, in the shape of the first one. """
+    shape = np.shape(networks[0])
+    raws = [np.asarray(x, dtype=float).ravel() for x in networks]
+    if any(len(x) != len(raws[0]) for x in raws):
+        raise ValueError("Cannot combine networks of different sizes")
+
+    masks = [~np.isnan(x) for x in raws]
+    counts = set(int(np.count_nonzero(x)) for x in masks)
+    ordered = np.sort(np.abs(raws[representative][masks[representative]]))
+
+    # rowMeans of R sums and divides in long double
+    total = np.zeros(len(raws[0]), dtype=np.longdouble)
+    count = np.zeros(len(raws[0]), dtype=np.int64)
+    for raw, mask in zip(raws, masks):
+        converted = convert_scores(raw[mask], ordered, len(counts) == 1)
+        total[mask] += converted * np.sign(raw[mask])
+        count += mask
+    with np.errstate(divide="ignore", invalid="ignore"):
+        combined = (total / count).astype(float)
+    return combined.reshape(shape)
+
+
+R_DIGITS = 15
+KP_MAX = 27
+__powers__ = np.array([10 ** x for x in range(KP_MAX + 1)], dtype=np.longdouble)
+
+
+def scientific(r):
+    """ scientific() of R's format.c for positive finite values: the
+    exponent, the significant digits and whether rounding to R_DIGITS
+    digits widens the value, e.g. 99.9999999999999999 to 100. """
+    kp = np.array([math.floor(math.log10(x)) for x in r.tolist()], dtype=np.int64) - R_DIGITS + 1
+
+    r_prec = r.astype(np.longdouble)
+    small = np.abs(kp) < 10
+    r_prec[small & (kp > 0)] /= __powers__[kp[small & (kp > 0)]]
+    r_prec[small & (kp < 0)] *= __powers__[-kp[small & (kp < 0)]]
+    tiny = ~small & (kp <= -307)
+    r_prec[tiny] = (r[tiny] * 1e303).astype(np.longdouble) / np.power(np.longdouble(10), (kp[tiny] + 303).astype(np.longdouble))
+    large = ~small & ~tiny
+    r_prec[large] /= np.power(np.longdouble(10), kp[large].astype(np.longdouble))
+
+    short = r_prec < __powers__[R_DIGITS - 1]
+    r_prec[short] *= 10
+    kp[short] -= 1
+    alpha = np.rint(r_prec).astype(float).astype(np.int64)
+
+    nsig = np.full(len(r), R_DIGITS, dtype=np.int64)
+    for _ in range(R_DIGITS):
+        trailing = (alpha % 10 == 0) & (nsig > 0)
+        if not trailing.any():
+            break
+        nsig[trailing] -= 1
+        alpha[trailing] //= 10
+    kp[nsig == 0] += 1
+    nsig[nsig == 0] = 1
+    kpower = kp + R_DIGITS - 1
+
+    rgt = np.clip(R_DIGITS - kpower, 0, KP_MAX)
+    fuzz = 0.5 / __powers__[rgt].astype(float)
+    widens = (kpower > 0) & (kpower <= KP_MAX)
+    widens[widens] = r[widens] < __powers__[kpower[widens]] - fuzz[widens]
+    return kpower, nsig, widens
+
+
+def format_r(values):
+    """ Cells formatted one by one as write.table of R formats them. """
+    values = np.asarray(values, dtype=float).ravel()
+    finite = np.isfinite(values) & (values != 0)
+    r = np.abs(values[finite])
+    neg = (values[finite] < 0).astype(np.int64)
+
+    kpower, nsig, widens = scientific(r)
+    left = kpower + 1 - widens
+    sleft = neg + np.where(left <= 0, 1, left)
+    rgt = np.maximum(nsig - left, 0)
+    width_f = sleft + rgt + (rgt != 0)
+    e = np.where((left > 100) | (left <= -99), 2, 1)
+    d = nsig - 1
+    width_e = neg + (d > 0) + d + 4 + e
+
+    # format codes: the digits of fixed notation, or 1000 + the digits of scientific notation
+    codes = np.where(width_f <= width_e, rgt, 1000 + d)
+    unique, inverse = np.unique(codes, return_inverse=True)
+    specs = np.array(["%%.%de" % (x - 1000) if x >= 1000 else "%%.%df" % x for x in unique.tolist()], dtype=object)
+
+    tokens = np.full(len(values), "NA", dtype=object)
+    tokens[values == 0] = "0"
+    tokens[np.isposinf(values)] = "Inf"
+    tokens[np.isneginf(values)] = "-Inf"
+    tokens[finite] = specs[inverse.ravel()]
+    return tokens
+
+
+def write_table(fn, adjmtr):
+    """ write.table(adjmtr, fn, row.names=FALSE, col.names=FALSE, quote=FALSE) """
+    adjmtr = np.asarray(adjmtr, dtype=float)
+    tokens = format_r(adjmtr).reshape(adjmtr.shape)
+    with open(fn, "w") as writer:
+        for row, cells in zip(adjmtr, tokens):
+            keep = np.isfinite(row) & (row != 0)
+            writer.write((" ".join(cells.tolist()) + "\n") % tuple(row[keep].tolist()))
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    logging.info("Loading network ... ")
+    networks = [read_table(x) for x in parsed.fn_inputs]
+    combined = quantile_combine(networks, parsed.representative)
+
+    logging.info("Writing network ... ")
+    if parsed.fn_output.endswith(network_io.BINARY_SUFFIX):
+        rids, gids = None, None
+        if network_io.is_binary(parsed.fn_inputs[0]):
+            _, rids, gids = network_io.load_network(parsed.fn_inputs[0])
+        network_io.save_network(parsed.fn_output, combined, rids, gids)
+    else:
+        write_table(parsed.fn_output, combined)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
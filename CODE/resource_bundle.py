@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import os
+import json
+import logging
+
+import numpy as np
+
+
+"""
+An importable bundle of the input resources parsed by step 2.
+
+The gene, regulator and condition IDs, the expression matrix and the row of
+every regulator in it are kept as .npy files in one directory, loaded as
+memory maps instead of parsed again by every step. The genes are also kept
+in sorted order, so names are mapped to their indices with a binary search.
+
+The manifest lists the text file every array is parsed from, along with its
+size and modification time; read_ids returns an array of the bundle only if
+its text file is unchanged, and parses the text file otherwise, so a stale
+bundle is never used.
+"""
+
+MANIFEST = "manifest.json"
+
+# bundles loaded by this process
+__bundles__ = {}
+
+
+def _stat(fn):
+    stat = os.stat(fn)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _save(dir_bundle, name, array):
+    tmp = os.path.join(dir_bundle, name + ".tmp.npy")
+    np.save(tmp, np.ascontiguousarray(array))
+    os.replace(tmp, os.path.join(dir_bundle, name + ".npy"))
+
+
+def write_bundle(dir_bundle, arrays, sources=None):
+    """ Saves arrays, a dict of name -> array, and the manifest, written last
+    so that a bundle cut by a crash has no manifest and is never read.
+
+    sources is a dict of name -> the text file the array is parsed from. """
+    if not os.path.exists(dir_bundle):
+        os.makedirs(dir_bundle)
+    manifest = os.path.join(dir_bundle, MANIFEST)
+    __bundles__.pop(os.path.abspath(dir_bundle), None)
+    if os.path.exists(manifest):
+        os.remove(manifest)
+
+    arrays = dict(arrays)
+    if "genes" in arrays:
+        arrays["genes_order"] = np.argsort(arrays["genes"], kind="stable")
+    for name, array in arrays.items():
+        _save(dir_bundle, name, array)
+
+    content = {
+        "arrays": {x: list(np.shape(y)) for x, y in arrays.items()},
+        "sources": {os.path.abspath(y): [x] + _stat(y) for x, y in (sources or {}).items()},
+    }
+    with open(manifest + ".tmp", "w") as writer:
+        json.dump(content, writer, indent=4)
+    os.replace(manifest + ".tmp", manifest)
+
+
+class Bundle(object):
+    """ Arrays of a bundle, loaded on first access. """
+
+    def __init__(self, dir_bundle, mmap=True):
+        with open(os.path.join(dir_bundle, MANIFEST)) as reader:
+            self.manifest = json.load(reader)
+        self.dir_bundle = dir_bundle
+        self.mmap = mmap
+        self.__arrays__ = {}
+
+    def __getitem__(self, name):
+        if name not in self.__arrays__:
+            if name not in self.manifest["arrays"]:
+                raise KeyError("%s is not in the bundle %s" % (name, self.dir_bundle))
+            self.__arrays__[name] = np.load(os.path.join(self.dir_bundle, name + ".npy"), mmap_mode="r" if self.mmap else None)
+        return self.__arrays__[name]
+
+    def source(self, fn):
+        """ Name of the array parsed from the text file fn, None if fn is not
+        a source of the bundle or is changed since. """
+        entry = self.manifest["sources"].get(os.path.abspath(fn))
+        if entry is None or not os.path.exists(fn) or entry[1:] != _stat(fn):
+            return None
+        return entry[0]
+
+    def gene_index(self, names):
+        """ Index of the first gene of every name, -1 if there is none. """
+        genes, order = self["genes"], self["genes_order"]
+        names = np.asarray(names, dtype=str)
+        if len(genes) == 0:
+            return np.full(names.shape, -1)
+        ordered = genes[order]
+        pos = np.minimum(np.searchsorted(ordered, names), len(genes) - 1)
+        return np.where(ordered[pos] == names, order[pos], -1)
+
+
+def load_bundle(dir_bundle):
+    """ The bundle in dir_bundle, None if there is no finished bundle. """
+    if dir_bundle is None or not os.path.exists(os.path.join(dir_bundle, MANIFEST)):
+        return None
+    key = os.path.abspath(dir_bundle)
+    if key not in __bundles__:
+        __bundles__[key] = Bundle(dir_bundle)
+    return __bundles__[key]
+
+
+def read_ids(fn, dir_bundle=None, **kwargs):
+    """ IDs in a text file, from the bundle if it is parsed from that file,
+    otherwise np.loadtxt(fn, dtype=str, **kwargs). """
+    bundle = load_bundle(dir_bundle)
+    name = bundle.source(fn) if bundle is not None else None
+    if name is None:
+        if dir_bundle is not None:
+            logging.info("%s is not in the resource bundle, parsing it ... " % fn)
+        return np.loadtxt(fn, dtype=str, **kwargs)
+    ids = np.asarray(bundle[name])
+    if kwargs.get("ndmin", 0) == 0 and ids.shape == (1,):
+        # a single ID is parsed into a 0-d array
+        return ids.reshape(())
+    return ids
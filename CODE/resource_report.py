@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import resource
+import subprocess
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Timer
+
+
+"""
+Resource usage of the steps of the pipeline and of the external programs they run.
+
+Every entry is a JSON line appended with O_APPEND to the report named by the
+NETPROPHET2_REPORT environment variable, so the entries of pool workers and
+of concurrent steps go to the same report. Nothing is recorded when it is
+not set.
+
+- a step is measured in the thread it runs in: wall time, the user and system
+  cpu of that thread, the user and system cpu of the child processes reaped
+  meanwhile (those of steps running at the same time included), the peak RSS
+  of the pipeline process and of its reaped children so far, and the bytes
+  the thread read from and wrote to storage.
+- an external program started by check_call is measured by wait4, for the
+  program along with all the processes it waited for.
+"""
+
+ENV_REPORT = "NETPROPHET2_REPORT"
+
+# ru_inblock and ru_oublock count 512-byte blocks
+BLOCK_SIZE = 512
+
+# ru_maxrss is in kilobytes on linux, in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Summarize the resource report of a pipeline run.")
+    parser.add_argument('-i', '--input', dest='fn_report', type=str, help="report written by a run, JSON lines")
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def record(entry):
+    """
+    append an entry to the report of this run, if any
+    """
+    path = os.environ.get(ENV_REPORT)
+    if not path:
+        return
+    line = (json.dumps(entry) + "\n").encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def usage_entry(kind, name, wall, ru, status):
+    return OrderedDict([
+        ("kind", kind),
+        ("name", name),
+        ("status", status),
+        ("wall", round(wall, 3)),
+        ("user", round(ru.ru_utime, 3)),
+        ("system", round(ru.ru_stime, 3)),
+        ("max_rss", ru.ru_maxrss * RSS_UNIT),
+        ("read_bytes", ru.ru_inblock * BLOCK_SIZE),
+        ("write_bytes", ru.ru_oublock * BLOCK_SIZE),
+    ])
+
+
+@contextmanager
+def measure(name, kind="step"):
+    """
+    record the usage of the work done by the current thread in the with block
+    """
+    start = time.time()
+    thread, children = resource.getrusage(RUSAGE_THREAD), resource.getrusage(resource.RUSAGE_CHILDREN)
+    status = "failed"
+    try:
+        yield
+        status = "finished"
+    finally:
+        wall = time.time() - start
+        thread_end, children_end = resource.getrusage(RUSAGE_THREAD), resource.getrusage(resource.RUSAGE_CHILDREN)
+        entry = usage_entry(kind, name, wall, thread_end, status)
+        entry.update([
+            ("user", round(thread_end.ru_utime - thread.ru_utime, 3)),
+            ("system", round(thread_end.ru_stime - thread.ru_stime, 3)),
+            ("max_rss", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT),
+            ("read_bytes", (thread_end.ru_inblock - thread.ru_inblock) * BLOCK_SIZE),
+            ("write_bytes", (thread_end.ru_oublock - thread.ru_oublock) * BLOCK_SIZE),
+            ("children_user", round(children_end.ru_utime - children.ru_utime, 3)),
+            ("children_system", round(children_end.ru_stime - children.ru_stime, 3)),
+            ("children_max_rss", children_end.ru_maxrss * RSS_UNIT),
+        ])
+        record(entry)
+
+
+def measured(name, func):
+    """
+    func wrapped to record its usage as a step
+    """
+    def wrapper(*args, **kwargs):
+        with measure(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def check_call(cmd, name=None, timeout=None, consume=None, **kwargs):
+    """
+    subprocess.check_call that records the usage of the program
+
+    :param cmd: command, as for subprocess.Popen
+    :param name: name of the entry, default is the program
+    :param timeout: seconds, after which the program and the processes it started are killed
+                    and subprocess.TimeoutExpired is raised
+    :param consume: called with every line of the standard output while the program runs
+    """
+    if name is None:
+        program = cmd.split()[0] if isinstance(cmd, str) else cmd[0]
+        name = os.path.basename(program)
+
+    start = time.time()
+    if timeout is not None:
+        # a group of its own, so a shell is killed along with the program it runs
+        kwargs["start_new_session"] = True
+    if consume is not None:
+        kwargs.update(stdout=subprocess.PIPE, universal_newlines=True)
+    process = subprocess.Popen(cmd, **kwargs)
+    expired = []
+    timer = None
+    if timeout is not None:
+        def kill():
+            expired.append(True)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timer = Timer(timeout, kill)
+        timer.start()
+    try:
+        if consume is not None:
+            with process.stdout:
+                for line in process.stdout:
+                    consume(line)
+        _, status, ru = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+    returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    # reaped by wait4, so Popen does not wait for it again
+    process.returncode = returncode
+    # the timer could go off between the exit of the program and its cancel
+    expired = expired and os.WIFSIGNALED(status)
+
+    status = "timeout" if expired else "finished" if returncode == 0 else "failed"
+    entry = usage_entry("task", name, time.time() - start, ru, status)
+    entry["returncode"] = returncode
+    record(entry)
+
+    if expired:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
+
+
+def human_bytes(n):
+    for unit in ["B", "K", "M", "G"]:
+        if abs(n) < 1024:
+            return "%.0f%s" % (n, unit) if unit == "B" else "%.1f%s" % (n, unit)
+        n /= 1024.0
+    return "%.1fT" % n
+
+
+def read_report(fn):
+    entries = []
+    with open(fn) as r:
+        for line in r:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # a line cut by a crash
+                continue
+    return entries
+
+
+def summarize(entries):
+    """
+    a table of the steps, and of the external programs grouped by the part of their names before "/"
+    """
+    rows = []
+    groups = OrderedDict()
+    for entry in entries:
+        if entry["kind"] == "step":
+            rows.append((
+                entry["name"], "1" if entry["status"] == "finished" else "failed",
+                entry["wall"], entry["user"] + entry.get("children_user", 0), entry["system"] + entry.get("children_system", 0),
+                max(entry["max_rss"], entry.get("children_max_rss", 0)), entry["read_bytes"], entry["write_bytes"]
+            ))
+        else:
+            group = groups.setdefault(entry["name"].split("/")[0], [0, 0, 0, 0, 0, 0, 0, 0])
+            group[0] += 1
+            group[1] += entry["status"] != "finished"
+            group[2] += entry["wall"]
+            group[3] += entry["user"]
+            group[4] += entry["system"]
+            group[5] = max(group[5], entry["max_rss"])
+            group[6] += entry["read_bytes"]
+            group[7] += entry["write_bytes"]
+
+    for name, x in groups.items():
+        count = str(x[0]) if x[1] == 0 else "%d (%d failed)" % (x[0], x[1])
+        rows.append((name, count) + tuple(x[2:]))
+
+    header = ("name", "runs", "wall(s)", "user(s)", "system(s)", "peak rss", "read", "written")
+    cells = [header] + [
+        (x[0], x[1], "%.1f" % x[2], "%.1f" % x[3], "%.1f" % x[4], human_bytes(x[5]), human_bytes(x[6]), human_bytes(x[7]))
+        for x in rows
+    ]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(x.ljust(w) if i < 2 else x.rjust(w) for i, (x, w) in enumerate(zip(row, widths)))
+        for row in cells
+    )
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    print(summarize(read_report(parsed.fn_report)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
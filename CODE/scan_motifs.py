@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+import sys
+import os
+import argparse
+import logging
+
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from CODE import promoter_store
+
+
+"""
+A built-in motif scanner in place of running fimo once per regulator.
+
+The promoters are encoded once into a 2-bit store of promoter_store, every
+sequence followed by a separator, and the motifs of all regulators are
+scored on both strands together: the one-hot encoded bases at every offset
+of the motif width are multiplied with the stacked score matrices, a block
+of positions decoded at a time. A window overlapping a separator or a base
+other than ACGT is never reported.
+
+Scores follow fimo of MEME 4.9.1: the letter frequencies of a motif get a
+pseudocount (--motif-pseudo 0.1) weighted by nsites, log2 odds against the
+background, which is averaged with its complement since both strands are
+scanned, and are scaled to integers from 0 to RANGE per position. The
+p-value of a score is exact over the distribution of scaled scores of
+background sequences, the reported score is the scaled one converted back
+to bits. Sites with a p-value of at most the threshold are written to a
+fimo.txt of every regulator, sorted by p-value then position; q-values are
+the Benjamini-Hochberg ones over every scanned window of the motif.
+"""
+
+BASES = promoter_store.BASES
+
+RANGE = 100
+PSEUDOCOUNT = 0.1
+
+HEADER = "#pattern name\tsequence name\tstart\tstop\tstrand\tscore\tp-value\tq-value\tmatched sequence\n"
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Scan the promoters with the motifs of all regulators on both strands, in place of fimo.")
+    parser.add_argument('-m', '--dir_pfm', dest='dir_pfm', type=str, help="MEME motif of every regulator, named by the regulator")
+    parser.add_argument('-r', '--fn_rids', dest='fn_rids', type=str, help="scan the motifs of these regulators only, in this order")
+    parser.add_argument('-P', '--fn_promoters', dest='fn_promoters', type=str)
+    parser.add_argument('-o', '--dir_fimo', dest='dir_fimo', type=str, help="the sites of a regulator are written to <dir_fimo>/<regulator>/fimo.txt")
+    parser.add_argument('-t', '--thresh', dest='thresh', type=float, default=5e-3, help="p-value threshold of the sites, as fimo --thresh")
+    parser.add_argument('-S', '--fn_store', dest='fn_store', type=str, help="promoter store shared by the processes, encoded from -P if missing or encoded from another version of it")
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1)
+    parsed = parser.parse_args(argv)
+    return parsed
+
+
+def read_promoters(fn, fn_store=None):
+    u"""
+    the promoters encoded in memory, or in a store file shared by the processes if fn_store is given
+    """
+    if fn_store is not None:
+        return promoter_store.build_store(fn, fn_store)
+    return promoter_store.from_fasta(fn)
+
+
+def read_meme(fn):
+    u"""
+    motifs of a MEME file, as (name, letter frequencies, nsites), and the background frequencies, uniform if not given
+    """
+    motifs, background = [], np.full(4, 0.25)
+    with open(fn) as reader:
+        lines = [x.strip() for x in reader]
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith("Background letter frequencies"):
+            tokens = lines[i + 1].split()
+            freqs = dict(zip(tokens[0::2], [float(x) for x in tokens[1::2]]))
+            background = np.array([freqs.get(x, 0.0) for x in BASES])
+            i += 2
+            continue
+        if line.startswith("MOTIF"):
+            name = line.split()[1] if len(line.split()) > 1 else ""
+            i += 1
+            while i < len(lines) and not lines[i].startswith("letter-probability matrix"):
+                i += 1
+            if i == len(lines):
+                break
+            tokens = lines[i].replace("= ", "=").split()
+            header = dict(x.split("=", 1) for x in tokens if "=" in x)
+            width = int(header.get("w", 0))
+            nsites = float(header.get("nsites", 20))
+            rows = []
+            i += 1
+            while len(rows) < width and i < len(lines):
+                if lines[i]:
+                    rows.append([float(x) for x in lines[i].split()[:4]])
+                i += 1
+            motifs.append((name, np.array(rows, dtype=float).reshape(-1, 4), nsites))
+            continue
+        i += 1
+    return motifs, background
+
+
+class PSSM(object):
+    u"""
+    Scaled integer scores of a motif on both strands, and the p-value of every scaled score
+    """
+
+    def __init__(self, name, freqs, nsites, background):
+        self.name = name
+        # both strands are scanned, so the background is averaged with its complement
+        background = np.asarray(background, dtype=float)
+        background = (background + background[::-1]) / 2
+        background = background / background.sum()
+
+        freqs = (freqs * nsites + PSEUDOCOUNT * background) / (nsites + PSEUDOCOUNT)
+        scores = np.log2(freqs / background)
+        self.width = len(scores)
+
+        self.offset = scores.min() if self.width > 0 else 0.0
+        spread = scores.max() - self.offset if self.width > 0 else 0.0
+        self.scale = RANGE / spread if spread > 0 else 1.0
+        self.matrix = np.rint((scores - self.offset) * self.scale).astype(np.int64)
+        # the reverse complement strand
+        self.reverse = self.matrix[::-1, ::-1]
+
+        # distribution of the scaled score of a background window
+        dist = np.ones(1)
+        for row in self.matrix:
+            step = np.zeros(len(dist) + row.max())
+            for score, p in zip(row.tolist(), background.tolist()):
+                step[score:score + len(dist)] += p * dist
+            dist = step
+        # p-value of every scaled score, the chance of a score at least as high
+        self.pvalues = np.minimum(np.cumsum(dist[::-1])[::-1], 1.0)
+
+    def min_score(self, thresh):
+        u"""
+        the lowest scaled score whose p-value is at most thresh, None if there is none
+        """
+        passing = np.flatnonzero(self.pvalues <= thresh)
+        return int(passing[0]) if len(passing) > 0 else None
+
+    def to_bits(self, scaled):
+        return scaled / self.scale + self.width * self.offset
+
+
+def block_size(n_columns, limit=1 << 25):
+    u"""
+    positions scored at a time, so the float32 scores and one-hot bases of a block stay within limit bytes
+    """
+    return max(1024, limit // (4 * max(5, n_columns)))
+
+
+def scan(promoters, pssms, thresh=5e-3):
+    u"""
+    sites of every motif, as (window starts, strands, scaled scores), strand 0 is + and 1 is -
+    """
+    pssms = list(pssms)
+    sites = [([], [], []) for _ in pssms]
+    thresholds = [x.min_score(thresh) for x in pssms]
+    # motifs without any passing score, eg: empty ones, are left out
+    keep = [i for i, x in enumerate(thresholds) if x is not None and pssms[i].width > 0]
+    if not keep or len(promoters) == 0:
+        return [tuple(np.zeros(0, dtype=np.int64) for _ in range(3)) for _ in pssms]
+
+    width = max(pssms[i].width for i in keep)
+    # a column of every motif on every strand, the scores of other bases are masked afterwards
+    weights = np.zeros((width, 5, 2 * len(keep)), dtype=np.float32)
+    for j, i in enumerate(keep):
+        weights[:pssms[i].width, :4, 2 * j] = pssms[i].matrix
+        weights[:pssms[i].width, :4, 2 * j + 1] = pssms[i].reverse
+    cutoffs = np.repeat(np.array([thresholds[i] for i in keep], dtype=np.float32), 2)
+    widths = np.repeat(np.array([pssms[i].width for i in keep]), 2)
+
+    eye = np.eye(5, dtype=np.float32)
+    n_positions = len(promoters)
+    step = block_size(weights.shape[2])
+    for start in range(0, n_positions, step):
+        stop = min(start + step, n_positions)
+        onehot = eye[promoters.decode(start, stop + width)]
+        scores = np.zeros((stop - start, weights.shape[2]), dtype=np.float32)
+        for k in range(width):
+            scores += onehot[k:k + stop - start] @ weights[k]
+        rows, columns = np.nonzero(scores >= cutoffs)
+        if len(rows) == 0:
+            continue
+        starts = rows + start
+        ok = promoters.clean(starts, widths[columns])
+        rows, columns, starts = rows[ok], columns[ok], starts[ok]
+        values = scores[rows, columns].astype(np.int64)
+        for j in np.unique(columns // 2).tolist():
+            hit = columns // 2 == j
+            sites[keep[j]][0].append(starts[hit])
+            sites[keep[j]][1].append(columns[hit] % 2)
+            sites[keep[j]][2].append(values[hit])
+
+    return [tuple(np.concatenate(x) if x else np.zeros(0, dtype=np.int64) for x in y) for y in sites]
+
+
+def qvalues(pvalues, tests):
+    u"""
+    Benjamini-Hochberg q-values of the sorted p-values out of a number of tests
+    """
+    if len(pvalues) == 0:
+        return np.zeros(0)
+    q = pvalues * tests / np.arange(1, len(pvalues) + 1)
+    return np.minimum(np.minimum.accumulate(q[::-1])[::-1], 1.0)
+
+
+def format_sites(promoters, pssm, sites):
+    u"""
+    lines of fimo.txt for the sites of a motif, sorted by p-value then by position
+    """
+    starts, strands, scaled = sites
+    if len(starts) == 0:
+        return []
+    order = np.lexsort((strands, starts, -scaled))
+    starts, strands, scaled = starts[order], strands[order], scaled[order]
+
+    seqs = np.searchsorted(promoters.offsets, starts, side="right") - 1
+    positions = starts - promoters.offsets[seqs] + 1
+    pvalues = pssm.pvalues[scaled]
+    tests = 2 * promoters.windows(pssm.width)
+
+    # matched sequences, reverse complemented on the - strand
+    letters = np.frombuffer(b"ACGTN", dtype=np.uint8)
+    codes = promoters.take(starts[:, None] + np.arange(pssm.width)[None, :])
+    minus = strands == 1
+    codes[minus] = 3 - codes[minus][:, ::-1]
+    matched = letters[codes].view("S%d" % pssm.width).ravel()
+
+    cells = np.empty((len(starts), 9), dtype=object)
+    cells[:, 0] = pssm.name
+    cells[:, 1] = promoters.names[seqs].tolist()
+    cells[:, 2] = positions.tolist()
+    cells[:, 3] = (positions + pssm.width - 1).tolist()
+    cells[:, 4] = np.where(minus, "-", "+").tolist()
+    cells[:, 5] = pssm.to_bits(scaled).tolist()
+    cells[:, 6] = pvalues.tolist()
+    cells[:, 7] = qvalues(pvalues, tests).tolist()
+    cells[:, 8] = [x.decode("ascii") for x in matched.tolist()]
+    text = ("%s\t%s\t%d\t%d\t%s\t%.6g\t%.3g\t%.3g\t%s\n" * len(starts)) % tuple(cells.ravel().tolist())
+    return [text]
+
+
+def write_sites(fn, promoters, pssm, sites):
+    tmp = fn + ".tmp"
+    with open(tmp, "w") as writer:
+        writer.write(HEADER)
+        writer.writelines(format_sites(promoters, pssm, sites))
+    os.replace(tmp, fn)
+
+
+def read_pssms(fn):
+    motifs, background = read_meme(fn)
+    return [PSSM(name, freqs, nsites, background) for name, freqs, nsites in motifs]
+
+
+def scan_regulators(promoters, fns, dir_fimo, thresh=5e-3):
+    u"""
+    scan the motifs of several regulators at once and write the fimo.txt of every one of them
+
+    :param fns: dict of regulator -> its MEME file
+    """
+    pssms, owners = [], []
+    for regulator, fn in fns.items():
+        for pssm in read_pssms(fn):
+            pssms.append(pssm)
+            owners.append(regulator)
+
+    sites = scan(promoters, pssms, thresh)
+    written = {}
+    for regulator in fns.keys():
+        written[regulator] = []
+        out = os.path.join(dir_fimo, regulator)
+        if not os.path.exists(out):
+            os.makedirs(out)
+    for regulator, pssm, site in zip(owners, pssms, sites):
+        written[regulator].extend(format_sites(promoters, pssm, site))
+    for regulator, texts in written.items():
+        fn = os.path.join(dir_fimo, regulator, "fimo.txt")
+        with open(fn + ".tmp", "w") as writer:
+            writer.write(HEADER)
+            writer.writelines(texts)
+        os.replace(fn + ".tmp", fn)
+    return list(fns.keys())
+
+
+__worker__ = {}
+
+
+def init_worker(promoters, dir_fimo, thresh):
+    __worker__.update(promoters=promoters, dir_fimo=dir_fimo, thresh=thresh)
+
+
+def scan_batch(fns):
+    return scan_regulators(__worker__["promoters"], fns, __worker__["dir_fimo"], __worker__["thresh"])
+
+
+def main(argv):
+    parsed = parse_args(argv)
+    if parsed.fn_rids is not None:
+        regulators = [x for x in np.loadtxt(parsed.fn_rids, dtype=str, ndmin=1).tolist()]
+    else:
+        regulators = sorted(os.listdir(parsed.dir_pfm))
+    fns = {}
+    for regulator in regulators:
+        fn = os.path.join(parsed.dir_pfm, regulator)
+        if os.path.isfile(fn):
+            fns.setdefault(regulator, fn)
+
+    logging.info("Encoding promoters ... ")
+    promoters = read_promoters(parsed.fn_promoters, parsed.fn_store)
+
+    # a few batches of motifs per process, every batch scores its motifs in one pass over the promoters
+    names = list(fns.keys())
+    n_batches = min(len(names), max(1, parsed.processes) * 4)
+    batches = [{x: fns[x] for x in names[i::n_batches]} for i in range(n_batches)]
+    logging.info("Scanning %d motifs in %d batches ... " % (len(names), n_batches))
+    if parsed.processes > 1 and n_batches > 1:
+        with Pool(parsed.processes, initializer=init_worker, initargs=(promoters, parsed.dir_fimo, parsed.thresh)) as p:
+            for _ in tqdm(p.imap_unordered(scan_batch, batches), total=len(batches)):
+                pass
+    else:
+        init_worker(promoters, parsed.dir_fimo, parsed.thresh)
+        for batch in tqdm(batches):
+            scan_batch(batch)
+    return names
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
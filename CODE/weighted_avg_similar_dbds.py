@@ -2,25 +2,36 @@
 import sys
 import os
 import glob
+import json
+import hashlib
 import argparse
 import logging
+import tempfile
 
 import numpy as np
 
+from scipy import sparse
+
+from CODE import network_io
+from CODE import resource_bundle
+
 
 dbds_formats = ['multi_dbds', 'single_dbds']
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description="Merge TF network scores by weighted averaging, where the weight uses DBD-PWM similarity fit.")
-    parser.add_argument("-n", "--fn_adjmtr_network", dest="fn_adjmtr_network")
+    parser.add_argument("-n", "--fn_adjmtr_network", dest="fn_adjmtr_network", nargs="+", help="one or more networks, averaged with the same weights")
     parser.add_argument("-r", "--fn_rids", dest="fn_rids")
+    parser.add_argument("-g", "--fn_gids", dest="fn_gids", help="gene IDs stored along with a binary output network")
     parser.add_argument("-a", "--dir_aligned_dbd", dest="dir_aligned_dbd")
     parser.add_argument("-d", "--dbd_cutoff", dest="dbd_cutoff", type=float, default=50)
     parser.add_argument("-f", "--dbds_formats", dest="dbds_formats", help="options: %s" % dbds_formats, default="single_dbds")
     parser.add_argument("-t", "--fn_dbd2rids_conversion", dest="fn_dbd2rids_conversion")
     parser.add_argument("-p", "--fn_pertrubed_rids", dest="fn_pertrubed_rids")
-    parser.add_argument("-o", "--fn_output", dest="fn_output")
+    parser.add_argument("-c", "--dir_cache", dest="dir_cache", help="directory to cache the parsed TF weights in")
+    parser.add_argument("-B", "--dir_bundle", dest="dir_bundle", help="binary bundle of the resources written by prepare_resources")
+    parser.add_argument("-o", "--fn_output", dest="fn_output", nargs="+", help="one output per input network")
     parsed = parser.parse_args(argv)
     return parsed
 
@@ -30,24 +41,16 @@ def sigmoid(x):
 
 
 def write_adjmtr(fn, adjmtr):
-    writer = open(fn, "w")
-    for i in range(len(adjmtr)):
-        for j in range(len(adjmtr[i])):
-            if adjmtr[i,j] == 0:
-                writer.write("0\t")
-            else:
-                writer.write("%0.10f\t" % adjmtr[i, j])
-        writer.write("\n")
-    writer.close()
-
-
-def get_regulators(fn_rids, fn_pert_rids):    
-    rids = np.loadtxt(fn_rids, dtype=str)
-    pert_rids = np.intersect1d(rids, np.loadtxt(fn_pert_rids, dtype=str)) if fn_pert_rids is not None else None
+    network_io.write_adjmtr(fn, adjmtr, fmt="%0.10f", zero="0")
+
+
+def get_regulators(fn_rids, fn_pert_rids, dir_bundle=None):
+    rids = resource_bundle.read_ids(fn_rids, dir_bundle)
+    pert_rids = np.intersect1d(rids, resource_bundle.read_ids(fn_pert_rids, dir_bundle)) if fn_pert_rids is not None else None
     return rids, pert_rids
 
 
-def get_tf_weights_multi_dbds(dir_dbd, dbd_cutoff, fn_conv):
+def get_tf_weights_multi_dbds(dir_dbd, dbd_cutoff, fn_conv, rids=None):
 
     # parse tf-dbd conversion
     dbd2rid_list = np.loadtxt(fn_conv, dtype=str)
@@ -60,6 +63,8 @@ def get_tf_weights_multi_dbds(dir_dbd, dbd_cutoff, fn_conv):
     for fn_dbd in glob.glob(dir_dbd + "*"):
         query_dbd = os.path.basename(fn_dbd)
         query_tf = dbd2rid_dict[query_dbd]
+        if rids is not None and query_tf not in rids:
+            continue
         if query_tf not in tf_simscore_dict.keys():
             tf_simscore_dict[query_tf] = {}
 
@@ -81,17 +86,19 @@ def get_tf_weights_multi_dbds(dir_dbd, dbd_cutoff, fn_conv):
     for query_tf in tf_simscore_dict.keys():
         tf_weight_dict[query_tf] = {}
         for paired_tf, scores in tf_simscore_dict[query_tf].items():
-            scores = scores[scores >= dbd_cutoff]
+            scores = [x for x in scores if x >= dbd_cutoff]
             if len(scores) > 0:
                 tf_weight_dict[query_tf][paired_tf] = sigmoid(max(scores))
     return tf_weight_dict
 
 
-def get_tf_weights(dir_dbd, dbd_cutoff):
+def get_tf_weights(dir_dbd, dbd_cutoff, rids=None):
     # loop thru dbd similarity files
     tf_simscore_dict = {}
     for fn_tf in glob.glob(dir_dbd + "*"):
         query_tf = os.path.basename(fn_tf)
+        if rids is not None and query_tf not in rids:
+            continue
         tf_simscore_dict[query_tf] = {}
 
         # get similarity scores
@@ -114,6 +121,60 @@ def get_tf_weights(dir_dbd, dbd_cutoff):
     return tf_weight_dict
 
 
+def get_cache_key(dir_dbd, dbd_cutoff, dbds_format, fn_conv=None):
+    """ Hashes the name, size and modification time of every alignment file
+    along with the cutoff and format, so that any change makes a new key. """
+    entries = []
+    for fn in sorted(glob.glob(dir_dbd + "*")):
+        stat = os.stat(fn)
+        entries.append([os.path.basename(fn), stat.st_size, stat.st_mtime_ns])
+    if fn_conv is not None:
+        stat = os.stat(fn_conv)
+        entries.append([os.path.abspath(fn_conv), stat.st_size, stat.st_mtime_ns])
+    key = json.dumps([dbds_format, dbd_cutoff, entries])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def load_tf_weights(dir_dbd, dbd_cutoff, dbds_format, rids, fn_conv=None, dir_cache=None):
+    """ Returns the TF weights of the listed regulators. With dir_cache the
+    parsed weights are kept in one JSON file per format and cutoff, along
+    with the get_cache_key they were parsed under; only the regulators not
+    looked up before are parsed and added to it, and a file of another key
+    is started over, so a sweep keeps one file per cutoff. """
+    def parse(queries):
+        if dbds_format == "multi_dbds":
+            return get_tf_weights_multi_dbds(dir_dbd, dbd_cutoff, fn_conv, queries)
+        return get_tf_weights(dir_dbd, dbd_cutoff, queries)
+
+    rids = set(np.asarray(rids).tolist())
+    if dir_cache is None:
+        return parse(rids)
+
+    key = get_cache_key(dir_dbd, dbd_cutoff, dbds_format, fn_conv)
+    fn_cache = os.path.join(dir_cache, "dbd_weights.%s.%s.json" % (dbds_format, dbd_cutoff))
+
+    cache = {"key": key, "rids": [], "weights": {}}
+    if os.path.exists(fn_cache):
+        with open(fn_cache) as reader:
+            stored = json.load(reader)
+        if stored.get("key") == key:
+            cache = stored
+
+    missing = rids - set(cache["rids"])
+    if missing:
+        logging.info("Parsing TF weights of %d regulators into %s" % (len(missing), fn_cache))
+        cache["weights"].update(parse(missing))
+        cache["rids"] = sorted(set(cache["rids"]) | missing)
+
+        os.makedirs(dir_cache, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dir_cache, suffix=".tmp")
+        with os.fdopen(fd, "w") as writer:
+            json.dump(cache, writer)
+        os.replace(tmp, fn_cache)
+
+    return {k: v for k, v in cache["weights"].items() if k in rids}
+
+
 def update_tf_weights(tf_weight_dict, pert_rids):
     for query_tf in tf_weight_dict.keys():
         for paired_tf in tf_weight_dict[query_tf].keys():
@@ -122,37 +183,42 @@ def update_tf_weights(tf_weight_dict, pert_rids):
                 tf_weight_dict[query_tf][paired_tf] = 0
 
 
-def average_scores(network_input, tf_weight_dict, rids):
-    network_output = np.zeros(network_input.shape)
-    print(network_input.shape)
-    # weighted average
-    for query_tf in rids:
-        query_indx = np.where(rids == query_tf)[0][0]
-        if query_tf not in tf_weight_dict.keys() or len(tf_weight_dict[query_tf].keys()) < 2:
-
+def build_weight_matrix(tf_weight_dict, rids):
+    """ Compiles the TF weights into a sparse R x R matrix whose rows hold the
+    normalized weights of the paired TFs, so that averaging a network is one
+    matrix product. Rows of TFs without other similar TFs are identity rows. """
+    rids = np.asarray(rids)
+    index = {}
+    for i, rid in enumerate(rids.tolist()):
+        index.setdefault(rid, i)
+
+    rows, cols, data = [], [], []
+    for query_tf, query_indx in index.items():
+        paired = tf_weight_dict.get(query_tf, {})
+        allowed_rids = sorted(x for x in paired.keys() if x in index) if len(paired) >= 2 else []
+        if len(allowed_rids) == 0:
             # unchanged score if query tf does not have other similar tfs
-            network_output[query_indx, :] = network_input[query_indx, :]
+            rows.append(query_indx)
+            cols.append(query_indx)
+            data.append(1.0)
         else:
+            paired_tf_weights = np.array([paired[x] for x in allowed_rids], dtype=float)
+            paired_tf_weights /= np.sum(paired_tf_weights)
+            rows.extend([query_indx] * len(allowed_rids))
+            cols.extend(index[x] for x in allowed_rids)
+            data.extend(paired_tf_weights.tolist())
 
-            # use allowed tfs
-            allowed_rids = np.intersect1d(list(tf_weight_dict[query_tf].keys()), rids)
-            if len(allowed_rids) == 0:
-                network_output[query_indx, :] = network_input[query_indx, :]
-            else:
-                paired_tf_indices = []
-                paired_tf_weights = []
-                for paired_tf in allowed_rids:
-                    paired_tf_indices.append(np.where(rids == paired_tf)[0][0])
-                    paired_tf_weights.append(tf_weight_dict[query_tf][paired_tf])
+    # explicit zeros are kept, a zero weight still propagates nan and inf like a dense product
+    return sparse.csr_matrix((data, (rows, cols)), shape=(len(rids), len(rids)))
 
-                # compute weighted average
-                paired_tf_weights = np.array(paired_tf_weights)
-                paired_tf_weights /= np.sum(paired_tf_weights)
 
-                # update the subnetwork
-                network_sub = network_input[paired_tf_indices, :]
-                network_output[query_indx, :] = np.dot(paired_tf_weights,  network_sub)
-    return network_output
+def average_scores(network_input, tf_weight_dict, rids):
+    """ Weighted averages the scores of similar TFs. network_input is either a
+    network or a list of networks, which share one weight matrix. """
+    weights = build_weight_matrix(tf_weight_dict, rids)
+    if isinstance(network_input, (list, tuple)):
+        return [np.asarray(weights @ np.asarray(x, dtype=float)) for x in network_input]
+    return np.asarray(weights @ np.asarray(network_input, dtype=float))
 
 
 def main(argv):
@@ -160,16 +226,16 @@ def main(argv):
     parsed.dir_aligned_dbd += "" if parsed.dir_aligned_dbd.endswith("/") else "/"
 
     # get regulator list
-    rids, pert_rids = get_regulators(parsed.fn_rids, parsed.fn_pertrubed_rids)
+    rids, pert_rids = get_regulators(parsed.fn_rids, parsed.fn_pertrubed_rids, parsed.dir_bundle)
 
     # parse dbd percent identity and compute weights from sigmoid fit
     logging.info("Computing TF weights ... ")
     if parsed.dbds_formats.lower() == "multi_dbds":
         if parsed.fn_dbd2rids_conversion is None:
             sys.exit("ERROR: DBD to TF conversion file must be provided if multi_dbds is used.")
-        tf_weight_dict = get_tf_weights_multi_dbds(parsed.dir_aligned_dbd, parsed.dbd_cutoff, parsed.fn_dbd2rids_conversion)
+        tf_weight_dict = load_tf_weights(parsed.dir_aligned_dbd, parsed.dbd_cutoff, "multi_dbds", rids, parsed.fn_dbd2rids_conversion, parsed.dir_cache)
     elif parsed.dbds_formats.lower() == 'single_dbds':
-        tf_weight_dict = get_tf_weights(parsed.dir_aligned_dbd, parsed.dbd_cutoff)
+        tf_weight_dict = load_tf_weights(parsed.dir_aligned_dbd, parsed.dbd_cutoff, "single_dbds", rids, dir_cache=parsed.dir_cache)
     else:
         sys.exit("ERROR: Improper DBD alignment score format.")
     logging.info("DONE\n")
@@ -180,19 +246,29 @@ def main(argv):
         update_tf_weights(tf_weight_dict, pert_rids)
         logging.info("DONE\n")
 
+    if len(parsed.fn_adjmtr_network) != len(parsed.fn_output):
+        sys.exit("ERROR: %d input networks but %d output networks." % (len(parsed.fn_adjmtr_network), len(parsed.fn_output)))
+
     # load network
     logging.info("Loading network ... ")
-    network_input = np.loadtxt(parsed.fn_adjmtr_network)
+    networks_input, networks_gids = [], []
+    for fn in parsed.fn_adjmtr_network:
+        network_input, _, gids = network_io.read_network(fn)
+        networks_input.append(network_input)
+        networks_gids.append(gids)
+    if parsed.fn_gids is not None:
+        networks_gids = [resource_bundle.read_ids(parsed.fn_gids, parsed.dir_bundle)] * len(networks_input)
     logging.info("DONE\n")
 
     # merge similar tfs using weighted average
     logging.info("Weighted averaging similar TFs ... ")
-    network_output = average_scores(network_input, tf_weight_dict, rids)
+    networks_output = average_scores(networks_input, tf_weight_dict, rids)
     logging.info("DONE\n")
 
     # write weighted average network
     logging.info("Writing network ... ")
-    write_adjmtr(parsed.fn_output, network_output)
+    for fn, network_output, gids in zip(parsed.fn_output, networks_output, networks_gids):
+        network_io.write_network(fn, network_output, rids, gids, fmt="%0.10f", zero="0")
     logging.info("DONE\n")
 
 
@@ -1,11 +1,12 @@
 ###### multiple response LARS (single combined)
 ##TODO: Need to make # of folds a parameter exposed to used
 library(lars)
+library(parallel)
 
-lars.multi.optimize <- function(tdata,rdata,pert,prior,allowed)
+lars.multi.optimize <- function(tdata,rdata,pert,prior,allowed,processes=1)
 {
 	cat(as.character(Sys.time()),"\n")
-	lars.paths.cv <- lars.multi.cv(tdata,rdata,pert,prior,allowed,10)
+	lars.paths.cv <- lars.multi.cv(tdata,rdata,pert,prior,allowed,10,processes)
 	
 	lars.paths <- lars.multi(tdata,rdata,pert,prior,allowed)
 	B <- lars.multi.path.step(lars.paths,lars.paths.cv[[2]])
@@ -25,21 +26,44 @@ lars.multi.optimize <- function(tdata,rdata,pert,prior,allowed)
 	rval
 }
 
-lars.multi.cv <- function(tdata,rdata,pert,prior,allowed,fold)
+## lapply over the forked processes of a local pool when processes > 1
+lars.lapply <- function(X,FUN,processes=1)
+{
+	if (processes <= 1)
+		return(lapply(X,FUN))
+	rval <- mclapply(X,FUN,mc.cores=processes,mc.preschedule=FALSE)
+	failed <- sapply(rval, inherits, "try-error")
+	if (any(failed))
+		stop(rval[failed][[1]])
+	rval
+}
+
+lars.multi.cv <- function(tdata,rdata,pert,prior,allowed,fold,processes=1)
 {	
 	all.folds <- cv.folds(dim(tdata)[2], fold)
-	lars.cv.paths <- list()
-	cMax <- 0;
-	for (f in 1:fold)
+	lars.cv.paths <- lars.lapply(1:fold, function(f)
 	{
 		cat("Building path for cv",f,"of",fold,"\n")
 		omit <- all.folds[[f]]
-		lars.cv.paths[[f]] <- lars.multi(tdata[,-omit], rdata[,-omit], pert[,-omit],prior,allowed)
+		lars.multi(tdata[,-omit], rdata[,-omit], pert[,-omit],prior,allowed)
+	}, processes)
+	cMax <- 0;
+	for (f in 1:fold)
+	{
 		if (lars.cv.paths[[f]]$R[1,1]>cMax)
 		{
 			cMax <- lars.cv.paths[[f]]$R[1,1]
 		}
-		
+	}
+
+	## the simplex search probes the same penalties again, each one is evaluated once
+	evaluated <- new.env()
+	lars.eval <- function(cVal)
+	{
+		key <- sprintf("%a",cVal)
+		if (is.null(evaluated[[key]]))
+			evaluated[[key]] <- lars.multi.cv.eval(cVal,fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed,processes=processes)
+		evaluated[[key]]
 	}
 
 	cSteps <- c()
@@ -48,7 +72,7 @@ lars.multi.cv <- function(tdata,rdata,pert,prior,allowed,fold)
 	
 	converged <- FALSE
 	P <- c(cMax/10,0)
-	FP <- c(lars.multi.cv.eval(P[1],fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed),lars.multi.cv.eval(P[2],fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed))
+	FP <- c(lars.eval(P[1]),lars.eval(P[2]))
 
 	while (!converged)
 	{
@@ -66,13 +90,13 @@ lars.multi.cv <- function(tdata,rdata,pert,prior,allowed,fold)
 		else if (Pref<0)
 			FPref <- max(FP) + Pref^2
 		else
-			FPref <- lars.multi.cv.eval(Pref,fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed)
+			FPref <- lars.eval(Pref)
 		
 			if (FPref < FP[Imin])		
 			{
 				#Attempt expansion
 				Pexp <- 2*Pref - Phat
-				FPexp <- lars.multi.cv.eval(Pexp,fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed)
+				FPexp <- lars.eval(Pexp)
 				if (FPexp < FPref) #Expand
 				{
 					cat("Expand\n")
@@ -93,13 +117,13 @@ lars.multi.cv <- function(tdata,rdata,pert,prior,allowed,fold)
 				{
 					cat("Contract (1)\n")
 					P[Imax] <- (P[Imax] + Phat)/2
-					FP[Imax] <- lars.multi.cv.eval(P[Imax],fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed)
+					FP[Imax] <- lars.eval(P[Imax])
 				}
 				else
 				{
 					cat("Contract (2)\n")
 					P[Imax] <- (Pref + Phat)/2
-					FP[Imax] <- lars.multi.cv.eval(P[Imax],fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed)
+					FP[Imax] <- lars.eval(P[Imax])
 				}
 			}
 	}
@@ -111,13 +135,14 @@ lars.multi.cv <- function(tdata,rdata,pert,prior,allowed,fold)
 	rval
 }
 
-lars.multi.cv.eval <- function(cVal,fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed,targets=NULL)
+lars.multi.cv.eval <- function(cVal,fold,lars.cv.paths,all.folds,tdata,rdata,pert,prior,allowed,targets=NULL,processes=1)
 {
 		if (is.null(targets))
 			targets <- seq(dim(tdata)[1])
-		mse <- rep(0,times=fold)
-		for (f in 1:fold)
+		## folds are independent, each one is summed in the same order as in a single process
+		mse <- unlist(lars.lapply(1:fold, function(f)
 		{
+			msef <- 0
 			B <- lars.multi.path.step(lars.cv.paths[[f]],cVal)
 			for (i in targets)
 			{
@@ -131,10 +156,10 @@ lars.multi.cv.eval <- function(cVal,fold,lars.cv.paths,all.folds,tdata,rdata,per
 
 				testp <- scale(t(testx) , lars.cv.paths[[f]][[i]]$meanx, FALSE) %*% matrix(B[[i]]) + lars.cv.paths[[f]][[i]]$mu
 				testr <- apply((testp - testy)^2,2,mean)
-				mse[f] <- mse[f] + testr
+				msef <- msef + testr
 			}
-			mse[f] <- mse[f]/length(targets)
-		}
+			msef/length(targets)
+		}, processes))
 		totalmse <- sum(mse) / fold
 		totalmse
 }
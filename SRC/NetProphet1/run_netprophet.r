@@ -12,6 +12,7 @@ outputDirectory <- toString(args[10])
 combinedAdjLstFileName <- toString(args[11])
 regulatorGeneNamesFileName <- toString(args[12])
 targetGeneNamesFileName <- toString(args[13])
+processes <- if (length(args) >= 15) as.integer(args[15]) else 1
 
 source("global.lars.regulators.r")
 
@@ -73,7 +74,7 @@ set.seed(seed)
 if (nonGlobalShrinkageFlag == 1) {
 	uniform.solution <- lars.local(tdata,rdata,pert,prior,allowed,skip_reg,skip_gen)
 } else {
-	uniform.solution <- lars.multi.optimize(tdata,rdata,pert,prior,allowed)
+	uniform.solution <- lars.multi.optimize(tdata,rdata,pert,prior,allowed,processes)
 }
 
 lasso_component <- uniform.solution[[1]]
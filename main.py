@@ -8,24 +8,49 @@ A python wrapper for running the netprophet to replace snakemake
 import os
 import sys
 import json
+import time
 import logging
 
 from argparse import ArgumentParser, ArgumentError
 from multiprocessing import Pool
 from shutil import rmtree
-from subprocess import check_call, CalledProcessError
+from subprocess import CalledProcessError, TimeoutExpired
+from threading import Lock
 
 from tqdm import tqdm
 
+from CODE import dag_scheduler
+# the parallelism of every step is its pools and R workers sized by the cpu budget, so the BLAS and OpenMP pools
+# of numpy and of the child processes get a thread each instead of a thread per core each; numpy reads them when imported
+dag_scheduler.cap_threads(1)
+
 from CODE import prepare_resources
 from CODE import weighted_avg_similar_dbds
 from CODE import build_motif_network
+from CODE import bart_shards
 from CODE import combine_networks
+from CODE import quantile_combine_networks
 from CODE import convert_fire2meme
-from CODE import parse_network_scores
 from CODE import parse_motif_summary
-from CODE import parse_quantized_bins
-
+from CODE import bin_network_scores
+from CODE import estimate_affinity
+from CODE import motif_pipeline
+from CODE import ledger
+from CODE import network_io
+from CODE import resource_report
+from CODE import scan_motifs
+from CODE import batch_fimo
+from CODE import promoter_store
+
+
+# the text writer of every intermediate network, the one its step uses when it writes text
+TEXT_WRITERS = {
+    "npwa.adjmtr": weighted_avg_similar_dbds.write_adjmtr,
+    "bnwa.adjmtr": weighted_avg_similar_dbds.write_adjmtr,
+    "npwa_bnwa.adjmtr": quantile_combine_networks.write_table,
+    "mn.adjmtr": lambda fn, adjmtr: build_motif_network.write_adjmtr(adjmtr, fn),
+    "npwa_bnwa_mn.adjmtr": combine_networks.write_adjmtr,
+}
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
 
@@ -37,7 +62,38 @@ def call(cmd):
     :return:
     """
     with open(os.devnull, "w+") as w:
-        check_call(cmd, shell=True, stdout=w, stderr=w)
+        resource_report.check_call(cmd, shell=True, stdout=w, stderr=w)
+
+
+def call_fimo(task):
+    u"""
+    run FIMO of a regulator, a failed run is returned instead of raised so the other regulators go on
+    :param task: regulator, command, timeout and retries
+    :return: regulator and its error, None if FIMO is finished
+    """
+    regulator, cmd, timeout, retries = task
+    try:
+        motif_pipeline.call_retry(cmd, "FIMO/" + regulator, timeout, retries)
+    except (CalledProcessError, TimeoutExpired) as err:
+        return regulator, str(err)
+    return regulator, None
+
+
+def write_affinity(task):
+    u"""
+    write the affinity summary of a regulator, a failure is returned instead of raised so the other regulators go on
+    :param task: path to fimo.txt and to the summary
+    :return: path to the summary and its error, None if it is written
+    """
+    fn_fimo, fn_summary = task
+    try:
+        estimate_affinity.write_summary(task)
+    except (OSError, ValueError) as err:
+        # left out of the motif network, like a regulator without a summary
+        if os.path.exists(fn_summary):
+            os.remove(fn_summary)
+        return fn_summary, str(err)
+    return fn_summary, None
 
 
 class SnakeMakePipe(object):
@@ -45,13 +101,32 @@ class SnakeMakePipe(object):
 
     """
 
-    def __init__(self, path: str, processes: int=1):
+    def __init__(self, path: str, processes: int=1, binary: bool=False, export_text: bool=False, bart_shards: int=10,
+                 task_timeout: float=None, task_retries: int=1, memory: float=None, scanner: str="fimo",
+                 inference: str="fire"):
         u"""
         path to config file
         :param path:
         :param processes
+        :param binary: pass the intermediate networks between steps as binary memory-mapped files
+        :param export_text: also write text copies of the binary intermediate networks
+        :param bart_shards: number of shards of target genes the BART network of step 4 is built in
+        :param task_timeout: seconds a FIRE or FIMO run of step 8 is killed after, None for no limit
+        :param task_retries: times a failed or killed FIRE or FIMO run of step 8 is tried again
+        :param memory: bytes of memory shared by the running steps, default is the physical memory
+        :param scanner: fimo, fimo-batch to stop step 8 at the motifs and score them in step 9 with a fimo run per batch,
+                        or builtin to score the motifs of step 8 and 9 with scan_motifs
+        :param inference: fire, or kmer to infer the motifs of step 8 with kmer_motifs instead of a FIRE run per regulator
         """
         self.processes = processes
+        self.bart_shards = bart_shards
+        self.task_timeout = task_timeout
+        self.task_retries = task_retries
+        self.memory = memory if memory is not None else dag_scheduler.physical_memory()
+        self.scanner = scanner
+        self.inference = inference
+        self.binary = binary
+        self.export_text = export_text
         # self.__root__ = os.path.abspath(os.path.dirname(__file__))
         self.__root__ = "/opt/NetProphet_2.0"
 
@@ -62,6 +137,14 @@ class SnakeMakePipe(object):
             self.config = json.load(r)
 
         self.progress = os.path.join(self.config["NETPROPHET2_DIR"], "progress.json")
+        # binary bundle of the resources parsed by STEP2
+        self.bundle = os.path.join(self.config["NETPROPHET2_DIR"], self.config["RESOURCES_DIR"], "tmp/bundle")
+        self.__lock__ = Lock()
+        self.ledger = ledger.Ledger(os.path.join(self.config["NETPROPHET2_DIR"], "ledger.jsonl"))
+        # before any step or worker appends to it
+        self.ledger.compact()
+        self.__tasks__ = {x.name: x for x in self.tasks()}
+        self.requires = dag_scheduler.resolve_dependencies(list(self.__tasks__.values()))
 
         if self.check_progress(11):
             logging.info("Please remove {} before re-run this pipeline".format(self.progress))
@@ -74,25 +157,294 @@ class SnakeMakePipe(object):
         """
 
         progress = []
-        if os.path.exists(self.progress):
-            with open(self.progress) as r:
-                progress = json.load(r)
+        with self.__lock__:
+            if os.path.exists(self.progress):
+                with open(self.progress) as r:
+                    progress = json.load(r)
+
+        if step not in progress:
+            return False
 
-        return step in progress
+        # steps finished before the ledger existed are trusted
+        recorded = self.ledger.get("STEP%d" % step)
+        if recorded is not None and recorded != self.fingerprint(step):
+            logging.info("Inputs or parameters of STEP%d are changed since it was finished" % step)
+            return False
+        return True
 
     def log_progress(self, step):
-        progress = []
-        if os.path.exists(self.progress):
-            with open(self.progress) as r:
-                progress = json.load(r)
+        value = self.fingerprint(step)
+        with self.__lock__:
+            progress = []
+            if os.path.exists(self.progress):
+                with open(self.progress) as r:
+                    progress = json.load(r)
 
-        if step not in progress:
-            progress.append(step)
+            if step not in progress:
+                progress.append(step)
+
+            with open(self.progress, "w+") as w:
+                json.dump(progress, w, indent=4)
+
+        self.ledger.record("STEP%d" % step, value)
+
+    def fingerprint(self, step):
+        u"""
+        fingerprint of the inputs, outputs and parameters of a step
+
+        files are represented by their content, directories written by upstream steps by the fingerprints
+        recorded for those steps, and other directories by the content of all their files
+        :param step:
+        :return:
+        """
+        task = self.__tasks__["STEP%d" % step]
+        inputs = []
+        for path in task.inputs:
+            upstream = [
+                x for x in self.requires[task.name]
+                if any(dag_scheduler.produces(o, path) for o in self.__tasks__[x].outputs)
+            ]
+            if os.path.isdir(path) and upstream:
+                inputs.append([path, [self.ledger.get(x) for x in upstream]])
+            else:
+                inputs.append([path, self.ledger.hash_path(path)])
+        return ledger.fingerprint(task.name, task.params, inputs, task.outputs)
+
+    def check_requires(self, step):
+        u"""
+        check whether the upstream steps of a step are finished
+
+        :param step:
+        :return: list of unfinished upstream steps
+        """
+        return [x for x in self.requires["STEP%d" % step] if not self.check_progress(int(x.replace("STEP", "")))]
+
+    def network(self, name: str, binary: bool=None):
+        u"""
+        path to a network under the output directory, in the binary format if enabled
+
+        :param name: file name of the text network, eg: npwa.adjmtr
+        :param binary: override the binary mode of this pipeline
+        :return:
+        """
+        path = os.path.join(self.config["NETPROPHET2_DIR"], self.config["OUTPUT_DIR"], "networks", name)
+        if self.binary if binary is None else binary:
+            return path + network_io.BINARY_SUFFIX
+        return path
+
+    def export_network(self, name: str):
+        u"""
+        write the text copy of a binary intermediate network if requested, in the format of its text mode
+
+        :param name: file name of the text network, a key of TEXT_WRITERS
+        :return:
+        """
+        if self.binary and self.export_text:
+            TEXT_WRITERS[name](self.network(name, binary=False), network_io.load_network(self.network(name))[0])
+
+    def tasks(self):
+        u"""
+        declare the real inputs and outputs of every step, the dependencies between steps are derived from them
+
+        :return: list of dag_scheduler.Task
+        """
+        def resource(*names):
+            return os.path.join(self.config["NETPROPHET2_DIR"], self.config["RESOURCES_DIR"], *names)
+
+        def output(*names):
+            return os.path.join(self.config["NETPROPHET2_DIR"], self.config["OUTPUT_DIR"], *names)
+
+        genes = resource(self.config["FILENAME_GENES"])
+        regulators = resource(self.config["FILENAME_REGULATORS"])
+        dbd = resource(self.config["DBD_PID_DIR"])
+
+        # lines of a file, counted once it exists; the scheduler asks for footprints on every pass
+        counts = {}
+
+        def count(fn):
+            if fn not in counts:
+                if not os.path.exists(fn):
+                    return 0
+                with open(fn) as r:
+                    counts[fn] = sum(1 for x in r if x.strip())
+            return counts[fn]
+
+        def memory(networks=0, expression=0, per_thread=0, per_thread_networks=0, per_thread_expression=0):
+            u"""
+            rough footprint of a step, in copies of a network and of the expression data as float64 arrays,
+            and in bytes of every thread, eg: a pool worker, a FIRE run or a forked R worker
+            """
+            def footprint(threads):
+                network = 8 * count(regulators) * count(genes)
+                expression_data = 8 * count(genes) * count(resource(self.config["FILENAME_SAMPLE_CONDITIONS"]))
+                return networks * network + expression * expression_data + threads * (
+                    per_thread + per_thread_networks * network + per_thread_expression * expression_data
+                )
+            return footprint
+
+        mb = 2 ** 20
+
+        # STEP8 scores the motifs and builds the motif network itself, except with the fimo-batch scanner,
+        # which leaves them to STEP9 and STEP10; every output is declared by the step that writes it
+        batched = self.scanner == "fimo-batch"
+        scored = [output("motif_inference/motifs_score"), self.network("mn.adjmtr")]
+
+        return [
+            dag_scheduler.Task(
+                "STEP1", self.step1,
+                outputs=[
+                    resource("tmp"),
+                    output("networks"),
+                    output("motif_inference"),
+                    output("motif_inference/network_scores"),
+                    output("motif_inference/network_bins"),
+                    output("motif_inference/motifs_pfm"),
+                    output("motif_inference/motifs_score"),
+                ]
+            ),
+            dag_scheduler.Task(
+                "STEP2", self.step2,
+                inputs=[
+                    genes, regulators,
+                    resource(self.config["FILENAME_EXPRESSION_DATA"]),
+                    resource(self.config["FILENAME_SAMPLE_CONDITIONS"]),
+                    resource("tmp"),
+                ],
+                outputs=[
+                    resource("tmp/rdata.expr"),
+                    resource("tmp/data.fc.tsv"),
+                    resource("tmp/allowed.adj"),
+                    resource("tmp/data.pert.adj"),
+                    resource("tmp/data.pert.tsv"),
+                    self.bundle,
+                ],
+                threads=self.processes, min_threads=1,
+                memory=memory(expression=3, per_thread=128 * mb)
+            ),
+            dag_scheduler.Task(
+                "STEP3", self.step3,
+                inputs=[
+                    genes, regulators,
+                    resource(self.config["FILENAME_EXPRESSION_DATA"]),
+                    resource(self.config["FILENAME_DE_ADJMTR"]),
+                    resource("tmp/rdata.expr"),
+                    resource("tmp/allowed.adj"),
+                    resource("tmp/data.pert.adj"),
+                    output("networks"),
+                ],
+                outputs=[self.network("np.adjmtr", binary=False)],
+                threads=self.processes, min_threads=1,
+                memory=memory(expression=4, per_thread=256 * mb, per_thread_expression=1)
+            ),
+            dag_scheduler.Task(
+                "STEP4", self.step4,
+                inputs=[
+                    regulators,
+                    resource("tmp/data.fc.tsv"),
+                    resource("tmp/data.pert.adj"),
+                    output("networks"),
+                ],
+                outputs=[self.network("bn.adjmtr")],
+                threads=self.processes, min_threads=1,
+                memory=memory(expression=2, per_thread=512 * mb, per_thread_expression=2)
+            ),
+            dag_scheduler.Task(
+                "STEP5", self.step5,
+                inputs=[genes, regulators, dbd, self.network("np.adjmtr", binary=False)],
+                outputs=[self.network("npwa.adjmtr")],
+                memory=memory(networks=4)
+            ),
+            dag_scheduler.Task(
+                "STEP6", self.step6,
+                inputs=[genes, regulators, dbd, self.network("bn.adjmtr")],
+                outputs=[self.network("bnwa.adjmtr")],
+                memory=memory(networks=4)
+            ),
+            dag_scheduler.Task(
+                "STEP7", self.step7,
+                inputs=[self.network("npwa.adjmtr"), self.network("bnwa.adjmtr")],
+                outputs=[self.network("npwa_bnwa.adjmtr")],
+                memory=memory(networks=6)
+            ),
+            dag_scheduler.Task(
+                "STEP8", self.step8,
+                inputs=[
+                    genes, regulators,
+                    resource(self.config["FILENAME_PROMOTERS"]),
+                    self.network("npwa_bnwa.adjmtr"),
+                    output("motif_inference/network_bins"),
+                ],
+                outputs=[
+                    output("motif_inference/network_bins"),
+                    output("motif_inference/motifs.txt"),
+                    output("motif_inference/motifs_pfm"),
+                ] + ([] if batched else scored),
+                threads=self.processes, min_threads=1,
+                params={"MOTIF_THRESHOLD": self.config["MOTIF_THRESHOLD"], "FIREDIR": os.getenv("FIREDIR"), "SCANNER": self.scanner,
+                        "INFERENCE": self.inference},
+                memory=memory(networks=2, per_thread=256 * mb)
+            ),
+            dag_scheduler.Task(
+                "STEP9", self.step9,
+                inputs=[
+                    regulators,
+                    resource(self.config["FILENAME_PROMOTERS"]),
+                    output("motif_inference/network_bins"),
+                    output("motif_inference/motifs_pfm"),
+                ] + ([] if batched else scored[:1]),
+                outputs=scored[:1] if batched else [],
+                threads=self.processes, min_threads=1,
+                params={"SCANNER": self.scanner, "INFERENCE": self.inference},
+                memory=memory(per_thread=256 * mb)
+            ),
+            dag_scheduler.Task(
+                "STEP10", self.step10,
+                inputs=[
+                    genes, regulators,
+                    output("motif_inference/motifs.txt"),
+                    output("motif_inference/motifs_score"),
+                ],
+                outputs=scored[1:] if batched else [],
+                threads=self.processes, min_threads=1,
+                params={"MOTIF_THRESHOLD": self.config["MOTIF_THRESHOLD"]},
+                memory=memory(networks=2, per_thread=128 * mb)
+            ),
+            dag_scheduler.Task(
+                "STEP11", self.step11,
+                inputs=[
+                    regulators, dbd,
+                    self.network("npwa_bnwa.adjmtr"),
+                    self.network("mn.adjmtr"),
+                ],
+                outputs=[
+                    self.network("npwa_bnwa_mn.adjmtr"),
+                    output(self.config["FILENAME_NETPROPHET2_NETWORK"]),
+                ],
+                memory=memory(networks=4)
+            ),
+        ]
 
-        with open(self.progress, "w+") as w:
-            json.dump(progress, w, indent=4)
+    def run(self):
+        u"""
+        run the whole pipeline, steps whose inputs are ready run concurrently within the cpu budget
+        :return:
+        """
+        report = os.path.join(self.config["NETPROPHET2_DIR"], "reports", "run.%s.jsonl" % time.strftime("%Y%m%d-%H%M%S"))
+        if not os.path.exists(os.path.dirname(report)):
+            os.makedirs(os.path.dirname(report))
+        # pool workers and external programs inherit the report through the environment
+        os.environ[resource_report.ENV_REPORT] = report
+
+        tasks = self.tasks()
+        for task in tasks:
+            task.func = resource_report.measured(task.name, task.func)
+        try:
+            dag_scheduler.DAGScheduler(tasks, self.processes, self.memory).run()
+        finally:
+            if os.path.exists(report):
+                logging.info("Resource usage, saved to %s:\n%s" % (report, resource_report.summarize(resource_report.read_report(report))))
 
-    def step1(self):
+    def step1(self, processes: int=None):
         u"""
         STEP 1 to create output dir or files
         :return:
@@ -149,19 +501,22 @@ class SnakeMakePipe(object):
                 logging.info("%s exists" % i)
         self.log_progress(1)
 
-    def step2(self):
+    def step2(self, processes: int=None):
         u"""
 
         :return:
         """
         logging.info("STEP2: prepare_resources")
 
-        if not self.check_progress(1):
-            raise FileNotFoundError("Please run STEP1 before run STEP2")
+        missing = self.check_requires(2)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP2".format(", ".join(missing)))
         else:
 
             if not self.check_progress(2):
                 prepare_resources.main([
+                    "-ob", self.bundle,
+                    "-p", str(processes or self.processes),
                     "-g", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
@@ -211,18 +566,20 @@ class SnakeMakePipe(object):
 
                 self.log_progress(2)
 
-    def step3(self):
+    def step3(self, processes: int=None):
         u"""
 
         :return:
         """
         logging.info("STEP3: map_np_network")
-        if not self.check_progress(2):
-            raise FileNotFoundError("Please run STEP2 before run STEP3")
+        missing = self.check_requires(3)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP3".format(", ".join(missing)))
         else:
             if not self.check_progress(3):
-                check_call(
-                    "bash {program} -m -u {input_u} -t {input_t} -r {input_r} -a {input_a} -p {input_p} -d {input_d} -g {input_g} -f {input_f} -o {input_o} -n {output_n}".format(**{
+                resource_report.check_call(
+                    "bash {program} -m -j {processes} -u {input_u} -t {input_t} -r {input_r} -a {input_a} -p {input_p} -d {input_d} -g {input_g} -f {input_f} -o {input_o} -n {output_n}".format(**{
+                        "processes": processes or self.processes,
                         "program": os.path.join(self.__root__, "SRC/NetProphet1/netprophet"),
                         "input_u": os.path.join(
                             self.config["NETPROPHET2_DIR"], "SRC/NetProphet1/"),
@@ -271,12 +628,13 @@ class SnakeMakePipe(object):
                             "networks/np.adjmtr"
                         )
                     }),
+                    name="NetProphet1",
                     shell=True
                 )
 
                 self.log_progress(3)
 
-    def step4(self):
+    def step4(self, processes: int=None):
         u"""
 
         data_fc_expr=${1}
@@ -290,48 +648,61 @@ class SnakeMakePipe(object):
 
         logging.info("STEP4: map_bart_network")
 
-        if not self.check_progress(3):
-            raise FileNotFoundError("Please run STEP3 before run STEP4")
+        missing = self.check_requires(4)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP4".format(", ".join(missing)))
         else:
             if not self.check_progress(4):
-                check_call("Rscript --vanilla {program} fcFile={data_fc_expr} isPerturbedFile={pert_matrix} tfNameFile={tf_names} saveTo={output_adjmtr}.tsv mpiBlockSize={processes}".format(**{
-                    "program": os.path.join(self.__root__, "CODE/build_bart_network.r"),
-                    "data_fc_expr": os.path.join(
+                # targets are fitted shard by shard, a killed run resumes from the unfinished shards
+                bart_shards.main([
+                    "-e", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
                         "tmp/data.fc.tsv"
                     ),
-                    "pert_matrix": os.path.join(
+                    "-x", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
                         "tmp/data.pert.adj"
                     ),
-                    "tf_names": os.path.join(
+                    "-t", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
                         self.config["FILENAME_REGULATORS"]
                     ),
-                    "output_adjmtr": os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/bn.adjmtr"
-                    ),
-                    "processes": self.processes
-                }), shell=True)
+                    "-o", self.network("bn.adjmtr", binary=False) + ".tsv",
+                    "-n", str(self.bart_shards),
+                    "-p", str(processes or self.processes),
+                    "-L", self.ledger.path,
+                    "--program", os.path.join(self.__root__, "CODE/build_bart_network.r")
+                ])
 
                 # 推测，这里只是单纯的去除行名和列名
-                o = os.path.join(self.config["NETPROPHET2_DIR"], self.config["OUTPUT_DIR"], "networks/bn.adjmtr")
-                with open(o, "w+") as w:
+                o = self.network("bn.adjmtr", binary=False)
+                if self.binary:
+                    # keep the row and column names in the header of the binary network
+                    rids, rows = [], []
                     with open(o + ".tsv") as r:
-                        for idx, line in enumerate(r):
-                            if idx > 0:
-                                lines = line.split()
-                                if len(lines) > 0:
-                                    w.write("\t".join(lines[1:]) + "\n")
+                        gids = [x.strip('"') for x in r.readline().split()]
+                        for line in r:
+                            lines = line.split()
+                            if len(lines) > 0:
+                                rids.append(lines[0].strip('"'))
+                                rows.append([float("nan") if x == "NA" else float(x) for x in lines[1:]])
+                    network_io.save_network(self.network("bn.adjmtr"), rows, rids, gids)
+                if not self.binary or self.export_text:
+                    # the text copy keeps the values as R wrote them
+                    with open(o, "w+") as w:
+                        with open(o + ".tsv") as r:
+                            for idx, line in enumerate(r):
+                                if idx > 0:
+                                    lines = line.split()
+                                    if len(lines) > 0:
+                                        w.write("\t".join(lines[1:]) + "\n")
 
                 self.log_progress(4)
 
-    def step5(self):
+    def step5(self, processes: int=None):
         u"""
 
         :return:
@@ -339,16 +710,14 @@ class SnakeMakePipe(object):
 
         logging.info("STEP5: weighted_average_np_network")
 
-        if not self.check_progress(4):
-            raise FileNotFoundError("Please run STEP4 before run STEP5")
+        missing = self.check_requires(5)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP5".format(", ".join(missing)))
         else:
             if not self.check_progress(5):
                 weighted_avg_similar_dbds.main([
-                    "-n", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/np.adjmtr"
-                    ),
+                    "-B", self.bundle,
+                    "-n", self.network("np.adjmtr", binary=False),
                     "-r", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
@@ -360,32 +729,33 @@ class SnakeMakePipe(object):
                         self.config["DBD_PID_DIR"]
                     ),
                     "-d", "50", "-t", "single_dbds",
-                    "-o", os.path.join(
+                    "-c", os.path.join(self.config["NETPROPHET2_DIR"], self.config["RESOURCES_DIR"], "tmp"),
+                    "-g", os.path.join(
                         self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/npwa.adjmtr"
-                    )
+                        self.config["RESOURCES_DIR"],
+                        self.config["FILENAME_GENES"]
+                    ),
+                    "-o", self.network("npwa.adjmtr")
                 ])
+                self.export_network("npwa.adjmtr")
 
                 self.log_progress(5)
 
-    def step6(self):
+    def step6(self, processes: int=None):
         u"""
 
         :return:
         """
         logging.info("STEP6: weighted_average_bart_network")
 
-        if not self.check_progress(5):
-            raise FileNotFoundError("Please run STEP5 before run STEP6")
+        missing = self.check_requires(6)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP6".format(", ".join(missing)))
         else:
             if not self.check_progress(6):
                 weighted_avg_similar_dbds.main([
-                    "-n", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/bn.adjmtr"
-                    ),
+                    "-B", self.bundle,
+                    "-n", self.network("bn.adjmtr"),
                     "-r", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
@@ -397,72 +767,63 @@ class SnakeMakePipe(object):
                         self.config["DBD_PID_DIR"]
                     ),
                     "-d", "50", "-t", "single_dbds",
-                    "-o", os.path.join(
+                    "-c", os.path.join(self.config["NETPROPHET2_DIR"], self.config["RESOURCES_DIR"], "tmp"),
+                    "-g", os.path.join(
                         self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/bnwa.adjmtr"
-                    )
+                        self.config["RESOURCES_DIR"],
+                        self.config["FILENAME_GENES"]
+                    ),
+                    "-o", self.network("bnwa.adjmtr")
                 ])
+                self.export_network("bnwa.adjmtr")
 
                 self.log_progress(6)
 
-    def step7(self):
+    def step7(self, processes: int=None):
         u"""
 
         :return:
         """
         logging.info("STEP7: combine_npwa_bnwa")
 
-        if not self.check_progress(6):
-            raise FileNotFoundError("Please run STEP6 before run STEP7")
+        missing = self.check_requires(7)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP7".format(", ".join(missing)))
         else:
             if not self.check_progress(7):
-                check_call(
-                    "Rscript {program} {input_n} {input_b} {output_o}".format(**{
-                        "program": os.path.join(self.__root__, "CODE/quantile_combine_networks.r"),
-                        "input_n": os.path.join(
-                            self.config["NETPROPHET2_DIR"],
-                            self.config["OUTPUT_DIR"],
-                            "networks/npwa.adjmtr"
-                        ),
-                        "input_b": os.path.join(
-                            self.config["NETPROPHET2_DIR"],
-                            self.config["OUTPUT_DIR"],
-                            "networks/bnwa.adjmtr"
-                        ),
-                        "output_o": os.path.join(
-                            self.config["NETPROPHET2_DIR"],
-                            self.config["OUTPUT_DIR"],
-                            "networks/npwa_bnwa.adjmtr"
-                        )
-                    }),
-                    shell=True
-                )
+                quantile_combine_networks.main([
+                    "-i", self.network("npwa.adjmtr"), self.network("bnwa.adjmtr"),
+                    "-o", self.network("npwa_bnwa.adjmtr")
+                ])
+                self.export_network("npwa_bnwa.adjmtr")
 
                 self.log_progress(7)
 
-    def step8(self):
+    def step8(self, processes: int=None):
         u"""
 
         ## Check if all motifs are ready
         bash CODE/check_inference_status.sh ${OUTPUT_DIR}/motif_inference/motif_inference.log $REGULATORS $FLAG
 
+        every regulator goes on to FIMO and its row of the motif network as soon as its FIRE run is finished,
+        so this step also does the work of STEP9 and STEP10; those are kept to re-run them alone.
+        With the fimo-batch scanner this step stops at the motifs, and STEP9 scores all of them in a few
+        batched fimo runs before STEP10 builds the motif network
+
         :return:
         """
         logging.info("STEP8: infer_motifs")
 
-        if not self.check_progress(7):
-            raise FileNotFoundError("Please run STEP7 before run STEP8")
+        missing = self.check_requires(8)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP8".format(", ".join(missing)))
         else:
             if not self.check_progress(8):
                 logging.info("Binning promoters based on network scores ... ")
 
-                parse_network_scores.main([
-                    "-a", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/npwa_bnwa.adjmtr"
-                    ),
+                bin_network_scores.main([
+                    "-B", self.bundle,
+                    "-a", self.network("npwa_bnwa.adjmtr"),
                     "-r", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
@@ -473,74 +834,97 @@ class SnakeMakePipe(object):
                         self.config["RESOURCES_DIR"],
                         self.config["FILENAME_GENES"]
                     ),
-                    "-o", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "motif_inference/network_scores"
-                    )
-                ])
-
-                parse_quantized_bins.main([
                     "-n", "20",
-                    "-i", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "motif_inference/network_scores"
-                    ),
                     "-o", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["OUTPUT_DIR"],
                         "motif_inference/network_bins"
                     ),
+                    "-p", str(processes or self.processes)
                 ])
 
                 logging.info("Done")
 
-                promoter = os.path.join(
-                    self.config["NETPROPHET2_DIR"],
-                    self.config["RESOURCES_DIR"],
-                    self.config["FILENAME_PROMOTERS"]
-                )
-                out_dir = os.path.join(
-                    self.config["NETPROPHET2_DIR"],
-                    self.config["OUTPUT_DIR"]
-                )
-
-                tasks = []
-                with open(os.path.join(
+                # FIRE, FIMO and the motif network of every regulator as one pipeline, covers STEP9 and STEP10
+                logging.info("Inferring and scoring motifs of every regulator ... ")
+                args = [
+                    "-B", self.bundle,
+                    "-r", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
-                        self.config["FILENAME_REGULATORS"])
-                ) as r:
-                    for regulator in r:
-                        regulator = regulator.strip()
-
-                        tasks.append(
-                            "perl {FIREDIR}/fire.pl --expfiles={OUTDIR} --exptype=discrete --fastafile_dna={PROMOTER} --k=7 --jn=20 --jn_t=16 --nodups=1 --dorna=0 --dodnarna=0".format(**{
-                                "FIREDIR": os.getenv("FIREDIR"),
-                                "OUTDIR": os.path.join(out_dir, "motif_inference/network_bins", regulator),
-                                "PROMOTER": promoter
-                            })
-                        )
-
-                try:
-                    with Pool(self.processes) as p:
-                        list(tqdm(p.imap(call, tasks), total=len(tasks)))
-                except CalledProcessError as err:
-                    logging.error(err)
-                    exit(1)
-
+                        self.config["FILENAME_REGULATORS"]
+                    ),
+                    "-g", os.path.join(
+                        self.config["NETPROPHET2_DIR"],
+                        self.config["RESOURCES_DIR"],
+                        self.config["FILENAME_GENES"]
+                    ),
+                    "-P", os.path.join(
+                        self.config["NETPROPHET2_DIR"],
+                        self.config["RESOURCES_DIR"],
+                        self.config["FILENAME_PROMOTERS"]
+                    ),
+                    "-b", os.path.join(
+                        self.config["NETPROPHET2_DIR"],
+                        self.config["OUTPUT_DIR"],
+                        "motif_inference/network_bins"
+                    ),
+                    "-m", os.path.join(
+                        self.config["NETPROPHET2_DIR"],
+                        self.config["OUTPUT_DIR"],
+                        "motif_inference/motifs_pfm"
+                    ),
+                    "-f", os.path.join(
+                        self.config["NETPROPHET2_DIR"],
+                        self.config["OUTPUT_DIR"],
+                        "motif_inference/motifs_score"
+                    ),
+                    "-l", os.path.join(
+                        self.config["NETPROPHET2_DIR"],
+                        self.config["OUTPUT_DIR"],
+                        "motif_inference/motifs.txt"
+                    ),
+                    "-t", "robust",
+                    "-v", str(self.config["MOTIF_THRESHOLD"]),
+                    "-o", self.network("mn.adjmtr"),
+                    "--fire", os.path.join(os.getenv("FIREDIR", ""), "fire.pl"),
+                    "--fimo", os.path.join(self.__root__, "SRC/meme/bin/fimo"),
+                    "-p", str(processes or self.processes),
+                    "-L", self.ledger.path,
+                    "--scanner", {"builtin": "builtin", "fimo-batch": "none"}.get(self.scanner, "fimo"),
+                    "--inference", self.inference,
+                    "-S", os.path.join(
+                        self.config["NETPROPHET2_DIR"],
+                        self.config["OUTPUT_DIR"],
+                        "motif_inference/promoters" + promoter_store.STORE_SUFFIX
+                    ),
+                    "--retries", str(self.task_retries),
+                    "-F", os.path.join(
+                        self.config["NETPROPHET2_DIR"],
+                        self.config["OUTPUT_DIR"],
+                        "motif_inference/failed_regulators.txt"
+                    )
+                ]
+                if self.task_timeout is not None:
+                    args.extend(["--timeout", str(self.task_timeout)])
+                # failed regulators are reported and left out of the motif network
+                motif_pipeline.main(args)
                 self.log_progress(8)
+                if self.scanner != "fimo-batch":
+                    self.export_network("mn.adjmtr")
+                    self.log_progress(9)
+                    self.log_progress(10)
 
-    def step9(self):
+    def step9(self, processes: int=None):
         u"""
 
         :return:
         """
         logging.info("STEP9: score_motifs")
 
-        if not self.check_progress(8):
-            raise FileNotFoundError("Please run STEP8 before run STEP9")
+        missing = self.check_requires(9)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP9".format(", ".join(missing)))
         else:
             if not self.check_progress(9):
                 OUTPUT_DIR = os.path.join(
@@ -568,11 +952,13 @@ class SnakeMakePipe(object):
                 )
 
                 logging.info("Parsing motif inference results ... ")
-                parse_motif_summary.main([
-                    "-a", "True",
-                    "-i", MOTIFS_DIR,
-                    "-o", MOTIFS_LIST
-                ])
+                # k-mer motifs are only in the motifs.txt of step 8, there are no FIRE outputs to parse
+                if self.inference == "fire":
+                    parse_motif_summary.main([
+                        "-a", "True",
+                        "-i", MOTIFS_DIR,
+                        "-o", MOTIFS_LIST
+                    ])
                 convert_fire2meme.main([
                     "-i", MOTIFS_LIST,
                     "-o", os.path.join(OUTPUT_DIR, "motif_inference/motifs_pfm/")
@@ -585,7 +971,7 @@ class SnakeMakePipe(object):
                 FN_PROMOTERS = PROMOTERS  # promoter sequence file
                 OUT_FIMO = os.path.join(OUTPUT_DIR, "motif_inference/motifs_score")  # directory of fimo alignment output
 
-                tasks1, tasks2, tasks3 = [], [], []
+                tasks1, tasks2 = [], []
                 with open(REGULATORS) as r:
                     for regulator in r:
                         regulator = regulator.strip()
@@ -595,53 +981,78 @@ class SnakeMakePipe(object):
 
                         if os.path.exists(os.path.join(OUT_FIMO, regulator)):
                             rmtree(os.path.join(OUT_FIMO, regulator))
-                        os.makedirs(os.path.join(OUT_FIMO, regulator))
+                        if self.scanner != "fimo-batch":
+                            os.makedirs(os.path.join(OUT_FIMO, regulator))
 
-                        tasks1.append("{fimo} -o {OUT_FIMO}/{regulator} --thresh 5e-3 {FN_TF_PWM}/{regulator} {FN_PROMOTERS}".format(**{
+                        tasks1.append((regulator, "{fimo} -o {OUT_FIMO}/{regulator} --thresh 5e-3 {FN_TF_PWM}/{regulator} {FN_PROMOTERS}".format(**{
                             "OUT_FIMO": OUT_FIMO,
                             "regulator": regulator,
                             "FN_TF_PWM": FN_TF_PWM,
                             "FN_PROMOTERS": FN_PROMOTERS,
                             "fimo": os.path.join(self.__root__, "SRC/meme/bin/fimo")
-                        }))
-
-                        tasks2.append("sed '1d' {OUT_FIMO}/{regulator}/fimo.txt | cut -f 1,2,7 > {OUT_FIMO}/{regulator}/temp.txt".format(**{
-                            "OUT_FIMO": OUT_FIMO,
-                            "regulator": regulator,
-                        }))
-
-                        tasks3.append("ruby {program} -i {OUT_FIMO}/{regulator}/temp.txt > {OUT_FIMO}/{regulator}.summary".format(**{
-                            "OUT_FIMO": OUT_FIMO,
-                            "regulator": regulator,
-                            "program": os.path.join(self.__root__, "CODE/estimate_affinity.rb")
-                        }))
-
-                with Pool(self.processes) as p:
-                    try:
-                        list(tqdm(p.imap(call, tasks1), total=len(tasks1)))
-                    except CalledProcessError as err:
-                        pass
-                    try:
-                        list(tqdm(p.imap(call, tasks2), total=len(tasks2)))
-                        list(tqdm(p.imap(call, tasks3), total=len(tasks3)))
-                    except CalledProcessError as err:
-                        logging.error(err)
-                        exit(1)
+                        }), self.task_timeout, self.task_retries))
+
+                        tasks2.append((
+                            batch_fimo.sites_path(OUT_FIMO, regulator) if self.scanner == "fimo-batch" else os.path.join(OUT_FIMO, regulator, "fimo.txt"),
+                            os.path.join(OUT_FIMO, regulator + ".summary")
+                        ))
+
+                if self.scanner == "builtin":
+                    # the promoters are encoded once and the motifs of all regulators are scanned in batches
+                    scan_motifs.main([
+                        "-m", FN_TF_PWM,
+                        "-r", REGULATORS,
+                        "-P", FN_PROMOTERS,
+                        "-S", os.path.join(OUTPUT_DIR, "motif_inference/promoters" + promoter_store.STORE_SUFFIX),
+                        "-o", OUT_FIMO,
+                        "-t", "5e-3",
+                        "-p", str(processes or self.processes)
+                    ])
+                    tasks1 = []
+                elif self.scanner == "fimo-batch":
+                    # a fimo run per batch of motifs, its sites are split into <regulator>.fimo.txt
+                    args = [
+                        "-m", FN_TF_PWM,
+                        "-r", REGULATORS,
+                        "-P", FN_PROMOTERS,
+                        "-o", OUT_FIMO,
+                        "-t", "5e-3",
+                        "-p", str(processes or self.processes),
+                        "--fimo", os.path.join(self.__root__, "SRC/meme/bin/fimo"),
+                        "--retries", str(self.task_retries)
+                    ]
+                    if self.task_timeout is not None:
+                        args.extend(["--timeout", str(self.task_timeout)])
+                    for regulator, error in batch_fimo.main(args).items():
+                        # scored as a motif without any site, as before
+                        logging.warning("FIMO of %s failed: %s" % (regulator, error))
+                    tasks1 = []
+
+                with Pool(processes or self.processes) as p:
+                    for regulator, error in tqdm(p.imap_unordered(call_fimo, tasks1), total=len(tasks1)):
+                        if error is not None:
+                            # scored as a motif without any site, as before
+                            logging.warning("FIMO of %s failed: %s" % (regulator, error))
+                    for fn_summary, error in tqdm(p.imap_unordered(write_affinity, tasks2), total=len(tasks2)):
+                        if error is not None:
+                            logging.warning("Affinity summary %s failed: %s" % (fn_summary, error))
 
                 self.log_progress(9)
 
-    def step10(self):
+    def step10(self, processes: int=None):
         u"""
         :return:
         """
 
         logging.info("STEP10: build_motif_network")
 
-        if not self.check_progress(9):
-            raise FileNotFoundError("Please run STEP9 before run STEP10")
+        missing = self.check_requires(10)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP10".format(", ".join(missing)))
         else:
             if not self.check_progress(10):
                 build_motif_network.main([
+                    "-B", self.bundle,
                     "-i", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["OUTPUT_DIR"],
@@ -664,46 +1075,35 @@ class SnakeMakePipe(object):
                     ),
                     "-t", "robust",
                     "-v", str(self.config["MOTIF_THRESHOLD"]),
-                    "-o", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/mn.adjmtr"
-                    )
+                    "-p", str(processes or self.processes),
+                    "-o", self.network("mn.adjmtr")
                 ])
+                self.export_network("mn.adjmtr")
 
                 self.log_progress(10)
 
-    def step11(self):
+    def step11(self, processes: int=None):
         u"""
         :return:
         """
         logging.info("STEP11: assemble_final_network")
-        if not self.check_progress(10):
-            raise FileNotFoundError("Please run STEP10 before run STEP11")
+        missing = self.check_requires(11)
+        if missing:
+            raise FileNotFoundError("Please run {} before run STEP11".format(", ".join(missing)))
         else:
             if not self.check_progress(11):
                 combine_networks.main([
                     "-s", "resort",
-                    "-n", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/npwa_bnwa.adjmtr"
-                    ),
-                    "-b", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/mn.adjmtr"
-                    ),
+                    "-n", self.network("npwa_bnwa.adjmtr"),
+                    "-b", self.network("mn.adjmtr"),
                     "-od", os.path.join(self.config["NETPROPHET2_DIR"], self.config["OUTPUT_DIR"], "networks/"),
-                    "-om", "npwa_bnwa_mn.adjmtr"
+                    "-om", os.path.basename(self.network("npwa_bnwa_mn.adjmtr"))
                 ])
+                self.export_network("npwa_bnwa_mn.adjmtr")
 
                 weighted_avg_similar_dbds.main([
-                    "-n", os.path.join(
-                        self.config["NETPROPHET2_DIR"],
-                        self.config["OUTPUT_DIR"],
-                        "networks/", "npwa_bnwa_mn.adjmtr"
-                    ),
+                    "-B", self.bundle,
+                    "-n", self.network("npwa_bnwa_mn.adjmtr"),
                     "-r", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["RESOURCES_DIR"],
@@ -715,6 +1115,7 @@ class SnakeMakePipe(object):
                         self.config["DBD_PID_DIR"]
                     ),
                     "-d", "50", "-f", "single_dbds",
+                    "-c", os.path.join(self.config["NETPROPHET2_DIR"], self.config["RESOURCES_DIR"], "tmp"),
                     "-o", os.path.join(
                         self.config["NETPROPHET2_DIR"],
                         self.config["OUTPUT_DIR"],
@@ -730,6 +1131,24 @@ if __name__ == '__main__':
 
     parser.add_argument("-c", "--config", type=str, required=True, help="Path to config file")
     parser.add_argument("-p", "--processes", type=int, default=1, help="How many cpu to use")
+    parser.add_argument("-b", "--binary", action="store_true", default=False,
+                        help="Pass the intermediate networks between steps as binary memory-mapped files")
+    parser.add_argument("--export-text", dest="export_text", action="store_true", default=False,
+                        help="Also write text copies of the binary intermediate networks")
+    parser.add_argument("--bart-shards", dest="bart_shards", type=int, default=10,
+                        help="Build the BART network of step 4 in this many shards of target genes, finished shards are kept")
+    parser.add_argument("--task-timeout", dest="task_timeout", type=float, default=None,
+                        help="Kill a FIRE or FIMO run of a regulator after this many seconds")
+    parser.add_argument("--task-retries", dest="task_retries", type=int, default=1,
+                        help="Try a failed or killed FIRE or FIMO run again this many times")
+    parser.add_argument("--scanner", type=str, default="fimo", choices=["fimo", "fimo-batch", "builtin"],
+                        help="Score the motifs with a fimo run per regulator, a fimo run per batch of motifs in step 9, "
+                             "or the built-in scanner on promoters encoded once")
+    parser.add_argument("--inference", type=str, default="fire", choices=["fire", "kmer"],
+                        help="Infer the motifs of step 8 with a FIRE run per regulator, or from the mutual information "
+                             "of 7-mers with the bins of all regulators at once")
+    parser.add_argument("-m", "--memory", type=float, default=None,
+                        help="GB of memory shared by the steps running at the same time, default is the physical memory")
 
     if len(sys.argv) <= 1:
         parser.print_help()
@@ -749,19 +1168,11 @@ if __name__ == '__main__':
             else:
                 processes = args.processes
 
-            runner = SnakeMakePipe(args.config, args.processes)
-
-            runner.step1()
-            runner.step2()
-            runner.step3()
-            runner.step4()
-            runner.step5()
-            runner.step6()
-            runner.step7()
-            runner.step8()
-            runner.step9()
-            runner.step10()
-            runner.step11()
+            runner = SnakeMakePipe(args.config, processes, binary=args.binary, export_text=args.export_text, bart_shards=args.bart_shards,
+                                   task_timeout=args.task_timeout, task_retries=args.task_retries,
+                                   memory=args.memory * 2 ** 30 if args.memory else None, scanner=args.scanner,
+                                   inference=args.inference)
+            runner.run()
 
         except ArgumentError as err:
             print(err)